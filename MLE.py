@@ -79,6 +79,97 @@ def MLEVAR(YY,L):
 
     return B, S, y, x.T
 
+def MLEVARindices(L):
+    """
+    This function builds the index maps of a VAR with the lags L of each
+    variable. The companion form stacks max(L) lags of every variable, the
+    first lag of each variable in turn followed by the second lag and so on,
+    and noncinds keeps the states which are in the system, dropping the lags
+    beyond L[k] of variable k.
+
+    Inputs:
+    L:          A list of the number of lags used for each variable in the VAR.
+
+    Returns:
+    cn:         A list of the locations of the first coefficients for each variable.
+    noncinds:   A list of the indices of the companion form states kept in the system.
+    """
+    K = len(L)
+    cn = [0] + np.cumsum(L).astype(int).tolist()
+    noncinds = [l * K + k for l in range(max(L)) for k in range(K) if l < L[k]]
+    return cn, noncinds
+
+def MLEVARinitial(YY, L):
+    """
+    This function builds the date zero observation X_0 of the state: the first
+    L[k] observations of each variable, most recent first, ordered like the
+    states selected by noncinds (see MLEVARindices).
+
+    Inputs:
+    YY:         A list of numpy arrays of the relevant time series, as passed to MLEVAR.
+    L:          A list of the number of lags used for each variable in the VAR.
+
+    Returns:
+    X0:         A numpy array containing the date zero observation of X_t.
+    """
+    K = len(L)
+    return np.array([YY[k][L[k] - 1 - l] for l in range(max(L)) for k in range(K) if l < L[k]])
+
+def MLEVARcompanion(B, S, L, noncinds):
+    """
+    This function writes the VAR estimated by MLEVAR as a VAR(1) in the states
+    selected by noncinds.
+
+    Inputs:
+    B:          A numpy array of the coefficients, as returned by MLEVAR.
+    S:          A numpy array of the variance of the error terms, as returned by MLEVAR.
+    L:          A list of the number of lags used for each variable in the VAR.
+    noncinds:   A list of the indices of the companion form states kept in the system.
+
+    Returns:
+    G:          The transition matrix for the VAR system.
+    BB:         The one period covariance matrix of the VAR system.
+    mx:         The coefficients for the constant on each variable.
+    """
+    K = len(L)
+    n = max(L) * K
+    nstate = len(noncinds)
+    G = np.vstack((B[:, 1:], np.hstack((np.eye(n - K), np.zeros((n - K, K))))))
+    G = G[noncinds][:, noncinds]
+    H = np.vstack((np.linalg.cholesky(S), np.zeros((nstate - K, K))))
+    mx = np.zeros(nstate); mx[:K] = B[:, 0]
+    return G, H @ H.T, mx
+
+def MLEVARtriangular(y, x):
+    """
+    This function runs the regressions of the triangular system of Zha (1999):
+    each variable is regressed on the lags in x and on the current values of the
+    variables before it, so that the errors of the equations are uncorrelated.
+
+    Inputs:
+    y:          A list of numpy arrays of the lagged y data, as returned by MLEVAR.
+    x:          A numpy array of the x data, as returned by MLEVAR.
+
+    Returns:
+    T:          An integer representing the number of time periods included in the
+                    regressions after lags are taken into consideration.
+    b_hat0:     A list of numpy arrays containing the results from the uncorrelated
+                    regressions.
+    Lam:        A list of the lambda matrix used in the precision matrix calculation
+                    for the coefficient draws described in Zha.
+    dt:         A list of d_ts used to draw the scaling coefficient zeta.
+    """
+    b_hat0 = []
+    Lam = []
+    dt = []
+    for k in range(len(y)):
+        xk = np.vstack([x] + list(y[:k]))
+        b_hat0.append(la.solve(xk @ xk.T, xk @ y[k]))
+        Lam.append(xk @ xk.T)
+        et = y[k] - xk.T @ b_hat0[k]        # Residuals
+        dt.append(et @ et)
+    return len(y[0]), b_hat0, Lam, dt
+
 @jit(nopython=True)
 def mvn(mu, sigma):
     """Generate a sample from multivarate normal with mean mu and covariance sigma."""
@@ -89,12 +180,17 @@ def mvn(mu, sigma):
     zs = mu + A@z
     return zs
 
-@jit # This function cannot be used with nopython jit since it creates numpy arrays
-def MLEVARsim(K, T, b_hat0, Lam, dt, L, cn, s, noncinds):
+@jit(nopython=True)
+def nbseed(s):
+    """Seed the random number generator used inside nopython functions such as mvn."""
+    np.random.seed(s)
+
+def MLEVARdraw(K, T, b_hat0, Lam, dt, s, shift = None):
     """
-    This function takes the results of the uncorrelated VAR described by Zha
-    (1999). It then draws new coefficients from the posterior distribution
-    and rearranges them into the corresponding objects from the VAR.
+    This function draws the scaling coefficients zeta and the regression
+    coefficients of the uncorrelated VAR described by Zha (1999). Given shift,
+    the coefficients are instead drawn from the posterior with its mean shifted
+    by shift, which is used as an importance sampling proposal.
 
     Inputs:
     K:          An integer representing the number of variables in the VAR.
@@ -105,34 +201,60 @@ def MLEVARsim(K, T, b_hat0, Lam, dt, L, cn, s, noncinds):
     Lam:        A list of the lambda matrix used in the precision matrix calculation
                     for the coefficient draws described in Zha.
     dt:         A list of d_ts used to draw the scaling coefficient zeta.
-    L:          A list of the number of lags used for each variable in the VAR.
-    cn:         A list of the locations of the first coefficients for each variable.
     s:          An integer use to seed the random number generator.
-    noncinds:   A list of indices which will be used to drop the extra lag of the
-                    consumption growth variable which this system estimates.
+    shift:      None, or a list of numpy arrays shifting the mean of the coefficients
+                    of each equation.
 
     Returns:
-    G:          The transition matrix for the VAR system.
-    BB:         The one period covariance matrix given the newly drawn coefficients.
-    mx:         The coefficients for the constant on each variable.
+    zeta:       A list of the drawn scaling coefficients.
+    b_hat1:     A list of numpy arrays containing the drawn coefficients.
+    logratio:   The log of the ratio of the posterior density to the proposal
+                    density at the draw, 0 when shift is None.
     """
     # Create empty lists to store the drawn coefficients
     zeta = []
     b_hat1 = []
-    # Seed the random number generator
+    logratio = 0.
+    # Seed the random number generators, numba keeps its own state for nopython code
     np.random.seed(s)
+    nbseed(s)
     for k in range(K):
         zeta.append(np.random.gamma(T/2 + 1, 2 / dt[k]))
         cov = np.linalg.inv(zeta[k] * Lam[k])
-        b_hat1.append(mvn(b_hat0[k], cov))
+        if shift is None:
+            b_hat1.append(mvn(b_hat0[k], cov))
+        else:
+            b_hat1.append(mvn(b_hat0[k] + shift[k], cov))
+            # zeta has the same distribution under both, so only the normal densities enter
+            d = b_hat1[k] - b_hat0[k]
+            logratio += zeta[k] * (.5 * shift[k] @ Lam[k] @ shift[k] - shift[k] @ Lam[k] @ d)
 
-    # This lower triangular matrix maps from the uncorrelated regressions to the
-    # original VAR system
-    A1 = np.array([[0,0,0],
-                   [b_hat1[1][-1], 0, 0],
-                   [b_hat1[2][-2], b_hat1[2][-1], 0]])
+    return zeta, b_hat1, logratio
 
-    A2 = np.array([b_hat1[0], b_hat1[1][:-1], b_hat1[2][:-2]])
+def MLEVARmap(zeta, b_hat1):
+    """
+    This function maps drawn coefficients of the uncorrelated VAR to the
+    coefficients of the original VAR system.
+
+    Inputs:
+    zeta:       A list of the drawn scaling coefficients.
+    b_hat1:     A list of numpy arrays containing the drawn coefficients.
+
+    Returns:
+    Astar:      A numpy array of the VAR coefficients, the constants in the first
+                    column followed by the lags of each variable in turn.
+    B1:         The impact matrix of the shocks in the original VAR system.
+    """
+    K = len(b_hat1)
+    # Equation k ends with the coefficients on the current values of the
+    # variables before it, which form this lower triangular matrix mapping from
+    # the uncorrelated regressions to the original VAR system
+    nA = len(b_hat1[0])
+    A1 = np.zeros((K, K))
+    for k in range(K):
+        A1[k, :k] = b_hat1[k][nA:]
+
+    A2 = np.array([b[:nA] for b in b_hat1])
 
     # Astar contains the regression coefficients once mapped to the original VAR
     Astar = np.linalg.inv(np.eye(len(A1)) - A1) @ A2
@@ -142,6 +264,54 @@ def MLEVARsim(K, T, b_hat0, Lam, dt, L, cn, s, noncinds):
     # Part of the matrix B from the system described in the paper
     B1 = np.linalg.inv(np.eye(len(A1)) - A1) @ B1star
 
+    return Astar, B1
+
+def MLEVARscreen(Astar, L, cn):
+    """
+    This function is a cheap necessary condition for the stability of the VAR,
+    evaluated before the transition matrix G is assembled. With the lag
+    polynomial Phi(z) = I - sum_l A_l z^l, det(I - G) = det(Phi(1)) and
+    det(I + G) = det(Phi(-1)). Both are positive when all eigenvalues of G lie
+    inside the unit circle, so a draw failing the screen is explosive, with a
+    real eigenvalue beyond 1 or -1. Draws passing the screen still require the
+    eigenvalue check.
+
+    Inputs:
+    Astar:      A numpy array of the VAR coefficients, as returned by MLEVARmap.
+    L:          A list of the number of lags used for each variable in the VAR.
+    cn:         A list of the locations of the first coefficients for each variable.
+
+    Returns:
+    passed:     False if the draw is explosive.
+    """
+    K = len(L)
+    Phi1 = np.eye(K)
+    Phim1 = np.eye(K)
+    for k in range(K):
+        coeffs = Astar[:, 1 + cn[k]:1 + cn[k + 1]]        # lags 1, ..., L[k] of variable k
+        Phi1[:, k] -= np.sum(coeffs, axis = 1)
+        Phim1[:, k] -= coeffs @ (-1.) ** np.arange(1, L[k] + 1)
+    return np.linalg.det(Phi1) > 0 and np.linalg.det(Phim1) > 0
+
+def MLEVARassemble(K, Astar, B1, L, cn, noncinds):
+    """
+    This function rearranges the coefficients of the original VAR system into
+    the corresponding objects from the VAR.
+
+    Inputs:
+    K:          An integer representing the number of variables in the VAR.
+    Astar:      A numpy array of the VAR coefficients, as returned by MLEVARmap.
+    B1:         The impact matrix of the shocks, as returned by MLEVARmap.
+    L:          A list of the number of lags used for each variable in the VAR.
+    cn:         A list of the locations of the first coefficients for each variable.
+    noncinds:   A list of the indices of the companion form states kept in the
+                    system, see MLEVARindices.
+
+    Returns:
+    G:          The transition matrix for the VAR system.
+    BB:         The one period covariance matrix given the newly drawn coefficients.
+    mx:         The coefficients for the constant on each variable.
+    """
     # Rearrange the coefficients in A
     A0 = np.array([Astar[:, 0]]).T
     A1 = Astar[:, 1:]
@@ -170,11 +340,41 @@ def MLEVARsim(K, T, b_hat0, Lam, dt, L, cn, s, noncinds):
     mx      = np.zeros(num_vars)
     mx[:K] = A[:,0]             # coefficient on constant
 
-    B1      = np.vstack((B1,np.zeros((LL * K - K - 1, K)))) # Corresponds to the matrix B from the paper, augmented for VAR
+    B1      = np.vstack((B1,np.zeros((len(noncinds) - K, K)))) # Corresponds to the matrix B from the paper, augmented for VAR
     BB      = B1 @ B1.T
 
     return G, BB, mx
 
+def MLEVARsim(K, T, b_hat0, Lam, dt, L, cn, s, noncinds):
+    """
+    This function takes the results of the uncorrelated VAR described by Zha
+    (1999). It then draws new coefficients from the posterior distribution
+    and rearranges them into the corresponding objects from the VAR.
+
+    Inputs:
+    K:          An integer representing the number of variables in the VAR.
+    T:          An integer representing the number of time periods included in the
+                    regressions after lags are taken into consideration.
+    b_hat0:     A list of numpy arrays containing the results from the uncorrelated
+                    regressions.
+    Lam:        A list of the lambda matrix used in the precision matrix calculation
+                    for the coefficient draws described in Zha.
+    dt:         A list of d_ts used to draw the scaling coefficient zeta.
+    L:          A list of the number of lags used for each variable in the VAR.
+    cn:         A list of the locations of the first coefficients for each variable.
+    s:          An integer use to seed the random number generator.
+    noncinds:   A list of the indices of the companion form states kept in the
+                    system, see MLEVARindices.
+
+    Returns:
+    G:          The transition matrix for the VAR system.
+    BB:         The one period covariance matrix given the newly drawn coefficients.
+    mx:         The coefficients for the constant on each variable.
+    """
+    zeta, b_hat1, _ = MLEVARdraw(K, T, b_hat0, Lam, dt, s)
+    Astar, B1 = MLEVARmap(zeta, b_hat1)
+    return MLEVARassemble(K, Astar, B1, L, cn, noncinds)
+
 def wprctile(x, w, p):
     """
     Calculates the percentile of an array of data where each point has a weight
@@ -199,12 +399,252 @@ def wprctile(x, w, p):
     x_value = x[prctind]
     return x_value
 
+def wprctile_columns(x, w, p):
+    """
+    Calculates wprctile for every column of a matrix of data at once, e.g. the
+    pointwise percentiles of curves drawn with weights.
+
+    Inputs:
+    x:          A numpy array of shape (n, m), one row per weighted point.
+    w:          A numpy array of the n weights of the rows. The entries of w
+                    should sum up to 1.
+    p:          A float between 0 and 100 representing the percentile.
+
+    Returns:
+    x_values:   A numpy array of the m pth percentiles, one per column.
+    """
+    sort_indices = np.argsort(x, axis = 0)
+    x = np.take_along_axis(x, sort_indices, axis = 0)
+    w = np.cumsum(w[sort_indices], axis = 0)
+    prctind = np.argmin(np.abs(w - p / 100.), axis = 0)
+    return x[prctind, np.arange(x.shape[1])]
+
+def normalize_logweights(logw):
+    """
+    Converts log-weights, possibly stored in single precision, to weights
+    summing to 1. The log-sum-exp normalization is done in double precision.
+    """
+    logw = np.asarray(logw, dtype = np.float64)
+    w = np.exp(logw - np.max(logw))
+    return w / np.sum(w)
+
+def ess(w):
+    """
+    Calculates the effective sample size (sum w)^2 / sum w^2 of importance
+    sampling weights w.
+    """
+    return np.sum(w) ** 2 / np.sum(w ** 2)
+
+def wprctile_se(x, w, p):
+    """
+    Calculates the Monte Carlo standard error of wprctile(x, w, p) for self-
+    normalized importance sampling weights. The variance of the weighted cdf at
+    the percentile, sum w^2 (1{x <= q} - p)^2, is mapped to the percentile by
+    the delta method, dividing by a weighted kernel density estimate at q.
+
+    Inputs:
+    x:          A numpy array containing the x data.
+    w:          A numpy array containing the weights corresponding to the x data.
+                    The entries of w should sum up to 1.
+    p:          A float between 0 and 100 representing the percentile.
+
+    Returns:
+    se:         The standard error of the pth weighted percentile.
+    """
+    q = wprctile(x, w, p)
+    # Silverman's rule of thumb with the weighted standard deviation and the effective sample size
+    sd = np.sqrt(np.sum(w * (x - np.sum(w * x)) ** 2))
+    h = 1.06 * sd * ess(w) ** -.2
+    f = np.sum(w * np.exp(-.5 * ((x - q) / h) ** 2)) / (h * np.sqrt(2 * np.pi))
+    var = np.sum(w ** 2 * ((x <= q) - p / 100.) ** 2)
+    return np.sqrt(var) / f
+
+@njit
+def companion(G):
+    """
+    Finds the companion structure of G: the rows below the first K are unit
+    vectors, row i copying state p[i] < i of the previous period.
+
+    Returns:
+    K:          The number of free rows of G.
+    p:          A numpy array, p[i] is the column of the 1 in row i >= K.
+    root:       A numpy array, root[i] < K is the free state of which state i is a lag.
+    """
+    n = len(G)
+    p = np.full(n, -1)
+    K = n
+    for i in range(n - 1, -1, -1):
+        j = np.argmax(np.abs(G[i]))
+        if G[i, j] != 1. or np.sum(np.abs(G[i])) != 1. or j >= i:
+            break
+        p[i] = j
+        K = i
+    root = np.arange(n)
+    for i in range(K, n):
+        root[i] = root[p[i]]
+    return K, p, root
+
+@njit
+def small_solve(M, b):
+    """
+    Solves M x = b by Gaussian elimination with partial pivoting. For the K x K
+    systems of the companion solves, where the call overhead of LAPACK
+    dominates.
+    """
+    K = len(b)
+    A = M.copy()
+    x = b.copy()
+    for j in range(K):
+        piv = j + np.argmax(np.abs(A[j:, j]))
+        if piv != j:
+            for l in range(K):
+                A[j, l], A[piv, l] = A[piv, l], A[j, l]
+            x[j], x[piv] = x[piv], x[j]
+        for i in range(j + 1, K):
+            f = A[i, j] / A[j, j]
+            A[i, j:] -= f * A[j, j:]
+            x[i] -= f * x[j]
+    for j in range(K - 1, -1, -1):
+        x[j] = (x[j] - A[j, j + 1:] @ x[j + 1:]) / A[j, j]
+    return x
+
+@njit
+def cholesky_solve_lower(S, e):
+    """
+    Computes the Cholesky factor C of S and y = C^{-1} e. Returns
+    (log det S, y'y), or (nan, nan) if S is not numerically positive definite.
+    """
+    n = len(e)
+    C = np.zeros((n, n))
+    y = np.zeros(n)
+    logdet = 0.
+    for i in range(n):
+        for j in range(i + 1):
+            d = S[i, j] - C[i, :j] @ C[j, :j]
+            if i == j:
+                if d <= 0:
+                    return np.nan, np.nan
+                C[i, i] = np.sqrt(d)
+                logdet += 2 * np.log(C[i, i])
+            else:
+                C[i, j] = d / C[j, j]
+        y[i] = (e[i] - C[i, :i] @ y[:i]) / C[i, i]
+    return logdet, y @ y
+
+@njit
+def companion_solve(G, K, p, root, v):
+    """
+    Solves (I - G) x = v for a companion matrix G. The lags satisfy
+    x_i = x_p[i] + v_i, so x = P x_top + c with c accumulated along the lags,
+    which leaves a K x K system for the free states x_top.
+    """
+    n = len(G)
+    c = np.zeros(n)
+    for i in range(K, n):
+        c[i] = v[i] + c[p[i]]
+    M = np.eye(K)
+    for j in range(n):
+        M[:, root[j]] -= G[:K, j]
+    xtop = small_solve(M, v[:K] + G[:K] @ c)
+    x = c.copy()
+    for i in range(n):
+        x[i] += xtop[root[i]]
+    return x
+
+@njit
+def companion_solve_left(G, K, p, root, u):
+    """
+    Solves a (I - G) = u for the row vector a and a companion matrix G, the
+    transpose of companion_solve: (I - G)^{-1} = P M^{-1} (E + G_top C) + C,
+    with C accumulating along the lags and E selecting the free states.
+    """
+    n = len(G)
+    M = np.eye(K)
+    w = np.zeros(K)
+    for j in range(n):
+        M[:, root[j]] -= G[:K, j]
+        w[root[j]] += u[j]
+    y = small_solve(M.T.copy(), w)
+    # z C for z = y G_top + u, accumulated from the deepest lags up
+    z = y @ G[:K] + u
+    a = np.zeros(n)
+    for i in range(n - 1, K - 1, -1):
+        a[i] += z[i]
+        if p[i] >= K:
+            a[p[i]] += a[i]
+    a[:K] = y
+    return a
+
 @njit
 def process_VAR(G, Sigma, num_vars, uc, mx, BB, X0):
     """
     This function calculates the implied model parameters given the VAR system
     generated through the process adapted from Zha (1999) and described in the
-    appendix.
+    appendix. (I - G)^{-1} is only applied to vectors, through the companion
+    structure of G, and every quadratic form is evaluated from uc outwards as
+    vector-matrix products. The density of X0 uses the Cholesky factor of Sigma.
+    Results agree with process_VAR_dense up to rounding.
+
+    Inputs:
+    G:          Matrix governing the evolution of the VAR. Written A in the appendix.
+    Sigma:      A numpy array describing the covariance of the multivariate normal
+                    distribution underlying X0.
+    num_vars:   An integer giving the total number of variables contained in X_t.
+    uc:         A numpy array which selects the consumption component of the VAR.
+    mx:         The average of X_t implied by the VAR.
+    BB:         A numpy array corresponding to BB' described by Appendix B.1.
+    X0:         A numpy array containing the date zero observation of X_t.
+
+    Returns:
+    weight:     A float providing a weight for the parameter draw.
+    ac:         The implied value of alpha_c from the paper.
+    bet:        The implied value of beta_x from the paper.
+    sigc1:      The implied first entry of sigma_c.
+    sigz1:      The implied first entry of sigma_z.
+    sigz2:      The implied second entry of sigma_z.
+    valid_run:  Denotes that this parameter setting did not have explosive eigenvalues.
+    """
+    logweight, ac, bet, sigc1, sigz1, sigz2, valid_run = process_VAR_log(G, Sigma, num_vars, uc, mx, BB, X0)
+    return np.exp(logweight), ac, bet, sigc1, sigz1, sigz2, valid_run
+
+@njit
+def process_VAR_log(G, Sigma, num_vars, uc, mx, BB, X0):
+    """
+    Same as process_VAR, but returns the log of the weight. The log-weight
+    keeps its range when stored in single precision, unlike the weight.
+    """
+    K, p, root = companion(G)
+    mu0 = companion_solve(G, K, p, root, mx)              # Written as mu_j in the paper
+    # weight = multivariate_normal.pdf(X0, mean=mu0, cov=Sigma)
+    logdet, quad = cholesky_solve_lower(Sigma, X0 - mu0)
+    if np.isnan(logdet):
+        # Sigma is not numerically positive definite
+        weight, ac, bet, sigc1, sigz1, sigz2, valid_run = process_VAR_dense(G, Sigma, num_vars, uc, mx, BB, X0)
+        return np.log(weight), ac, bet, sigc1, sigz1, sigz2, valid_run
+    logweight = -num_vars / 2 * np.log(2 * np.pi) - .5 * logdet - .5 * quad
+
+    a = companion_solve_left(G, K, p, root, uc)           # uc (I - G)^{-1}
+    ac = (a @ mx) * 100
+    r = a - uc                                            # uc G (I - G)^{-1}
+    Sr = Sigma @ r
+    bet = 1 - ((r @ G) @ Sr) / (r @ Sr)
+    BBr = BB @ r
+    BBuc = BB @ uc
+    matrixx = np.array([[uc @ BBuc, uc @ BBr],
+                        [r @ BBuc, r @ BBr]]) / 0.0001
+    sigc1 = np.sqrt(matrixx[0,0])
+    sigz1 = matrixx[1,0] * bet / sigc1
+    sigz2 = np.sqrt(matrixx[1,1] * bet**2 - sigz1**2)
+    valid_run = True
+    return logweight, ac, bet, sigc1, sigz1, sigz2, valid_run
+
+@njit
+def process_VAR_dense(G, Sigma, num_vars, uc, mx, BB, X0):
+    """
+    This function calculates the implied model parameters given the VAR system
+    generated through the process adapted from Zha (1999) and described in the
+    appendix, with dense inverses of I - G and Sigma. It is kept as the
+    reference for process_VAR, which exploits the companion structure of G.
 
     Inputs:
     G:          Matrix governing the evolution of the VAR. Written A in the appendix.
@@ -241,3 +681,427 @@ def process_VAR(G, Sigma, num_vars, uc, mx, BB, X0):
     sigz2 = np.sqrt(matrixx[1,1] * bet**2 - sigz1**2)
     valid_run = True
     return weight, ac, bet, sigc1, sigz1, sigz2, valid_run
+
+def MLEVARpack(b_hat0, Lam, dt, L, cn, noncinds):
+    """
+    This function packs the inputs of MLEVARsim into the arrays taken by
+    MLEVARkernel. The coefficients are padded to a common length and the
+    precision matrices are replaced by the Cholesky factors of their inverses,
+    so that no matrix is inverted per draw.
+
+    Inputs:
+    b_hat0:     A list of numpy arrays containing the results from the uncorrelated
+                    regressions.
+    Lam:        A list of the lambda matrix used in the precision matrix calculation
+                    for the coefficient draws described in Zha.
+    dt:         A list of d_ts used to draw the scaling coefficient zeta.
+    L:          A list of the number of lags used for each variable in the VAR.
+    cn:         A list of the locations of the first coefficients for each variable.
+    noncinds:   A list of the indices of the companion form states kept in the
+                    system, see MLEVARindices.
+
+    Returns:
+    packed:     A tuple (bhat, nb, chol, dt, L, cn, noncinds) of numpy arrays.
+    """
+    K = len(b_hat0)
+    nb = np.array([len(b) for b in b_hat0])
+    bhat = np.zeros((K, nb.max()))
+    chol = np.zeros((K, nb.max(), nb.max()))
+    for k in range(K):
+        bhat[k, :nb[k]] = b_hat0[k]
+        chol[k, :nb[k], :nb[k]] = np.linalg.cholesky(np.linalg.inv(Lam[k]))
+    return (bhat, nb, chol, np.array(dt, dtype = float), np.array(L), np.array(cn), np.array(noncinds))
+
+@njit
+def legacy_gamma(shape, scale):
+    """
+    Draws from the gamma distribution with the algorithm of np.random.gamma
+    (Marsaglia and Tsang, for shape > 1), so that nopython code seeded like
+    numpy reproduces its draws. Numba's own np.random.gamma uses another algorithm.
+    """
+    b = shape - 1. / 3.
+    c = 1. / np.sqrt(9. * b)
+    while True:
+        V = -1.
+        while V <= 0:
+            X = np.random.standard_normal()
+            V = 1. + c * X
+        V = V * V * V
+        U = np.random.random()
+        if U < 1. - 0.0331 * (X * X) * (X * X):
+            return scale * b * V
+        if np.log(U) < 0.5 * X * X + b * (1. - V + np.log(V)):
+            return scale * b * V
+
+@njit
+def lyapunov(G, BB):
+    """
+    Solves the discrete Lyapunov equation Sigma = G Sigma G' + BB by doubling,
+    Sigma = sum_k G^k BB G'^k, which converges for stable G. Returns a matrix
+    of infinities if the sum has not converged after 64 doublings.
+    """
+    Sigma = BB.copy()
+    A = G.copy()
+    for j in range(64):
+        term = A @ Sigma @ A.T
+        Sigma = Sigma + term
+        if np.max(np.abs(term)) <= 1e-17 * np.max(np.abs(Sigma)):
+            return Sigma
+        A = A @ A
+    return np.full_like(Sigma, np.inf)
+
+def MLEVARshift(shift, Lam, nb):
+    """
+    This function packs a mean shift of the coefficient proposal, as taken by
+    MLEVARdraw, into the arrays taken by MLEVARkernel.
+
+    Inputs:
+    shift:      None, or a list of numpy arrays shifting the mean of the coefficients
+                    of each equation.
+    Lam:        A list of the lambda matrix used in the precision matrix calculation
+                    for the coefficient draws described in Zha.
+    nb:         A numpy array of the number of coefficients of each equation, as
+                    packed by MLEVARpack.
+
+    Returns:
+    packed:     A tuple (shift, lshift) of numpy arrays padded like the coefficients
+                    packed by MLEVARpack: the shift of each equation, zero for
+                    None, and its product with the lambda matrix.
+    """
+    K = len(nb)
+    pshift = np.zeros((K, nb.max()))
+    lshift = np.zeros((K, nb.max()))
+    if shift is not None:
+        for k in range(K):
+            pshift[k, :nb[k]] = shift[k]
+            lshift[k, :nb[k]] = Lam[k] @ shift[k]
+    return (pshift, lshift)
+
+@njit
+def MLEVARkernel(seeds, T, bhat, nb, chol, dt, L, cn, noncinds, uc, X0, cond_tol, shift, lshift,
+                 logweights, ac, bet, sigc1, sigz1, sigz2, valid, stage, logratio, coeffs):
+    """
+    This function is the compiled version of a chunk of Monte Carlo draws:
+    MLEVARsim, the stability and invertibility checks and process_VAR, one draw
+    per seed. The results are written into the output buffers, so that a chunk
+    runs without any Python-level work per draw. Draws follow the same random
+    numbers as MLEVARsim with the same seed, and the results agree with those
+    of gen_results up to rounding: the coefficients are scaled by zeta after
+    factoring the inverse of the badly conditioned lambda, which changes them
+    by about 1e-9, and draws near a unit root amplify this to about 1e-4
+    relative in ac and the weight.
+
+    Inputs:
+    seeds:      A numpy array of integers used to seed each draw.
+    T:          An integer representing the number of time periods included in the
+                    regressions after lags are taken into consideration.
+    bhat, nb, chol, dt, L, cn, noncinds:
+                The packed inputs returned by MLEVARpack.
+    uc:         A numpy array which selects the consumption component of the VAR.
+    X0:         A numpy array containing the date zero observation of X_t.
+    cond_tol:   The largest condition number of Sigma_j accepted.
+    shift, lshift:
+                The packed mean shift of the coefficient proposal returned by
+                    MLEVARshift, zero for draws from the posterior as in
+                    MLEVARsim. The coefficients are then drawn as in MLEVARdraw.
+
+    Outputs (numpy arrays of the same length as seeds):
+    logweights, ac, bet, sigc1, sigz1, sigz2, valid:
+                The outputs of process_VAR_log for each draw, zero (-inf for the
+                    log-weight) for discarded draws. The arrays may be single
+                    precision, all computations are in double precision.
+    stage:      0 for valid draws, otherwise the check which discarded the draw:
+                    1 for the polynomial screen, 2 for the eigenvalues and 3 for
+                    the condition number of Sigma_j.
+    logratio, coeffs:
+                The log of the ratio of the posterior density to the proposal
+                    density at each draw, as returned by MLEVARdraw, and the drawn
+                    coefficients, shape (len(seeds), K, max nb) padded like bhat.
+                    They are only written if the arrays are not empty, e.g. of
+                    length 0 for draws from the posterior.
+    """
+    K = len(nb)
+    LL = np.max(L)
+    nfull = LL * K
+    nstate = len(noncinds)
+    num_vars = np.sum(L)
+    # Location of each lag coefficient of Astar in the full companion matrix
+    acol = np.empty(num_vars, dtype = np.int64)
+    for k in range(K):
+        for l in range(L[k]):
+            acol[cn[k] + l] = l * K + k
+    Gfull = np.zeros((nfull, nfull))
+    for i in range(nfull - K):
+        Gfull[K + i, i] = 1.
+    zeta = np.empty(K)
+    b = np.zeros((K, bhat.shape[1]))
+    Astar = np.empty((K, num_vars + 1))
+    B1 = np.empty((K, K))
+    G = np.empty((nstate, nstate))
+    BB = np.zeros((nstate, nstate))
+    mx = np.zeros(nstate)
+
+    for d in range(len(seeds)):
+        logweights[d] = -np.inf; ac[d] = 0.; bet[d] = 0.; sigc1[d] = 0.; sigz1[d] = 0.; sigz2[d] = 0.
+        valid[d] = False
+        # zeta is drawn from numpy's generator and the coefficients from numba's in
+        # MLEVARsim, both seeded with the same seed, hence the second seeding
+        np.random.seed(seeds[d])
+        for k in range(K):
+            zeta[k] = legacy_gamma(T / 2 + 1, 2 / dt[k])
+        np.random.seed(seeds[d])
+        lr = 0.
+        for k in range(K):
+            z = np.random.randn(nb[k])
+            b[k, :nb[k]] = bhat[k, :nb[k]] + shift[k, :nb[k]] + chol[k, :nb[k], :nb[k]] @ z / np.sqrt(zeta[k])
+            # zeta has the same distribution under both, so only the normal densities enter
+            lr += zeta[k] * (.5 * shift[k] @ lshift[k] - lshift[k, :nb[k]] @ (b[k, :nb[k]] - bhat[k, :nb[k]]))
+        if len(logratio) > 0:
+            logratio[d] = lr
+            coeffs[d] = b
+
+        # Map to the original VAR by forward substitution on the unit lower triangular I - A1
+        for k in range(K):
+            Astar[k] = b[k, :num_vars + 1]
+            B1[k] = 0.
+            B1[k, k] = 1. / np.sqrt(zeta[k])
+            for j in range(k):
+                a = b[k, nb[k] - k + j]
+                Astar[k] += a * Astar[j]
+                B1[k] += a * B1[j]
+
+        # Necessary condition for stability, see MLEVARscreen
+        Phi1 = np.eye(K)
+        Phim1 = np.eye(K)
+        for k in range(K):
+            for l in range(L[k]):
+                Phi1[:, k] -= Astar[:, 1 + cn[k] + l]
+                Phim1[:, k] -= (-1.) ** (l + 1) * Astar[:, 1 + cn[k] + l]
+        if np.linalg.det(Phi1) <= 0 or np.linalg.det(Phim1) <= 0:
+            stage[d] = 1
+            continue
+
+        for j in range(num_vars):
+            Gfull[:K, acol[j]] = Astar[:, 1 + j]
+        for i in range(nstate):
+            for j in range(nstate):
+                G[i, j] = Gfull[noncinds[i], noncinds[j]]
+        if np.max(np.abs(np.linalg.eigvals(G.astype(np.complex128)))) > 1:
+            stage[d] = 2
+            continue
+
+        mx[:K] = Astar[:, 0]
+        BB[:K, :K] = B1 @ B1.T
+        Sigma = lyapunov(G, BB)
+        if not np.all(np.isfinite(Sigma)) or np.linalg.cond(Sigma) > cond_tol:
+            stage[d] = 3
+            continue
+
+        stage[d] = 0
+        logweights[d], ac[d], bet[d], sigc1[d], sigz1[d], sigz2[d], valid[d] = process_VAR_log(G, Sigma, num_vars, uc, mx, BB, X0)
+
+####################################
+#      SUMMARIES OF THE DRAWS      #
+####################################
+
+PARAMETERS = ['ac', 'b', 'sigc1', 'sigz1', 'sigz2']
+
+class DrawSet:
+    """
+    The valid draws of a Monte Carlo run held in memory, with the exact
+    percentiles, standard errors and histograms reported by tenuous_estimation.py.
+    DrawSummary provides the same methods from mergeable summaries.
+
+    Inputs:
+    logweights: A numpy array of the log-weights of the draws.
+    values:     A dict mapping each name in PARAMETERS to a numpy array of draws.
+    valid:      A boolean numpy array of the validity of the draws.
+    """
+    def __init__(self, logweights, values, valid):
+        self.draws = len(valid)
+        self.valid = int(np.sum(valid))
+        self.values = dict((name, values[name][valid]) for name in PARAMETERS)
+        self.weights = normalize_logweights(logweights[valid])
+
+    def percentile(self, name, p, weighted = False):
+        """The pth (weighted) percentile of parameter name."""
+        if weighted:
+            return wprctile(self.values[name], self.weights, p)
+        return np.percentile(self.values[name], p)
+
+    def se(self, name, p):
+        """The Monte Carlo standard error of the pth weighted percentile of parameter name."""
+        return wprctile_se(self.values[name], self.weights, p)
+
+    def ess(self):
+        """The effective sample size of the weights."""
+        return ess(self.weights)
+
+    def histogram(self, name, bins = 200):
+        """
+        Unweighted and weighted counts of parameter name on bins equally spaced
+        bins between its 1st and 99th unweighted percentiles.
+
+        Returns:
+        edges:      A numpy array of the bin edges.
+        counts:     A numpy array of the number of draws per bin.
+        wcounts:    A numpy array of the weight of the draws per bin.
+        """
+        x = self.values[name]
+        lo, hi = np.percentile(x, 1), np.percentile(x, 99)
+        # Outliers are discarded
+        inds = np.logical_and(x > lo, x < hi)
+        edges = np.linspace(lo, hi, bins)
+        counts = np.histogram(x[inds], edges)[0]
+        wcounts = np.histogram(x[inds], edges, weights = self.weights[inds])[0]
+        return edges, counts, wcounts
+
+class DrawSummary:
+    """
+    A mergeable summary of Monte Carlo draws, of constant size in the number
+    of draws. For each parameter it holds the number, weight and squared
+    weight of the valid draws on fixed fine bins, with an underflow and an
+    overflow bin. These histograms act as quantile sketches: percentiles are
+    interpolated within a bin, so their error is below the bin width. The
+    summary also holds moment sums and the sums of the weights and squared
+    weights for the effective sample size. Weights are stored relative to
+    exp(logscale), so that chunks with very different log-weights merge
+    without overflow.
+
+    Inputs:
+    ranges:     A dict mapping each name in PARAMETERS to the (lo, hi) range of
+                    the fine bins.
+    bins:       The number of fine bins per parameter.
+    """
+    def __init__(self, ranges, bins = 8192):
+        self.ranges = ranges
+        self.bins = bins
+        self.draws = 0
+        self.valid = 0
+        self.logscale = -np.inf
+        self.sumw = 0.
+        self.sumw2 = 0.
+        self.counts = dict((name, np.zeros(bins + 2)) for name in PARAMETERS)
+        self.wcounts = dict((name, np.zeros(bins + 2)) for name in PARAMETERS)
+        self.w2counts = dict((name, np.zeros(bins + 2)) for name in PARAMETERS)
+        # sum of w, w x and w x^2 for the weighted mean and standard deviation
+        self.moments = dict((name, np.zeros(3)) for name in PARAMETERS)
+
+    def binindex(self, name, x):
+        """Fine bin of each entry of x: 0 for underflow, 1 to bins, bins + 1 for overflow."""
+        lo, hi = self.ranges[name]
+        inds = np.floor((np.asarray(x, dtype = np.float64) - lo) / (hi - lo) * self.bins).astype(np.int64) + 1
+        return np.clip(inds, 0, self.bins + 1)
+
+    def rescale(self, logscale):
+        """Expresses the weights relative to exp(logscale), logscale >= self.logscale."""
+        if logscale == self.logscale:
+            return
+        factor = np.exp(self.logscale - logscale) if np.isfinite(self.logscale) else 0.
+        self.sumw *= factor
+        self.sumw2 *= factor ** 2
+        for name in PARAMETERS:
+            self.wcounts[name] *= factor
+            self.w2counts[name] *= factor ** 2
+            self.moments[name] *= factor
+        self.logscale = logscale
+
+    def add(self, logweights, values, valid):
+        """
+        Adds a chunk of draws, as returned by gen_chunk in tenuous_estimation.py.
+
+        Inputs:
+        logweights: A numpy array of the log-weights of the draws.
+        values:     A dict mapping each name in PARAMETERS to a numpy array of draws.
+        valid:      A boolean numpy array of the validity of the draws.
+        """
+        self.draws += len(valid)
+        self.valid += int(np.sum(valid))
+        if not np.any(valid):
+            return
+        # The normalization is done in double precision whatever the storage precision
+        logw = np.asarray(logweights[valid], dtype = np.float64)
+        self.rescale(max(self.logscale, np.max(logw)))
+        w = np.exp(logw - self.logscale)
+        self.sumw += np.sum(w)
+        self.sumw2 += np.sum(w ** 2)
+        for name in PARAMETERS:
+            x = np.asarray(values[name][valid], dtype = np.float64)
+            inds = self.binindex(name, x)
+            self.counts[name] += np.bincount(inds, minlength = self.bins + 2)
+            self.wcounts[name] += np.bincount(inds, weights = w, minlength = self.bins + 2)
+            self.w2counts[name] += np.bincount(inds, weights = w ** 2, minlength = self.bins + 2)
+            self.moments[name] += [np.sum(w), np.sum(w * x), np.sum(w * x ** 2)]
+
+    def merge(self, other):
+        """Adds the draws summarized by other, a DrawSummary with the same bins."""
+        logscale = max(self.logscale, other.logscale)
+        self.rescale(logscale)
+        other.rescale(logscale)
+        self.draws += other.draws
+        self.valid += other.valid
+        self.sumw += other.sumw
+        self.sumw2 += other.sumw2
+        for name in PARAMETERS:
+            self.counts[name] += other.counts[name]
+            self.wcounts[name] += other.wcounts[name]
+            self.w2counts[name] += other.w2counts[name]
+            self.moments[name] += other.moments[name]
+        return self
+
+    def edges(self, name):
+        """The edges of the fine bins of parameter name."""
+        lo, hi = self.ranges[name]
+        return np.linspace(lo, hi, self.bins + 1)
+
+    def cdfinverse(self, name, counts, q):
+        """The value at which the cumulated counts reach the fraction q, interpolated within a bin."""
+        cum = np.cumsum(counts) / np.sum(counts)
+        i = min(np.searchsorted(cum, q), self.bins + 1)
+        edges = self.edges(name)
+        if i == 0:
+            return edges[0]
+        if i == self.bins + 1:
+            return edges[-1]
+        below = cum[i - 1]
+        frac = (q - below) / (cum[i] - below) if cum[i] > below else .5
+        return edges[i - 1] + frac * (edges[i] - edges[i - 1])
+
+    def percentile(self, name, p, weighted = False):
+        """The pth (weighted) percentile of parameter name."""
+        return self.cdfinverse(name, self.wcounts[name] if weighted else self.counts[name], p / 100.)
+
+    def se(self, name, p):
+        """
+        The Monte Carlo standard error of the pth weighted percentile of
+        parameter name, computed from the bins as in wprctile_se.
+        """
+        q = self.percentile(name, p, True)
+        edges = self.edges(name)
+        centers = np.concatenate(([edges[0]], (edges[:-1] + edges[1:]) / 2, [edges[-1]]))
+        below = centers <= q
+        var = (np.sum(self.w2counts[name][below]) * (1 - p / 100.) ** 2 +
+               np.sum(self.w2counts[name][~below]) * (p / 100.) ** 2) / self.sumw ** 2
+        sumw, sumwx, sumwx2 = self.moments[name]
+        sd = np.sqrt(max(sumwx2 / sumw - (sumwx / sumw) ** 2, 0.))
+        h = max(1.06 * sd * self.ess() ** -.2, edges[1] - edges[0])
+        f = np.sum(self.wcounts[name] * np.exp(-.5 * ((centers - q) / h) ** 2)) / (self.sumw * h * np.sqrt(2 * np.pi))
+        return np.sqrt(var) / f
+
+    def ess(self):
+        """The effective sample size of the weights."""
+        return self.sumw ** 2 / self.sumw2
+
+    def histogram(self, name, bins = 200):
+        """
+        Unweighted and weighted counts of parameter name on bins equally spaced
+        bins between its 1st and 99th unweighted percentiles, obtained by
+        regrouping the fine bins. See DrawSet.histogram.
+        """
+        lo, hi = self.percentile(name, 1), self.percentile(name, 99)
+        edges = np.linspace(lo, hi, bins)
+        fine = self.edges(name)
+        centers = (fine[:-1] + fine[1:]) / 2
+        counts = np.histogram(centers, edges, weights = self.counts[name][1:-1])[0]
+        wcounts = np.histogram(centers, edges, weights = self.wcounts[name][1:-1])[0]
+        return edges, counts, wcounts
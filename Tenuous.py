@@ -1,24 +1,55 @@
 import numpy as np
-import scipy.stats
-from numpy.linalg import norm, det, inv
-import sympy
+from numpy.linalg import norm, det
 import sys
+import types
 import os
-from IPython.core.display import display, HTML
-import plotly.io as pio
-import matplotlib.pyplot as plt
-import plotly.graph_objs as go
-from plotly.subplots import make_subplots
+import importlib
 import pickle
 from scipy.integrate import solve_bvp
-from scipy.optimize import fsolve, minimize
-from scipy.interpolate import CubicSpline, interp1d
-from numpy.linalg import solve, eig
-from scipy.io import loadmat
+from scipy.optimize import fsolve, minimize, OptimizeResult
+from scipy.interpolate import CubicSpline
+from scipy.special import ndtri
+from numpy.linalg import solve, eig, LinAlgError
 import scipy.sparse
-from scipy.sparse.linalg import spsolve
+from scipy.sparse.linalg import splu
 import copy
 import datetime
+import time
+import functools
+from contextlib import contextmanager
+
+class LazyImport():
+    # Stands for a module, or an attribute of a module, which is only imported when first used. The plotting
+    # dependencies (plotly, IPython) are loaded this way, so that importing the solver is fast
+    def __init__(self, module, attribute = None):
+        self.__module = module
+        self.__attribute = attribute
+        self.__target = None
+
+    def __resolve(self):
+        if self.__target is None:
+            target = importlib.import_module(self.__module)
+            self.__target = target if self.__attribute is None else getattr(target, self.__attribute)
+        return self.__target
+
+    def __getattr__(self, name):
+        return getattr(self.__resolve(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self.__resolve()(*args, **kwargs)
+
+go = LazyImport('plotly.graph_objs')
+make_subplots = LazyImport('plotly.subplots', 'make_subplots')
+display = LazyImport('IPython.display', 'display')
+
+def DerivedParams(p):
+    # Setting the parameters derived from the baseline dynamics (αz, βz, σk, σz) in the parameter dictionary p
+    p['z̄'] = p['αz'] / p['βz']
+    p['σ'] = np.vstack([p['σk'].T, p['σz'].T ])
+    p['a'] = norm(p['σz']) ** 2 /  det(p['σ'] ) ** 2
+    p['b'] = - np.squeeze(p['σk'].T.dot(p['σz'])) /  det(p['σ'] ) ** 2
+    p['d'] = norm(p['σk']) ** 2 /  det(p['σ'] ) ** 2
+    return p
 
 # Set default parameter values
 params = {}
@@ -35,77 +66,441 @@ params['δ'] = 0.002   # Subjective discount rate
 # parameters for Quadratic function of z, which is used to match q
 params['ρ1'] = 0      
 params['ρ2'] = params['q'] ** 2 / norm(params['σz']) ** 2
-params['z̄'] = params['αz'] / params['βz']
-params['σ'] = np.vstack([params['σk'].T, params['σz'].T ]) 
-params['a'] = norm(params['σz']) ** 2 /  det(params['σ'] ) ** 2
-params['b'] = - np.squeeze(params['σk'].T.dot(params['σz'])) /  det(params['σ'] ) ** 2
-params['d'] = norm(params['σk']) ** 2 /  det(params['σ'] ) ** 2
+DerivedParams(params)   # z̄, σ, a, b and d
 
 params['zl'] = -2.5
 params['zr'] = 2.5
+
+# z grid used after solving the ODE: 'uniform' (spacing Dz), 'chebyshev', 'stretched' (Nz points clustered around z̄)
+# or 'adaptive' (stretched grid refined with the solve_bvp mesh)
+params['zgrid'] = 'uniform'
+params['Dz'] = 0.01
+params['Nz'] = 201
+
+# HJB ODE solver: 'match' solves the two half lines separately and matches v(0) with fsolve,
+# 'global' solves one BVP on [zl, zr] with continuity at 0
+params['bvp'] = 'match'
+
+# θ calibration: 'nested' runs fsolve over θ with a v'(0) root-find inside every evaluation,
+# 'joint' solves for θ and v'(0) together with Broyden's method
+params['calibration'] = 'nested'
+
+# Grid searches of solvetheta (θ) and __MatchHalfLines (v'(0)): with gridstop the search stops once two neighbouring points
+# bracket the target and the values evaluated so far are monotone, otherwise every grid point is evaluated
+params['gridstop'] = True
+
+# Time integration of the FeynmanKac marches of ExpectH: 'euler' (implicit Euler steps of Dt = 0.1), 'cn' (Crank-Nicolson with
+# a Rannacher start) or 'trbdf2' with steps of fkstep quarters, or 'adaptive' (TR-BDF2 with local error tolerance fktol)
+params['feynmankac'] = 'euler'
+params['fkstep'] = 1.0
+params['fktol'] = 1e-6
 # print(params)
 ρ2_default = params['ρ2']
 
 
-def FeynmanKac(μz, σz, zgrid, fintl, T, Dt):
+def ZGrid(zl, zr, kind = 'uniform', Dz = 0.01, Nz = 201, center = 0, stretch = 3):
+    # Building the z grid on [zl, zr]; the grid always contains zl, 0, center(z̄) and zr since
+    # the two half-line ODE solutions are matched at 0 and relative entropy is normalized at z̄
+    if kind == 'uniform':
+        x_neg = np.append(np.arange(zl, 0, Dz), 0)
+        x_pos = np.append(np.arange(0, zr, Dz), zr)
+        return np.hstack([x_neg, x_pos[1:]])
+    elif kind == 'chebyshev':
+        # Chebyshev-Lobatto points on each half line, clustering at 0 and the boundaries
+        n = max(int(Nz / 2), 2)
+        u = (1 - np.cos(np.pi * np.arange(n + 1) / n)) / 2
+        grid = np.hstack([zl * (1 - u), zr * u])
+    elif kind in ('stretched', 'adaptive'):
+        # sinh stretching around center, with points on each side proportional to its length
+        nl = max(int(Nz * (center - zl) / (zr - zl)), 2)
+        nr = max(Nz - nl, 2)
+        ul = np.linspace(0, 1, nl + 1)
+        ur = np.linspace(0, 1, nr + 1)
+        grid = np.hstack([center - (center - zl) * np.sinh(stretch * ul) / np.sinh(stretch),
+                        center + (zr - center) * np.sinh(stretch * ur) / np.sinh(stretch)])
+    else:
+        raise ValueError("Unknown z grid type: {}".format(kind))
+    grid = grid[(grid >= zl) & (grid <= zr)]
+    return np.unique(np.hstack([grid, [zl, 0, center, zr]]))
+
+FK_SCHEMES = ['euler', 'cn', 'trbdf2', 'adaptive']     # time integrators of FeynmanKac
+
+def DiffOperators(zgrid):
+    # First and second derivative operators on a (possibly non-uniform) grid as sparse matrices
+    # Interior rows use centered three-point stencils; the first and last row of D1 are one-sided differences
+    # and the first and last row of D2 reuse the stencil of their neighbouring interior point
+    h = np.diff(zgrid)
+    hm = h[:-1]
+    hp = h[1:]
+    Nz = len(zgrid)
+    rows = np.arange(1, Nz - 1)
+
+    d1 = [-hp / (hm * (hm + hp)), (hp - hm) / (hm * hp), hm / (hp * (hm + hp))]
+    d2 = [2 / (hm * (hm + hp)), -2 / (hm * hp), 2 / (hp * (hm + hp))]
+
+    row = np.hstack([rows, rows, rows, [0, 0, Nz - 1, Nz - 1]])
+    col = np.hstack([rows - 1, rows, rows + 1, [0, 1, Nz - 2, Nz - 1]])
+    value = np.hstack(d1 + [[-1 / h[0], 1 / h[0], -1 / h[-1], 1 / h[-1]]])
+    D1 = scipy.sparse.csr_matrix((value, (row, col)), shape = (Nz, Nz))
+
+    row = np.hstack([rows, rows, rows, [0, 0, 0, Nz - 1, Nz - 1, Nz - 1]])
+    col = np.hstack([rows - 1, rows, rows + 1, [0, 1, 2, Nz - 3, Nz - 2, Nz - 1]])
+    value = np.hstack(d2 + [[d2[0][0], d2[1][0], d2[2][0], d2[0][-1], d2[1][-1], d2[2][-1]]])
+    D2 = scipy.sparse.csr_matrix((value, (row, col)), shape = (Nz, Nz))
+    return D1, D2
+
+def FeynmanKac(μz, σz, zgrid, fintl, T, Dt, scheme = 'euler', step = 1.0, tol = 1e-6, points = None, stats = None, tangents = None):
     # solving Feyman Kac Equation forwardly, return solution for Feyman Kac equation given the grids specification
-    Dz = zgrid[1] - zgrid[0]
+    # fintl may hold several initial conditions as columns (Nz, m), marched together; the solution is reported at the
+    # horizons 0, Dt, ..., T and has shape (Nz, T/Dt + 1) or (Nz, T/Dt + 1, m). Time integration (see FK_SCHEMES):
+    # 'euler' takes implicit Euler steps of Dt, with the boundary values of the previous step (first order);
+    # 'cn' takes Crank-Nicolson steps of length step, the first two replaced by four implicit Euler half steps (Rannacher);
+    # 'trbdf2' takes TR-BDF2 steps of length step (second order and L-stable, one factorization);
+    # 'adaptive' takes TR-BDF2 steps whose length is set by an estimate of the local error against tol.
+    # The last three march the interior points with the boundary values extrapolated from them, and the values between
+    # steps are cubic Hermite interpolants of the solution and its time derivative.
+    # Given points, the solution is only kept at these values of z (interpolated linearly, as InterpQuantile), with shape
+    # (len(points), T/Dt + 1) or (len(points), T/Dt + 1, m), so that the full solution is never held in memory
+    # Given a dict stats, the number of time steps taken is stored in stats['steps'] and that of rejected steps of
+    # 'adaptive' in stats['rejected']
+    # Given tangents, a list of (dμz, dvar, dfintl) with the derivatives of μz, |σz|^2 and fintl with respect to a parameter,
+    # the derivatives of the solution are marched with it, with the same step matrices and the source dL ϕ from the derivative
+    # dL = diag(dμz) D1 + 0.5 dvar D2 of the generator, and (sol, dsol) is returned with dsol[p] the derivative of sol for
+    # tangents[p]. These are the derivatives of the discrete solution, whose time steps are not changed by the tangents.
+    if scheme not in FK_SCHEMES:
+        raise ValueError("Unknown FeynmanKac scheme: {}".format(scheme))
     Nz = len(zgrid)
-    row = []
-    col = []
-    value = []
-    for j in range(Nz):
-        if j == 0:
-            value.append( -1)
-            row.append(j)
-            col.append(j)
-        elif j == Nz - 1:
-            value.append(-1)
-            row.append(j)
-            col.append(j)
-        else:
-            value.append( -1 + Dt * (-norm(σz) ** 2 / Dz ** 2))
-            row.append(j)
-            col.append(j)
-            value.append( Dt * (μz[j] / (2*Dz) + 0.5 * norm(σz) ** 2 / (Dz ** 2)))
-            row.append(j)
-            col.append(j+1)
-            value.append( Dt * (-μz[j] / (2*Dz) + 0.5 * norm(σz) ** 2 / (Dz ** 2)))
-            row.append(j)
-            col.append(j-1)
-    A = scipy.sparse.csr_matrix((value, (row, col)))
-    a1 = A[1,0]
-    a2 = A[-2,-1]
-    A = A[1:-1, 1:-1]
+    (D1, D2) = DiffOperators(zgrid)
+    L = scipy.sparse.diags(μz) @ D1 + 0.5 * norm(σz) ** 2 * D2
+    dL = []
+    if tangents is not None:
+        # the solution and its derivatives are the column blocks of one state, the solution first
+        shape = np.shape(fintl)
+        m = int(np.prod(shape[1:]))
+        dL = [scipy.sparse.csr_matrix(scipy.sparse.diags(dμz) @ D1 + 0.5 * dvar * D2) for (dμz, dvar, _) in tangents]
+        fintl = np.hstack([np.reshape(fintl, (Nz, m))] + [np.reshape(dfintl, (Nz, m)) for (_, _, dfintl) in tangents])
+
+    def result(sol):
+        # the solution, and its derivatives given tangents, in the shapes of fintl
+        if not dL:
+            return sol
+        dsol = np.moveaxis(sol[:, :, m:].reshape(sol.shape[:2] + (len(dL), m)), 2, 0)
+        return (sol[:, :, :m].reshape(sol.shape[:2] + shape[1:]), dsol.reshape((len(dL),) + sol.shape[:2] + shape[1:]))
+    # boundary values are extrapolated linearly from the two nearest interior points
+    wl = (zgrid[1] - zgrid[0]) / (zgrid[2] - zgrid[1])
+    wr = (zgrid[-1] - zgrid[-2]) / (zgrid[-2] - zgrid[-3])
+
+    W = None if points is None else InterpMatrix(zgrid, points)
+    sol = np.zeros((Nz if W is None else W.shape[0], int(T/Dt) + 1) + np.shape(fintl)[1:])
+    sol[:,0] = fintl if W is None else W @ fintl
+    if scheme != 'euler':
+        # interior generator M, with the extrapolated boundary values folded into the first and last column
+        E = scipy.sparse.lil_matrix((Nz, Nz - 2))
+        E[0, :2] = [1 + wl, -wl]
+        E[-1, -2:] = [-wr, 1 + wr]
+        E[1:-1] = scipy.sparse.identity(Nz - 2)
+        E = E.tocsr()
+        M = scipy.sparse.csc_matrix(L[1:-1] @ E)
+        try:
+            (steps, rejected) = FeynmanKacMarch(M, np.asarray(fintl, dtype = float)[1:-1], sol if W is not None else sol[1:-1], Dt, scheme, step,
+                            tol, None if W is None else scipy.sparse.csr_matrix(W @ E), [scipy.sparse.csc_matrix(d[1:-1] @ E) for d in dL])
+        except RuntimeError:
+            sol[:,1:] = np.nan
+            (steps, rejected) = (0, 0)
+        if stats is not None:
+            stats.update(steps = steps, rejected = rejected)
+        if W is None:
+            sol[0,1:] = (1 + wl) * sol[1,1:] - wl * sol[2,1:]
+            sol[-1,1:] = (1 + wr) * sol[-2,1:] - wr * sol[-3,1:]
+        return result(sol)
+
+    # Every step solves the same linear system, which is factorized once
+    A = Dt * L - scipy.sparse.identity(Nz)
+    A = scipy.sparse.csr_matrix(A[1:-1])
+    a1 = A[0,0]
+    a2 = A[-1,-1]
+    A = A[:, 1:-1]
 
     ϕold = fintl
-    sol = np.zeros([Nz, int(T/Dt) + 1])
-    sol[:,0] = fintl
-
+    try:
+        lu = splu(scipy.sparse.csc_matrix(A))
+    except RuntimeError:
+        # singular system, e.g. with the nan drift of a failed calibration: no solution, as with spsolve
+        sol[:,1:] = np.nan
+        if stats is not None:
+            stats.update(steps = 0, rejected = 0)
+        return result(sol)
+
+    dL = [scipy.sparse.csr_matrix(d[1:-1]) for d in dL]
     for t in range(int(T/Dt)):
         b = - ϕold[1:-1]
         b[0] = b[0] - a1 * ϕold[0]
         b[-1] = b[-1] -a2 * ϕold[-1]
-        ϕnew = spsolve(A, b)
-        ϕnew = np.hstack([2 * ϕnew[0] - ϕnew[1], ϕnew, 2 * ϕnew[-1] - ϕnew[-2]])
+        if dL:
+            # the derivatives solve the same system with the source -Dt dL ϕ, where ϕ has the new interior values and the
+            # previous boundary values of the solution, as in the rows of A
+            ϕnew = lu.solve(b[:, :m])
+            ϕmix = np.vstack([ϕold[:1, :m], ϕnew, ϕold[-1:, :m]])
+            ϕnew = np.hstack([ϕnew, lu.solve(b[:, m:] - Dt * np.hstack([d @ ϕmix for d in dL]))])
+        else:
+            ϕnew = lu.solve(b)
+        ϕnew = np.concatenate([[(1 + wl) * ϕnew[0] - wl * ϕnew[1]], ϕnew, [(1 + wr) * ϕnew[-1] - wr * ϕnew[-2]]])
         ϕold = ϕnew
-        sol[:,t+1] = ϕnew
-    return sol
+        sol[:,t+1] = ϕnew if W is None else W @ ϕnew
+    if stats is not None:
+        stats.update(steps = int(T/Dt), rejected = 0)
+    return result(sol)
+
+def FeynmanKacMarch(M, ϕ, out, Dt, scheme, step, tol, project = None, dM = []):
+    # marching dϕ/dt = M ϕ from ϕ at t = 0 with the scheme of FeynmanKac, filling out[:, n] with ϕ at t = n Dt, or with
+    # project @ ϕ if a projection matrix is given (out[:, 0] is given); returns the numbers of steps taken and of rejected
+    # steps, and raises RuntimeError if a system is singular or the solution is not finite
+    # Given the derivatives dM of M with respect to parameters, the columns of ϕ are the solution followed by a block of
+    # derivatives for each parameter, marched with the block lower triangular generator [[M, 0], [dM, M]]: the derivatives
+    # are solved with the factorizations of the solution and the source dM ϕ
+    n = out.shape[1] - 1
+    m = ϕ.shape[1] // (1 + len(dM)) if dM else None
+    I = scipy.sparse.identity(M.shape[0], format = 'csc')
+    factors = {}
+    def solver(c):
+        # factorization of I - c M, kept for each coefficient c (i.e. each step length)
+        if c not in factors:
+            factors[c] = splu(scipy.sparse.csc_matrix(I - c * M))
+        return factors[c]
+
+    def apply(x):
+        # the generator applied to x
+        y = M @ x
+        for (p, d) in enumerate(dM):
+            y[:, m * (p + 1):m * (p + 2)] += d @ x[:, :m]
+        return y
+
+    def solve(c, r):
+        # solving (I - c generator) x = r, the derivatives after the solution
+        if not dM:
+            return solver(c).solve(r)
+        x = solver(c).solve(r[:, :m])
+        return np.hstack([x, solver(c).solve(r[:, m:] + c * np.hstack([d @ x for d in dM]))])
+
+    γ = 2 - np.sqrt(2)
+    C = (-3 * γ ** 2 + 4 * γ - 2) / (6 * (2 - γ))    # local error constant of TR-BDF2 times 2
+    def trbdf2(ϕ, h, estimate = False):
+        # one TR-BDF2 step: trapezoidal rule to t + γh, then BDF2 to t + h; both solve with I - (γh/2) M
+        c = γ * h / 2
+        ϕγ = solve(c, ϕ + c * apply(ϕ))
+        ϕh = solve(c, (ϕγ - (1 - γ) ** 2 * ϕ) / (γ * (2 - γ)))
+        if not estimate:
+            return ϕh
+        # error estimate from the divided differences of M ϕ at t, t + γh and t + h, filtered by the stage system
+        error = solve(c, C * h * apply(ϕ / γ - ϕγ / (γ * (1 - γ)) + ϕh / (1 - γ)))
+        return (ϕh, error)
+
+    def dense(t0, h, ϕ0, ϕ1):
+        # fills the horizons in (t0, t0 + h] by cubic Hermite interpolation
+        first = int(np.floor(t0 / Dt + 1e-9)) + 1
+        last = min(int(np.floor((t0 + h) / Dt + 1e-9)), n)
+        if last < first:
+            return
+        s = (np.arange(first, last + 1) * Dt - t0) / h
+        s = np.clip(s, 0, 1)
+        coef = np.stack([2 * s ** 3 - 3 * s ** 2 + 1, h * (s ** 3 - 2 * s ** 2 + s), -2 * s ** 3 + 3 * s ** 2, h * (s ** 3 - s ** 2)])
+        stack = [ϕ0, apply(ϕ0), ϕ1, apply(ϕ1)]
+        if project is not None:
+            stack = [project @ a for a in stack]
+        values = np.tensordot(coef, np.stack(stack), axes = ([0], [0]))
+        out[:, first:last + 1] = np.moveaxis(values, 0, 1)
+
+    T = n * Dt
+    t = 0.0
+    if scheme in ('cn', 'trbdf2'):
+        # steps are whole multiples of Dt, doubling from Dt up to step so that the fast initial transient is resolved
+        k = max(int(round(step / Dt)), 1)
+        j = 0
+        while t < T - 1e-9 * Dt:
+            hj = min(min(2 ** j, k) * Dt, T - t)
+            if scheme == 'trbdf2':
+                ϕnew = trbdf2(ϕ, hj)
+            elif j < 2:
+                ϕnew = solve(hj / 2, solve(hj / 2, ϕ))
+            else:
+                ϕnew = solve(hj / 2, ϕ + hj / 2 * apply(ϕ))
+            if not np.all(np.isfinite(ϕnew)):
+                raise RuntimeError("FeynmanKac: the solution is not finite")
+            dense(t, hj, ϕ, ϕnew)
+            (t, ϕ, j) = (t + hj, ϕnew, j + 1)
+        return (j, 0)
+    else:
+        # step lengths are Dt times powers of sqrt(2), so that the factorizations are reused
+        level = 0
+        (steps, rejected) = (0, 0)
+        while t < T - 1e-9 * Dt:
+            h = min(Dt * np.sqrt(2) ** level, T - t)
+            (ϕnew, error) = trbdf2(ϕ, h, estimate = True)
+            # the steps are chosen for the solution, not its derivatives
+            (e, ϕe) = (error[:, :m], ϕnew[:, :m]) if dM else (error, ϕnew)
+            ratio = np.max(np.abs(e) / (tol * (1 + np.abs(ϕe))))
+            if not np.isfinite(ratio):
+                raise RuntimeError("FeynmanKac: the solution is not finite")
+            if ratio <= 1 or level <= -12:
+                dense(t, h, ϕ, ϕnew)
+                (t, ϕ, steps) = (t + h, ϕnew, steps + 1)
+            else:
+                rejected += 1
+            # new length 0.9 * h * ratio^(-1/3), at most 4 times longer
+            level = level + int(np.clip(np.floor(2 * np.log2(0.9 / max(ratio, 1e-12) ** (1 / 3))), -12, 4))
+        return (steps, rejected)
+
+def InterpMatrix(zgrid, points):
+    # sparse (len(points), Nz) matrix interpolating a function on zgrid linearly at points, as InterpQuantile does
+    points = np.asarray(points, dtype = float)
+    if np.any(points < zgrid[0]) or np.any(points > zgrid[-1]):
+        raise ValueError("A value in x_new is outside the interpolation range.")
+    j = np.minimum(np.searchsorted(zgrid, points, side = 'right') - 1, len(zgrid) - 2)
+    c = (points - zgrid[j]) / (zgrid[j + 1] - zgrid[j])
+    rows = np.arange(len(points))
+    return scipy.sparse.csr_matrix((np.hstack([1 - c, c]), (np.hstack([rows, rows]), np.hstack([j, j + 1]))),
+                                   shape = (len(points), len(zgrid)))
 
 def InterpQuantile(zgrid, mgrid, z0):
-    # interpolating mgrid through zgrid at cdf(Z = z0)
-    dim = mgrid.shape
-    res = []
-    for t in range(dim[1]):
-        f = interp1d(zgrid, mgrid[:,t])
-        res.append(f(z0))
-    return np.array(res)
+    # interpolating mgrid through zgrid at cdf(Z = z0), linearly as interp1d (np.interp) does, for all columns (time steps) at once
+    if z0 < zgrid[0] or z0 > zgrid[-1]:
+        raise ValueError("A value in x_new is outside the interpolation range.")
+    j = np.searchsorted(zgrid, z0, side = 'right') - 1
+    if zgrid[j] == z0:
+        return mgrid[j].copy()
+    slope = (mgrid[j + 1] - mgrid[j]) / (zgrid[j + 1] - zgrid[j])
+    return slope * (z0 - zgrid[j]) + mgrid[j]
+
+def EntropyContours(σ, σz, βk, βz, q_list, npoints = 400, κrange = [0, 0.5], βrange = [-3, 3]):
+    # Computing (βz, βk) contours holding relative entropy fixed at each q in q_list in one vectorized pass
+    # The constraint 0.5 * |η|^2 + c * (σz'η - βz) = 0 with c = q^2 / |σz^2| is a circle in (η1, η2):
+    # |η + c * σz|^2 = c^2 * |σz|^2 + 2 * c * βz, and [βk' - βk, βz - βz'] = σ η maps it to an ellipse in (βz', βk')
+    # Returns arrays κ, β of shape (len(q_list), npoints + 1); each row is a closed curve, points outside the window are nan
+    q = np.asarray(q_list, dtype = float)[:, np.newaxis]
+    σz = np.squeeze(σz)
+    c = q ** 2 / norm(σz ** 2)
+    R = np.sqrt(c ** 2 * norm(σz) ** 2 + 2 * c * βz)
+    t = np.linspace(0, 2 * np.pi, npoints + 1)
+    η1 = -c * σz[0] + R * np.cos(t)
+    η2 = -c * σz[1] + R * np.sin(t)
+    κ = βz - (σ[1,0] * η1 + σ[1,1] * η2)
+    β = βk + (σ[0,0] * η1 + σ[0,1] * η2)
+    outside = (κ < κrange[0]) | (κ > κrange[1]) | (β < βrange[0]) | (β > βrange[1])
+    κ[outside] = np.nan
+    β[outside] = np.nan
+    return κ, β
+
+class SolveProfile():
+
+    def __init__(self):
+        # Instrumentation for the StructuredModel solve pipeline: wall time, call counts and problem sizes per stage
+        # Stage times are inclusive, e.g. solvetheta contains the solve_bvp and RelativeEntropyUS time spent in it
+        self.stages = {}
+
+    def record(self, stage, elapsed, calls = 1, **sizes):
+        # adding one observation of a stage; sizes (e.g. mesh nodes, fevals) are accumulated as total and maximum
+        entry = self.stages.setdefault(stage, {'time': 0.0, 'calls': 0})
+        entry['time'] += elapsed
+        entry['calls'] += calls
+        for key, value in sizes.items():
+            entry[key] = entry.get(key, 0) + value
+            entry[key + '_max'] = max(entry.get(key + '_max', value), value)
+
+    @contextmanager
+    def stage(self, stage, **sizes):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, **sizes)
+
+    def report(self):
+        # structured per-stage report: {stage: {'time', 'calls', size: total, size_max: maximum}}
+        return copy.deepcopy(self.stages)
+
+    @staticmethod
+    def merge(reports):
+        # aggregating a list of reports, e.g. over the models of a TenuousModel grid
+        merged = SolveProfile()
+        for report in reports:
+            for (stage, entry) in report.items():
+                total = merged.stages.setdefault(stage, {'time': 0.0, 'calls': 0})
+                for (key, value) in entry.items():
+                    if key.endswith('_max'):
+                        total[key] = max(total.get(key, value), value)
+                    else:
+                        total[key] = total.get(key, 0) + value
+        return merged.stages
+
+    @staticmethod
+    def table(report):
+        # formatting a report as a table sorted by time
+        lines = ['{:<20}{:>8}{:>12}{:>12}  {}'.format('stage', 'calls', 'time (s)', 'per call', 'sizes')]
+        for (stage, entry) in sorted(report.items(), key = lambda item: -item[1]['time']):
+            sizes = ', '.join('{} = {}'.format(key, value) for (key, value) in entry.items() if key not in ('time', 'calls'))
+            lines.append('{:<20}{:>8}{:>12.3f}{:>12.4f}  {}'.format(stage, entry['calls'], entry['time'], entry['time'] / max(entry['calls'], 1), sizes))
+        return '\n'.join(lines)
+
+def GridBracket(values):
+    # Index of the point with the smallest absolute value among two neighbouring evaluated points with opposite signs,
+    # or None. This is the smallest absolute value over the whole grid if the grid values are monotone, so None is also
+    # returned unless the values evaluated so far (not nan) are finite and monotone
+    evaluated = values[~np.isnan(values)]
+    if not np.all(np.isfinite(evaluated)):
+        return None
+    steps = np.diff(evaluated)
+    if not (np.all(steps >= 0) or np.all(steps <= 0)):
+        return None
+    for i in range(len(values) - 1):
+        (a, b) = (values[i], values[i + 1])
+        if np.isfinite(a) and np.isfinite(b) and a * b <= 0:
+            return i if abs(a) <= abs(b) else i + 1
+    return None
+
+def profiled(stage):
+    # Decorator recording wall time and calls of a StructuredModel method in its profile
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.profile.stage(stage):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+def DerivedOutput(name, method):
+    # A StructuredModel output computed by the method of that name on first access and kept in model.derived, which is
+    # emptied when HL changes the solution; assigning the output (as the methods do) stores it there
+    def get(self):
+        if name not in self.derived:
+            if self.Distorted is None:
+                raise AttributeError("{} requires the solution of HL, run solvetheta and HL first".format(name))
+            getattr(self, method)()
+        return self.derived[name]
+
+    def set(self, value):
+        self.derived[name] = value
+    return property(get, set)
 
 class StructuredModel(): 
+
+    # drifts, half life and shock price elasticities, computed when first used
+    driftk = DerivedOutput('driftk', 'UpdatingDrift')
+    driftz = DerivedOutput('driftz', 'UpdatingDrift')
+    hl = DerivedOutput('hl', 'HalfLife')
+    h1 = DerivedOutput('h1', 'ExpectH')
+    h2 = DerivedOutput('h2', 'ExpectH')
+    shock1 = DerivedOutput('shock1', 'ExpectH')
+    shock2 = DerivedOutput('shock2', 'ExpectH')
+    ambiguity1 = DerivedOutput('ambiguity1', 'ExpectH')
+    ambiguity2 = DerivedOutput('ambiguity2', 'ExpectH')
+    misspec1 = DerivedOutput('misspec1', 'ExpectH')
+    misspec2 = DerivedOutput('misspec2', 'ExpectH')
     
     def __init__(self, params, q0s, qᵤₛ, ρ2 = None):
         # Constructor for StructuredModel Class; User could feed in q0s, qus, ρ2 and other parameters(through dictionary)
         self.θ = None
+        self.params = dict(params) # kept to build models with perturbed parameters, see Sensitivities
+        self.ρ2fixed = ρ2 is not None
         # this is model parameter values. Notations are the same as defining default parameter dictionary
         self.αk = params['αk']
         self.αz = params['αz']
@@ -131,9 +526,20 @@ class StructuredModel():
         # self.zrange = [-2.5, 2.5]
         self.zl = params['zl']
         self.zr = params['zr']
-        self.Dz = 0.01
+        self.Dz = params.get('Dz', 0.01)
+        self.zgrid = params.get('zgrid', 'uniform')
+        self.Nz = params.get('Nz', 201)
         
-        self.x = None # this is the z grid
+        self.x = ZGrid(self.zl, self.zr, self.zgrid, self.Dz, self.Nz, self.z̄) # this is the z grid
+        self.bvp = params.get('bvp', 'match')
+        self.calibration = params.get('calibration', 'nested')
+        self.gridstop = params.get('gridstop', True)
+        self.feynmankac = params.get('feynmankac', 'euler')
+        self.fkstep = params.get('fkstep', 1.0)
+        self.fktol = params.get('fktol', 1e-6)
+        self.solveinfo = None # iteration counts and solve time of solvetheta
+        self.profile = SolveProfile() # wall time, call counts and sizes of each solve stage
+        self.globalsol = None # last converged solution of the global BVP, used as warm start
         self.y = None
 
         self.s1 = None
@@ -143,9 +549,9 @@ class StructuredModel():
         self.dvErr = None    # Track error of "solved" model's difference in matching v'(0)
         self.qErr = None     # Track error of "solved" model's difference in q
         self.dv0 = None      # v'(0)
-        self.hl = None       # half life of Chernoff Entropy of the drift
         self.v = None        # storing the pde solutions and drift distortions
         self.Distorted = None
+        self.derived = {}    # outputs computed from the solution of HL, see DerivedOutput
 
     def __HJBODE(self, z, v, θ):
             # Setting up HJB ODE function for given θ value; v is a vector storing function value and derivatives; v is a function of z
@@ -163,19 +569,37 @@ class StructuredModel():
             
         else:
             min_val = self.__mined(z, v1)
-            temp = np.zeros(len(v1))
-            for i in range(len(v1)):
-        #         print(np.array([[0.01],[v1[i]]]))
-        #         print(np.array([0.01, v1[i]]))
-                temp[i] = np.array([0.01, v1[i]]).dot(self.σ).dot(self.σ.T).dot(np.array([[0.01],[v1[i]]]))
+            temp = self.__QuadraticForm(v1)
 
             return np.vstack((v1,
                             2 / norm(self.σz) ** 2 * (self.δ * v0 - min_val + 1 / (2 * θ) *  temp )))
 
+    def __QuadraticForm(self, v1):
+        # [0.01, v1] σ σ' [0.01, v1]' for every element of the array v1, as in the scalar case of __HJBODE
+        w = np.vstack([0.01 * np.ones(len(v1)), v1])
+        return np.sum(w * self.σ.dot(self.σ.T.dot(w)), axis = 0)
+
     def __mined(self, z, dv):
         # this function aims to solve the analytical minimum (maximum in the paper, here we change its sign and solve minimum) of the HJB ODE related to i as the objective is seperable in i and s
+        (s21, s22, mined1, mined2) = self.__MinedCandidates(z, dv)
+        
+        if isinstance(mined1, (int, float, np.float)):
+            res = min(mined1, mined2)
+            return (res, s21 * (mined1 <= mined2) + s22 * (mined1 > mined2))
+        else:
+            res = np.min(np.vstack([mined1,mined2]), axis = 0)
+            return res
+
+    def __MinedGrid(self, z, dv):
+        # __mined for arrays z and dv, returning the minimum and the minimizing s2 at every point like the scalar case
+        (s21, s22, mined1, mined2) = self.__MinedCandidates(z, dv)
+        res = np.where(mined2 < mined1, mined2, mined1)
+        return (res, s21 * (mined1 <= mined2) + s22 * (mined1 > mined2))
+
+    def __MinedCandidates(self, z, dv):
+        # the two roots s2 of the first order conditions and the values of the objective at them
         A = 0.5 * self.a
-        C0 = (self.ρ1 + self.ρ2 * (z - self.z̄)) * (self.αz - self.βz * (z - self.z̄)) + norm(self.σz) ** 2 / 2 * self.ρ2 - self.q0s ** 2 / 2
+        C0 = (self.ρ1 + self.ρ2 * (z - self.z̄)) * (-self.βz * (z - self.z̄)) + norm(self.σz) ** 2 / 2 * self.ρ2 - self.q0s ** 2 / 2
         C1 = (self.ρ1 + self.ρ2 * (z - self.z̄))
         C2 = 0.5 * self.d
         D = self.b ** 2 / (2 * A) - 2 * C2
@@ -188,34 +612,36 @@ class StructuredModel():
         s21 = ( -BB + np.sqrt(BB ** 2 - 4 * AA * CC)) / (2 * AA)
         s22 = ( -BB - np.sqrt(BB ** 2 - 4 * AA * CC)) / (2 * AA)
         
-        mined1 = np.squeeze(0.01 * (self.αk + self.βk* (z-self.z̄) + self.__S1(s21, z)) + dv * (self.αz - self.βz * (z - self.z̄) + s21))
-        mined2 = np.squeeze(0.01 * (self.αk + self.βk* (z-self.z̄) + self.__S1(s22, z)) + dv * (self.αz - self.βz * (z - self.z̄) + s22))
-        
-        if isinstance(mined1, (int, float, np.float)):
-            res = min(mined1, mined2)
-            return (res, s21 * (mined1 <= mined2) + s22 * (mined1 > mined2))
-        else:
-            res = np.min(np.vstack([mined1,mined2]), axis = 0)
-            return res
+        mined1 = np.squeeze(0.01 * (self.αk + self.βk* (z-self.z̄) + self.__S1(s21, z)) + dv * (-self.βz * (z - self.z̄) + s21))
+        mined2 = np.squeeze(0.01 * (self.αk + self.βk* (z-self.z̄) + self.__S1(s22, z)) + dv * (-self.βz * (z - self.z̄) + s22))
+        return (s21, s22, mined1, mined2)
 
     def __S1(self, s2, z):
     
         A = 0.5 * self.a
         B = self.b * s2
-        C = 0.5 * self.d * s2 ** 2 + (self.ρ1 + self.ρ2 * (z - self.z̄)) * s2 + (self.ρ1 + self.ρ2 * (z - self.z̄)) * (self.αz - self.βz * (z - self.z̄)) + norm(self.σz) ** 2 / 2 * self.ρ2 - self.q0s ** 2 / 2
+        C = 0.5 * self.d * s2 ** 2 + (self.ρ1 + self.ρ2 * (z - self.z̄)) * s2 + (self.ρ1 + self.ρ2 * (z - self.z̄)) * (-self.βz * (z - self.z̄)) + norm(self.σz) ** 2 / 2 * self.ρ2 - self.q0s ** 2 / 2
         
         return (-B - np.sqrt(B ** 2 - 4 * A * C)) / (2 * A)
 
+    @profiled('ApproxBound')
     def ApproxBound(self):
         # This function aims to solve the boundary for our ODE, details please check appendix E
-        ν, s1, s2 = sympy.symbols('ν s1 s2')
-        f1 = (-self.δ - self.βz + s2) * ν + 0.01 * (self.βk+ s1)
-        f2 = ν * (self.a * s1 + self.b * s2) - 0.01 * (self.b * s1 + self.d * s2 + self.ρ2)
-        f3 = 0.5 * (self.a * s1 ** 2 + 2 * self.b * s1 * s2 + self.d * s2 ** 2) + self.ρ2 * (-self.βz + s2 )
-        # initialGuess = (np.array([0.2, 0.8]), np.array([-0.1, 0.1]), np.array([0, 0]))
-        bounds =  np.array(sympy.solvers.solve((f1, f2, f3), (ν, s1, s2))).astype(float)
-        self.dvl = max(bounds[:,0])
-        self.dvr = min(bounds[:,0])
+        # f1 = (-δ - βz + s2) ν + 0.01 (βk + s1) = 0
+        # f2 = ν (a s1 + b s2) - 0.01 (b s1 + d s2 + ρ2) = 0
+        # f3 = 0.5 (a s1^2 + 2 b s1 s2 + d s2^2) + ρ2 (-βz + s2) = 0
+        # f1 and f2 are linear in s1, which gives s2 = N(ν) / D(ν) and s1 = S1(ν) / D(ν) for quadratic N, D and cubic S1;
+        # f3 multiplied by D^2 is then a polynomial in ν, whose real roots are the bounds
+        ν = np.polynomial.Polynomial([0, 1])
+        c = self.δ + self.βz
+        D = -100 * self.a * ν ** 2 + 2 * self.b * ν - 0.01 * self.d
+        N = -100 * self.a * c * ν ** 2 + (self.βk * self.a + self.b * c) * ν - 0.01 * self.βk * self.b + 0.01 * self.ρ2
+        S1 = -self.βk * D - 100 * (N - c * D) * ν
+        F = 0.5 * (self.a * S1 ** 2 + 2 * self.b * S1 * N + self.d * N ** 2) + self.ρ2 * (N - self.βz * D) * D
+        roots = F.roots()
+        bounds = roots[np.abs(roots.imag) <= 1e-9 * np.maximum(np.abs(roots.real), 1)].real
+        self.dvl = max(bounds)
+        self.dvr = min(bounds)
     
     def __ODEsolver(self, zrange, bdl, bdr, θ):
         # This function aims to specify ODE in Python given θ and boundary values and returns corresponding ODE solutions
@@ -232,43 +658,85 @@ class StructuredModel():
             
         x = np.linspace(zrange[0], zrange[1], 10)
         y = np.ones((2,x.size)) * np.array([0, temp])[:,np.newaxis]
-        res = solve_bvp(tosolve, bc, x, y)
+        with self.profile.stage('solve_bvp'):
+            res = solve_bvp(tosolve, bc, x, y)
+        self.profile.record('solve_bvp', 0, calls = 0, nodes = res.x.size)
         return res
         
+    def __GridSearch(self, method, points, **kwargs):
+        # Evaluating method(point, **kwargs) at the grid points in order and returning the point with the smallest absolute value
+        # With self.gridstop the search stops once two neighbouring points bracket 0 and the values evaluated so far are monotone
+        # (see GridBracket)
+        values = np.full(len(points), np.nan)
+        best = None
+        for (i, point) in enumerate(points):
+            values[i] = np.squeeze(method(point, **kwargs))
+            best = GridBracket(values) if self.gridstop else None
+            if best is not None:
+                break
+        self.profile.record('gridsearch', 0, points = int(np.sum(~np.isnan(values))))
+        if best is None:
+            best = np.argmin(abs(values))
+        return points[best]
+
+    @profiled('MatchODE')
     def __MatchODE(self, θ, dv0guess = None):
-        # We solv ODE in [0, inf] and [-inf, 0] seperately. This function tries to find a θ that match v0 at 0 for the two parts of ODE. See Appendix C for details
-
+        # Solving the HJB ODE for given θ and resampling the solution on the z grid
+        # With params['bvp'] = 'global' the ODE is solved as one BVP on [zl, zr]; it falls back to matching the two half lines if that fails
+
+        sols = None
+        if self.bvp == 'global':
+            sols = self.__GlobalODE(θ, dv0guess)
+        if sols is None:
+            sols = self.__MatchHalfLines(θ, dv0guess)
+        return self.__Resample(*sols)
+
+    def __Resample(self, negsol, possol, dv0, diff):
+        # Resampling the two half-line solutions on the z grid
         res = {}
+        if self.zgrid == 'adaptive':
+            x = self.__RefineGrid([negsol, possol])
+        else:
+            x = self.x
+        x_neg = x[x <= 0]
+        negSpline = CubicSpline(negsol.x, negsol.y, axis = 1)
+        negSplined = negSpline(x_neg)
         
-        def v0Diff(dv0):
-            # Given dv0, solves the ODE with boundary condition v'(0) = dv0
-            # return the difference in v(0)+ and v(0)- 
-
+        x_pos = x[x >= 0]
+        posSpline = CubicSpline(possol.x, possol.y, axis = 1)
+        posSplined = posSpline(x_pos)
+        
+        # x, y yields the solutions; diff measures whether v'(0) matches at x = 0
+        res['x'] = np.hstack([x_neg, x_pos[1:]])
+        res['y'] = np.hstack([negSplined, posSplined[:,1:]])
+        res['possol'] = possol
+        res['negsol'] = negsol
+        res['diff'] = diff
+        res['dv0'] = dv0
+        return res
 
-            # print('trying dv(0) = {}'.format(dv0))
-            negsol = self.__ODEsolver([self.zl, 0], self.dvl, dv0, θ)
-            # print('For this case, v(0-) = {}'.format(negsol['y'][0,-1]))
-            possol = self.__ODEsolver([0, self.zr], dv0, self.dvr, θ)
-            # print('For this case, v(0+) = {}'.format(possol['y'][0, 0]))
+    def __V0Diff(self, dv0, θ):
+        # Given dv0, solves the ODE with boundary condition v'(0) = dv0
+        # return the difference in v(0)+ and v(0)-
+        negsol = self.__ODEsolver([self.zl, 0], self.dvl, dv0, θ)
+        possol = self.__ODEsolver([0, self.zr], dv0, self.dvr, θ)
+        return negsol['y'][0, -1] - possol['y'][0, 0]
 
-            diff = negsol['y'][0, -1] - possol['y'][0, 0]
-            # print('The difference is: {}'.format(diff))
-            return diff
+    def __MatchHalfLines(self, θ, dv0guess = None):
+        # We solv ODE in [0, inf] and [-inf, 0] seperately. This function tries to find a θ that match v0 at 0 for the two parts of ODE. See Appendix C for details
+        
+        v0Diff = functools.partial(self.__V0Diff, θ = θ)
 
         # running grid searches for better initial guesses for dv0
         if dv0guess is None:
             dv0_lists = np.linspace(self.dvr + 0.2 * (self.dvl - self.dvr), self.dvl - 0.2 * (self.dvl - self.dvr), 5)
-            gridsvalue = []
-            for init in dv0_lists:
-                gridsvalue.append(v0Diff(init))
-
-            minIdx = np.argmin(abs(np.array(gridsvalue)))
-            dv0guess = dv0_lists[minIdx]
-            # print('Grids: {}; Values: {}'.format(dv0_lists, gridsvalue))
+            dv0guess = self.__GridSearch(self.__V0Diff, dv0_lists, θ = θ)
 
         # solve for a value of v'(0) that match the ODE solutions for two parts (-inf, 0) and (0, inf)
         # V0Diff needs to be 0 as the solution needs to be continous
-        dv0 = np.squeeze(fsolve(v0Diff, dv0guess))
+        (dv0, infodict, _, _) = fsolve(v0Diff, dv0guess, full_output = True)
+        dv0 = np.squeeze(dv0)
+        self.profile.record('fsolve', 0, fevals = infodict['nfev'])
 
         # print('-----------------------')
         # print('dv matched at {} with Error {}'.format(dv0, v0Diff(dv0)))
@@ -286,32 +754,59 @@ class StructuredModel():
         v2 = 2 / norm(self.σz) ** 2 * (self.δ * v0 - min_val + 1 / (2 * θ) *  np.array([0.01, v1]).dot(self.σ).dot(self.σ.T).dot(np.array([[0.01],[v1]])))
         # print("For θ = {}, v(0+) = {}; v'(0+) = {}; v''(0+) = {}".format(θ, v0, v1, v2))
         
-        x_neg = np.append(np.arange(-2.5, 0, self.Dz), 0)
-        negSpline = CubicSpline(negsol.x, negsol.y, axis = 1)
-        negSplined = negSpline(x_neg)
-        
-        x_pos = np.append(np.arange(0, 2.5, self.Dz), 2.5)
-        posSpline = CubicSpline(possol.x, possol.y, axis = 1)
-        posSplined = posSpline(x_pos)
-        
-        # x, y yields the solutions; diff measures whether v'(0) matches at x = 0
-        res['x'] = np.hstack([x_neg, x_pos[1:]])
-        res['y'] = np.hstack([negSplined, posSplined[:,1:]])
-        res['possol'] = possol
-        res['negsol'] = negsol
-        res['diff'] = abs(v0Diff(dv0))
-        res['dv0'] = dv0
-        return res
+        return (negsol, possol, dv0, abs(v0Diff(dv0)))
+
+    def __GlobalODE(self, θ, dv0guess = None):
+        # Solving the HJB ODE on [zl, zr] as a single BVP instead of matching two half-line solutions with fsolve
+        # Both half lines are mapped onto s in [0, 1] (z = zl * (1 - s) and z = zr * (1 - s)) and stacked into a
+        # four dimensional state (v-, v-', v+, v+'); continuity of v and v' at z = 0 (s = 1) closes the system,
+        # so v'(0) is an output of one Newton solve. Returns None if solve_bvp does not converge
+        def tosolve(s, y):
+            return np.vstack([-self.zl * self.__HJBODE(self.zl * (1 - s), y[:2], θ),
+                            -self.zr * self.__HJBODE(self.zr * (1 - s), y[2:], θ)])
 
+        def bc(ya, yb):
+            return np.array([ya[1] - self.dvl, ya[3] - self.dvr, yb[0] - yb[2], yb[1] - yb[3]])
+
+        if self.globalsol is not None and dv0guess is None:
+            # warm start from the last global solution, e.g. the previous θ
+            s = self.globalsol.x
+            y = self.globalsol.y
+        else:
+            if dv0guess is None:
+                dv0guess = (self.dvl + self.dvr) / 2
+            s = np.linspace(0, 1, 10)
+            y = np.vstack([np.zeros(s.size), self.dvl * (1 - s) + dv0guess * s,
+                        np.zeros(s.size), self.dvr * (1 - s) + dv0guess * s])
+        with self.profile.stage('solve_bvp'):
+            sol = solve_bvp(tosolve, bc, s, y)
+        self.profile.record('solve_bvp', 0, calls = 0, nodes = sol.x.size)
+        if not sol.success:
+            return None
+        self.globalsol = sol
+
+        # Splitting the solution back into the two half lines, both with increasing z
+        negsol = OptimizeResult(x = self.zl * (1 - sol.x), y = sol.y[:2], rms_residuals = sol.rms_residuals)
+        possol = OptimizeResult(x = self.zr * (1 - sol.x[::-1]), y = sol.y[2:, ::-1], rms_residuals = sol.rms_residuals[::-1])
+        dv0 = (sol.y[1,-1] + sol.y[3,-1]) / 2
+        return (negsol, possol, dv0, abs(sol.y[0,-1] - sol.y[2,-1]))
+
+    def __RefineGrid(self, sols):
+        # Refining the base grid with the solve_bvp meshes: mesh nodes are added, and intervals whose
+        # collocation residual is above the median are bisected, so points go where the ODE solution needs them
+        x = [self.x]
+        for sol in sols:
+            x.append(sol.x)
+            large = sol.rms_residuals > np.median(sol.rms_residuals)
+            x.append(((sol.x[:-1] + sol.x[1:]) / 2)[large])
+        return np.unique(np.hstack(x))
+
+    @profiled('Distortion')
     def __Distortion(self, sol, θ):
         # Calculate Drift __Distortion (ηᵤ ,ηₛ) given ODE solutions and θ
         Nz = len(sol['x'])
-        s2 = np.zeros(Nz)
-        s1 = np.zeros(Nz)
-        
-        for j in range(Nz):
-            (_, s2[j]) = self.__mined(sol['x'][j], sol['y'][1,j])
-            s1[j] = self.__S1(s2[j], sol['x'][j])
+        (_, s2) = self.__MinedGrid(sol['x'], sol['y'][1,:])
+        s1 = self.__S1(s2, sol['x'])
             
         s = np.vstack([s1,s2])
         r = solve(self.σ, s)
@@ -322,26 +817,12 @@ class StructuredModel():
         
         return (rh, s1, s2)
 
+    @profiled('RelativeEntropyUS')
     def __RelativeEntropyUS(self, ηᵤ ,ηₛ , zgrid):
         # calculate given drifts distortion ηᵤ ,ηₛ calculate relative entropy qus
-        Nz = len(zgrid)
-        Q = np.zeros([Nz, Nz])
-        for j in range(Nz):
-            if j == 0:
-                Q[0, 0] = (self.σz.T.dot(ηᵤ[:,j]) + self.αz - self.βz * zgrid[j]) / (self.Dz) - 0.5 * norm(self.σz) ** 2 / (self.Dz ** 2)
-                Q[0, 1] = -(self.σz.T.dot(ηᵤ[:,j]) + self.αz - self.βz * zgrid[j]) / (self.Dz) + norm(self.σz) ** 2 / (self.Dz ** 2)
-                Q[0, 2] = -0.5 * norm(self.σz) ** 2 / self.Dz ** 2
-                
-            elif j == Nz - 1:
-                Q[j, j] = -(self.σz.T.dot(ηᵤ[:,j]) + self.αz - self.βz * zgrid[j]) / (self.Dz) - 0.5 * norm(self.σz) ** 2 / (self.Dz ** 2)
-                Q[j, j - 1] = (self.σz.T.dot(ηᵤ[:,j]) + self.αz - self.βz * zgrid[j]) / (self.Dz) + norm(self.σz) ** 2 / (self.Dz ** 2)
-                Q[j, j - 2] = -0.5 * norm(self.σz) ** 2 / self.Dz ** 2
-                    
-            else:
-                Q[j, j - 1] = (self.σz.T.dot(ηᵤ[:,j]) + self.αz - self.βz * zgrid[j]) / (2 * self.Dz) - 0.5 * norm(self.σz) ** 2 / (self.Dz ** 2)
-                Q[j, j] = norm(self.σz) ** 2 / self.Dz ** 2
-                Q[j, j + 1] = -(self.σz.T.dot(ηᵤ[:,j]) + self.αz - self.βz * zgrid[j]) / (2 * self.Dz) - 0.5 * norm(self.σz) ** 2 / (self.Dz ** 2)
-                
+        (D1, D2) = DiffOperators(zgrid)
+        μ = self.σz.T.dot(ηᵤ)[0] - self.βz * (zgrid - self.z̄)
+        Q = -(scipy.sparse.diags(μ) @ D1 + 0.5 * norm(self.σz) ** 2 * D2).toarray()
         tmp = ηᵤ - ηₛ
         rhs = (tmp[0,:] ** 2 + tmp[1,:] ** 2) / 2
         lhs = Q
@@ -374,29 +855,138 @@ class StructuredModel():
             # print(qᵤₛ - self.qᵤₛ)
             return qᵤₛ - self.qᵤₛ
 
-    def solvetheta(self):
+    @profiled('solvetheta')
+    def solvetheta(self, θguess = None, dv0guess = None):
         # this function solves θ to match target qus given model's q0s by running a grid search given our priori knowledge about θ
+        # With params['calibration'] = 'joint', θ and v'(0) are solved together (see __JointCalibration); θguess and dv0guess
+        # are used as warm start, e.g. from a neighbouring model, and skip the grid search
+        # Iteration counts and solve times are stored in self.solveinfo
+        start = time.time()
         if self.qᵤₛ == np.inf:
             self.θ =  np.inf
             self.status = 1
-        else:
+            self.solveinfo = {'method': None, 'iterations': 0, 'fevals': 0, 'time': time.time() - start}
+            return
+
+        if θguess is None:
             thetalist = [0.1, 0.2, 0.3, 0.4, 0.6, 0.8, 1.0, 1.2]
-            values = []
-            for theta in thetalist:
-                values.append(self.__CalibratingTheta(theta, gridsearch = True))
+            theta0guess = self.__GridSearch(self.__CalibratingTheta, thetalist, gridsearch = True)
+        else:
+            theta0guess = θguess
 
-            
-            minIdx = np.argmin(abs(np.array(values)))
-            theta0guess = thetalist[minIdx]
+        # cast initial guesses with the lowest difference with target qus
 
-            # cast initial guesses with the lowest difference with target qus
+        joint = None
+        if self.calibration == 'joint':
+            if dv0guess is None:
+                dv0guess = self.__MatchODE(theta0guess, None)['dv0']
+            joint = self.__JointCalibration(theta0guess, dv0guess)
+        if joint is not None:
+            (self.θ, self.dv0, info) = joint
+        else:
+            (θ, infodict, _, _) = fsolve(self.__CalibratingTheta, theta0guess, (False), maxfev = 20, full_output = True)
+            self.θ = np.squeeze(θ)
+            info = {'method': 'nested', 'iterations': infodict['nfev'], 'fevals': infodict['nfev']}
+            if self.calibration == 'joint':
+                info['fallback'] = True     # __JointCalibration could not start or met a singular Jacobian
+            self.profile.record('fsolve', 0, fevals = infodict['nfev'])
+        info['gridsearch'] = θguess is None
+        info['time'] = time.time() - start
+        self.solveinfo = info
+        if self.qErr < 1e-2 and self.dvErr < 1e-4:
+            self.status = 1
 
-            self.θ = np.squeeze(fsolve(self.__CalibratingTheta, theta0guess, (False), maxfev = 20))
-            if self.qErr < 1e-2 and self.dvErr < 1e-4:
-                self.status = 1
+    def __CalibrationResidual(self, θ, dv0):
+        # Residuals of the calibration at (θ, v'(0)): v(0-) - v(0+) from the two half-line solutions and qus(θ) - target qus
+        negsol = self.__ODEsolver([self.zl, 0], self.dvl, dv0, θ)
+        possol = self.__ODEsolver([0, self.zr], dv0, self.dvr, θ)
+        diff = negsol.y[0, -1] - possol.y[0, 0]
+        res = self.__Resample(negsol, possol, dv0, abs(diff))
+        (Distorted, _, _) = self.__Distortion(res, θ)
+        qᵤₛ = self.__RelativeEntropyUS(Distorted[2:,:], Distorted[:2, :], res['x'])
+        return np.array([diff, np.squeeze(qᵤₛ) - self.qᵤₛ])
+
+    def __JointCalibration(self, θ0, dv00, tol = 1e-8, maxiter = 30):
+        # Solving for (θ, v'(0)) in one system instead of the nested root-finding of solvetheta and __MatchODE
+        # Residuals are v(0-) - v(0+) from the two half-line solutions and qus(θ) - target qus
+        # Broyden's method: the finite difference Jacobian is only recomputed when a Broyden step fails to reduce the residual,
+        # or gives a singular system. A step to a non-finite residual counts as failed. Returns None if the residual at the
+        # start is not finite or the finite difference Jacobian is singular, so that solvetheta falls back to the nested path
+        count = {'fevals': 0, 'jacobians': 0}
+
+        def residual(u):
+            count['fevals'] += 1
+            return self.__CalibrationResidual(u[0], u[1])
+
+        def jacobian(u, f):
+            count['jacobians'] += 1
+            J = np.zeros([2, 2])
+            steps = [1e-6 * max(abs(u[0]), 1), 1e-6 * max(abs(u[1]), 1)]
+            for i in range(2):
+                du = np.zeros(2)
+                du[i] = steps[i]
+                J[:,i] = (residual(u + du) - f) / steps[i]
+            return J
+
+        def newton(J, f):
+            # the step -J^-1 f, or None if J is singular
+            try:
+                step = -solve(J, f)
+            except LinAlgError:
+                return None
+            return step if np.all(np.isfinite(step)) else None
+
+        def reduces(fnew, f):
+            return np.all(np.isfinite(fnew)) and norm(fnew) < norm(f)
+
+        u = np.array([θ0, dv00], dtype = float)
+        f = residual(u)
+        if not np.all(np.isfinite(f)):
+            return None
+        J = jacobian(u, f)
+        fresh = True        # J is the finite difference Jacobian at u
+        iterations = 0
+        while np.max(np.abs(f)) > tol and iterations < maxiter:
+            iterations += 1
+            step = newton(J, f)
+            if step is None:
+                if fresh:
+                    return None
+                J = jacobian(u, f)
+                fresh = True
+                continue
+            λ = 1
+            # keeping θ positive and backtracking on the residual norm
+            while u[0] + λ * step[0] <= 0:
+                λ = λ / 2
+            while True:
+                unew = u + λ * step
+                fnew = residual(unew)
+                if reduces(fnew, f) or λ < 1 / 16:
+                    break
+                λ = λ / 2
+            if not reduces(fnew, f):
+                if fresh:
+                    # no descent along the finite difference step either: the calibration has stalled
+                    break
+                # the Broyden approximation is stale; refresh it by finite differences
+                J = jacobian(u, f)
+                fresh = True
+                continue
+            du = unew - u
+            J = J + np.outer(fnew - f - J.dot(du), du) / du.dot(du)
+            fresh = False
+            (u, f) = (unew, fnew)
+
+        self.dvErr = abs(f[0])
+        self.qErr = abs(f[1])
+        info = {'method': 'joint', 'iterations': iterations, 'fevals': count['fevals'], 'jacobians': count['jacobians']}
+        return (u[0], u[1], info)
     
+    @profiled('HL')
     def HL(self, calHL):
-        # calculate half life of mistake probabilities and update the Drift Distortions
+        # update the Drift Distortions, and calculate half life of mistake probabilities if calHL (otherwise it is
+        # calculated when self.hl is first used)
         res = self.__MatchODE(self.θ, self.dv0)
         (Distorted, s1, s2) = self.__Distortion(res, self.θ)
 
@@ -404,40 +994,27 @@ class StructuredModel():
         self.Distorted = Distorted
         self.s1 = s1
         self.s2 = s2
+        self.derived = {}
         
         if calHL:
-            ρ = self.__ChernoffEntropy(Distorted[2:,:])
-            hl = np.log(2) / ρ
-        else:
-            hl = None
-        
-        self.hl = hl
+            self.HalfLife()
+
+    def HalfLife(self):
+        # calculate half life of mistake probabilities from the Chernoff Entropy of the drift distortion
+        ρ = self.__ChernoffEntropy(self.Distorted[2:,:])
+        self.hl = np.log(2) / ρ
          
+    @profiled('ChernoffEntropy')
     def __ChernoffEntropy(self, η):
         # calculate Chernoff Entropy as described in section 5.2
+        (D1, D2) = DiffOperators(self.v['x'])
         def Rhos(s):
 
-            Nz = len(self.v['x'])
-        
-            Q = np.zeros([Nz, Nz])
-            for j in range(Nz):
-                if j == 0:
-                    Q[0, 0] = -s * (1-s) / 2 * norm(η[:,j]) ** 2 - (s * self.σz.T.dot(η[:,j]) + self.αz - self.βz * self.v['x'][j]) / (self.Dz) + 0.5 * norm(self.σz) ** 2 / (self.Dz ** 2)
-                    Q[0, 1] = (s * self.σz.T.dot(η[:,j]) + self.αz - self.βz * self.v['x'][j]) / (self.Dz) - norm(self.σz) ** 2 / (self.Dz ** 2)
-                    Q[0, 2] = 0.5 * norm(self.σz) ** 2 / self.Dz ** 2
-
-                elif j == Nz - 1:
-                    Q[j, j] = (-s * (1-s) / 2 * norm(η[:,j]) ** 2) + (s * self.σz.T.dot(η[:,j]) + self.αz - self.βz * self.v['x'][j]) / (self.Dz) + 0.5 * norm(self.σz) ** 2 / (self.Dz ** 2)
-                    Q[j, j - 1] = -(s * self.σz.T.dot(η[:,j]) + self.αz - self.βz * self.v['x'][j]) / (self.Dz) - norm(self.σz) ** 2 / (self.Dz ** 2)
-                    Q[j, j - 2] = 0.5 * norm(self.σz) ** 2 / self.Dz ** 2
+            μ = s * self.σz.T.dot(η)[0] - self.βz * (self.v['x'] - self.z̄)
+            Q = (scipy.sparse.diags(-s * (1-s) / 2 * np.sum(η ** 2, axis = 0) ) + scipy.sparse.diags(μ) @ D1 + 0.5 * norm(self.σz) ** 2 * D2).toarray()
 
-                else:
-
-                    Q[j, j - 1] = -(s * self.σz.T.dot(η[:,j]) + self.αz - self.βz * self.v['x'][j]) / (2 * self.Dz) + 0.5 * norm(self.σz) ** 2 / (self.Dz ** 2)
-                    Q[j, j] = - s * (1-s) / 2 * norm(η[:,j]) ** 2 - norm(self.σz) ** 2 / self.Dz ** 2
-                    Q[j, j + 1] = (s * self.σz.T.dot(η[:,j]) + self.αz - self.βz * self.v['x'][j]) / (2 * self.Dz) + 0.5 * norm(self.σz) ** 2 / (self.Dz ** 2)
-
-            D,_ = eig(Q)
+            with self.profile.stage('eig', Nz = len(Q)):
+                D,_ = eig(Q)
             rhos = max(np.real(D))
             return rhos
         
@@ -445,20 +1022,21 @@ class StructuredModel():
 
         return -res.fun
 
+    @profiled('UpdatingDrift')
     def UpdatingDrift(self):
         # calculate new drifts accomodating drift distortion solutions
         drift = self.σ.dot(self.Distorted[2:,:])
         self.driftk = drift[0,:] + self.αk + self.βk * (self.v['x'] - self.z̄)
-        self.driftz = drift[1,:] + self.αz - self.βz * (self.v['x'] - self.z̄)
+        self.driftz = drift[1,:] - self.βz * (self.v['x'] - self.z̄)
         
-        Nz = len(self.v['x'])
-        d2v = np.zeros(Nz)
-        for j in range(Nz):
-            temp = self.__HJBODE(self.v['x'][j], self.v['y'][:,j], self.θ)
-            d2v[j] = temp[1]
+        # v'' from the HJB ODE at every grid point, with the minimum taken as in the scalar case of __HJBODE
+        (v0, v1) = (self.v['y'][0,:], self.v['y'][1,:])
+        (min_val, _) = self.__MinedGrid(self.v['x'], v1)
+        d2v = 2 / norm(self.σz) ** 2 * (self.δ * v0 - min_val + 1 / (2 * self.θ) * self.__QuadraticForm(v1))
         
         self.v['y'] = np.vstack([self.v['y'][:2,:], d2v])
         
+    @profiled('ExpectH')
     def ExpectH(self):
         # calculate shock price elasiticities at .10, .50 and .90 quantiles as described in section 7.2
         
@@ -466,21 +1044,25 @@ class StructuredModel():
         Dt = 0.1
         
         drift = self.σ.dot(self.Distorted[2:,:])
-        μz = drift[1,:] + self.αz - self.βz * self.v['x']
-        
-        h1 = self.Distorted[2,:]
-        expectH1 = FeynmanKac(μz, self.σz, self.v['x'], h1, T, Dt)
-        mean = self.αz / self.βz
+        μz = drift[1,:] - self.βz * (self.v['x'] - self.z̄)
+
+        mean = self.z̄
         std = np.sqrt(norm(self.σz) ** 2 / (2 * self.βz))
-        z10 = scipy.stats.norm.ppf(0.1, mean, std)
-        z90 = scipy.stats.norm.ppf(0.9, mean, std)
-        z50 = scipy.stats.norm.ppf(0.5, mean, std)
-        
-        q10 = InterpQuantile(self.v['x'], expectH1, z10)
-        q90 = InterpQuantile(self.v['x'], expectH1, z90)
-        q50 = InterpQuantile(self.v['x'], expectH1, z50)
+        z10 = ndtri(0.1) * std + mean
+        z90 = ndtri(0.9) * std + mean
+        z50 = ndtri(0.5) * std + mean
         
+        # the four expectations share the drift, so they are marched together: columns h1, h2, r1 and r2. Only their values at
+        # the .10, .50 and .90 quantiles of z are kept, rows of expect, rather than the full (Nz, T/Dt + 1, 4) solution
+        # the profile records the time steps taken, only known after the march
+        stats = {}
+        start = time.perf_counter()
+        expect = FeynmanKac(μz, self.σz, self.v['x'], self.Distorted[[2, 3, 0, 1]].T, T, Dt, self.feynmankac, self.fkstep,
+                            self.fktol, points = [z10, z50, z90], stats = stats)
+        self.profile.record('FeynmanKac', time.perf_counter() - start, Nz = len(self.v['x']), **stats)
+
         # storing .10, .50 and .90 quantile of first shock
+        (q10, q50, q90) = expect[:,:,0]
         self.shock1 = {'q10': -q10 + 0.01 * self.σk[0],
                     'q50': -q50 + 0.01 * self.σk[0],
                     'q90': -q90 + 0.01 * self.σk[0]}
@@ -489,17 +1071,8 @@ class StructuredModel():
                     'q50': -q50,
                     'q90': -q90}
         
-        h2 = self.Distorted[3,:]
-        expectH2 = FeynmanKac(μz, self.σz, self.v['x'], h2, T, Dt)
-        z10 = scipy.stats.norm.ppf(0.1, mean, std)
-        z90 = scipy.stats.norm.ppf(0.9, mean, std)
-        z50 = scipy.stats.norm.ppf(0.5, mean, std)
-        
-        q10 = InterpQuantile(self.v['x'], expectH2, z10)
-        q90 = InterpQuantile(self.v['x'], expectH2, z90)
-        q50 = InterpQuantile(self.v['x'], expectH2, z50)
-        
         # storing .10, .50 and .90 quantile of second shock
+        (q10, q50, q90) = expect[:,:,1]
         self.shock2 = {'q10': -q10 + 0.01 * self.σk[1],
                     'q50': -q50 + 0.01 * self.σk[1],
                     'q90': -q90 + 0.01 * self.σk[1]}
@@ -508,32 +1081,14 @@ class StructuredModel():
                     'q50': -q50,
                     'q90': -q90}
         
-        r1 = self.Distorted[0,:]
-        expectR1 = FeynmanKac(μz, self.σz, self.v['x'], r1, T, Dt)
-        z10 = scipy.stats.norm.ppf(0.1, mean, std)
-        z90 = scipy.stats.norm.ppf(0.9, mean, std)
-        z50 = scipy.stats.norm.ppf(0.5, mean, std)
-        
-        q10 = InterpQuantile(self.v['x'], expectR1, z10)
-        q90 = InterpQuantile(self.v['x'], expectR1, z90)
-        q50 = InterpQuantile(self.v['x'], expectR1, z50)
-        
         # storing .10, .50 and .90 quantile of ambiguity price of the first shock
+        (q10, q50, q90) = expect[:,:,2]
         self.ambiguity1 = {'q10': -q10,
                     'q50': -q50,
                     'q90': -q90}
         
-        r2 = self.Distorted[1,:]
-        expectR2 = FeynmanKac(μz, self.σz, self.v['x'], r2, T, Dt)
-        z10 = scipy.stats.norm.ppf(0.1, mean, std)
-        z90 = scipy.stats.norm.ppf(0.9, mean, std)
-        z50 = scipy.stats.norm.ppf(0.5, mean, std)
-        
-        q10 = InterpQuantile(self.v['x'], expectR2, z10)
-        q90 = InterpQuantile(self.v['x'], expectR2, z90)
-        q50 = InterpQuantile(self.v['x'], expectR2, z50)
-        
         # storing .10, .50 and .90 quantile of ambiguity price of the second shock
+        (q10, q50, q90) = expect[:,:,3]
         self.ambiguity2 = {'q10': -q10,
                     'q50': -q50,
                     'q90': -q90}
@@ -548,6 +1103,226 @@ class StructuredModel():
                     'q50': -self.ambiguity2['q50'] + self.h2['q50'],
                     'q90': -self.ambiguity2['q90'] + self.h2['q90']}
 
+    @profiled('Sensitivities')
+    def Sensitivities(self, parameters = ['αz', 'βz', 'σz', 'σk', 'δ'], step = 1e-5):
+        # Derivatives of θ, v'(0), driftz and the shock price elasticities with respect to baseline parameters at the solved
+        # model (after solvetheta and HL), from the linearization of the model around its solution rather than new solves.
+        # The HJB ODE v'' = f(z, v, v', θ; p) with v'(zl) = dvl, v'(zr) = dvr is linearized on the z grid of the solution
+        # (trapezoidal collocation of (w, w'), continuous at 0 where the half lines are matched) and bordered with the linearized
+        # calibration dqus = 0, so the derivatives of v and θ for all parameters come from one sparse factorization. The
+        # expectations of ExpectH are then differentiated by one FeynmanKac march with their tangents (see FeynmanKac).
+        # The pointwise derivatives of f, of the drift distortions and of the drift of z in v', θ and the parameters are
+        # central differences of these closed-form functions with relative steps step; no ODE is solved again.
+        # Vector parameters (σz, σk) are differentiated by component. The model depends on z through z - z̄ only, so a change of
+        # z̄ = αz / βz shifts the solution along z: the parameters are perturbed with z̄ held fixed, which differentiates driftz
+        # and the elasticities at the same distance from z̄, and v'(0), taken at z = 0, gets the shift -v''(0) dz̄. The
+        # derivatives in αz, which only moves z̄, are then zero but for v'(0).
+        # Returns (labels, jacobian): the parameter component of each row and a dict of outputs, each an array with one row
+        # per parameter component, e.g. jacobian['shock1.q50'][i] = d shock1['q50'] / d labels[i]
+        if self.v is None:
+            raise ValueError("Sensitivities requires a solved model: run solvetheta and HL first")
+        calibrated = np.isfinite(self.θ)     # with qus = inf, θ = inf for all parameters
+        θ = float(self.θ)
+        x = self.v['x']
+        N = len(x)
+        # the outputs are taken on the grid and the ODE on the two half lines, matched at z = 0 as in __MatchHalfLines: the
+        # minimizing s2 and with it the derivatives of f in v' change there
+        (neg, pos) = (np.flatnonzero(x <= 0), np.flatnonzero(x >= 0))
+        half = np.hstack([neg, pos])
+        n = len(half)
+        z = np.hstack([x, x[half]])
+        (v0, v1) = (self.v['y'][0, np.hstack([np.arange(N), half])], self.v['y'][1, np.hstack([np.arange(N), half])])
+
+        def pointwise(model, v1, θ):
+            # rows f, r1, r2, h1, h2 and the distorted drift μ of z at the points z, for v' = v1
+            y = np.vstack([v0, v1])
+            (D, _, _) = model.__Distortion({'x': z, 'y': y}, θ)
+            μ = model.σ.dot(D[2:,:])[1,:] - model.βz * (z - model.z̄)
+            return np.vstack([model.__HJBODE(z, y, θ)[1], D, μ])
+
+        def limits(P):
+            # the derivatives at the ends of the half lines at z = 0 as one-sided limits, extrapolated linearly from the two
+            # nearest nodes: the roots of __MinedCandidates meet at z̄ for ρ1 = 0, where their differences are not reliable
+            for (k, j) in [(N + len(neg) - 1, -1), (N + len(neg), 1)]:
+                w = (z[k] - z[k + j]) / (z[k + j] - z[k + 2 * j])
+                P[:, k] = (1 + w) * P[:, k + j] - w * P[:, k + 2 * j]
+            return P
+
+        def scalars(model):
+            # the parameters entering the outputs other than through pointwise: boundary slopes, |σz|^2, z̄ = αz / βz, σk, std of z
+            var = norm(model.σz) ** 2
+            return np.hstack([model.dvl, model.dvr, var, model.αz / model.βz, np.ravel(model.σk), np.sqrt(var / (2 * model.βz))])
+
+        P0 = pointwise(self, v1, θ)
+        ε = step * (1 + np.abs(v1))
+        Pv1 = limits((pointwise(self, v1 + ε, θ) - pointwise(self, v1 - ε, θ)) / (2 * ε))
+        Pθ = np.zeros_like(P0)
+        if calibrated:
+            Pθ = limits((pointwise(self, v1, θ * (1 + step)) - pointwise(self, v1, θ * (1 - step))) / (2 * step * θ))
+
+        labels = []
+        (Pp, Sp) = ([], [])
+        for name in parameters:
+            value = np.array(self.params[name], dtype = float)
+            for index in ([None] if value.ndim == 0 else list(np.ndindex(value.shape))):
+                x0 = value if index is None else value[index]
+                h = step * abs(x0) if x0 != 0 else step
+                models = []
+                for sign in [1, -1]:
+                    p = dict(self.params)
+                    p[name] = np.array(p[name], dtype = float)
+                    if index is None:
+                        p[name] = p[name] + sign * h
+                    else:
+                        p[name][index] += sign * h
+                    p = DerivedParams(p)
+                    p['z̄'] = self.z̄
+                    model = StructuredModel(p, self.q0s, self.qᵤₛ, self.ρ2 if self.ρ2fixed else None)
+                    model.profile = self.profile
+                    model.ApproxBound()
+                    models.append(model)
+                Pp.append(limits((pointwise(models[0], v1, θ) - pointwise(models[1], v1, θ)) / (2 * h)))
+                Sp.append((scalars(models[0]) - scalars(models[1])) / (2 * h))
+                labels.append(name if index is None else '{}[{}]'.format(name, index[0]))
+        Sp = np.array(Sp)
+        dvar = Sp[:, 2]
+
+        # linearized HJB ODE for (w, w') = d(v, v')/dp: w' = w', w'' = a0 w + a1 w' + fθ dθ + fp, trapezoidal between the
+        # nodes of each half line, with the boundary conditions and the linearized matching w(0-) = w(0+), w'(0-) = w'(0+)
+        a0 = 2 * self.δ / norm(self.σz) ** 2
+        inner = np.delete(np.arange(n - 1), len(neg) - 1)
+        Hx = np.diff(x[half]) / 2
+        Δ = scipy.sparse.diags([-np.ones(n - 1), np.ones(n - 1)], [0, 1], shape = (n - 1, n), format = 'csr')[inner]
+        A = scipy.sparse.diags([Hx, Hx], [0, 1], shape = (n - 1, n), format = 'csr')[inner]
+        bc = scipy.sparse.csr_matrix(([1, 1], ([0, 1], [0, n - 1])), shape = (2, n))
+        match = scipy.sparse.csr_matrix(([1, -1], ([0, 0], [len(neg) - 1, len(neg)])), shape = (1, n))
+        blocks = [[Δ, -A], [-a0 * A, Δ - A @ scipy.sparse.diags(Pv1[0, N:])], [None, bc], [match, None], [None, match]]
+        rhs = [np.zeros((n - 2, len(labels))), A @ np.array([P[0, N:] for P in Pp]).T, Sp[:, :2].T, np.zeros((2, len(labels)))]
+        # the grid in the nodes of the half lines, the first of the two nodes at z = 0
+        grid = np.hstack([np.arange(len(neg)), np.arange(len(neg), N) + 1])
+        if calibrated:
+            # linearized relative entropy: qus^2 / 2 = λ·rhs with λ the adjoint of the system of __RelativeEntropyUS, so
+            # dqus = λ·(drhs - dlhs sol) / qus with dlhs sol = -(dμ D1 sol + 0.5 dvar D2 sol) off the normalization at z̄
+            (D1, D2) = DiffOperators(x)
+            (r, η) = (P0[1:3, :N], P0[3:5, :N])
+            lhs = -(scipy.sparse.diags(P0[5, :N]) @ D1 + 0.5 * norm(self.σz) ** 2 * D2).toarray()
+            lhs[:, x == self.z̄] = 1
+            sol = solve(lhs, np.sum((η - r) ** 2, axis = 0) / 2)
+            λ = solve(lhs.T, (x == self.z̄).astype(float))
+            qᵤₛ = np.sqrt(2 * sol[x == self.z̄])
+            sol[x == self.z̄] = 0
+            (D1sol, D2sol) = (D1 @ sol, D2 @ sol)
+            def entropy(P):
+                # dqus at every grid point for the pointwise derivatives P
+                return λ * (np.sum((η - r) * (P[3:5, :N] - P[1:3, :N]), axis = 0) + P[5, :N] * D1sol) / qᵤₛ
+            g = np.zeros(n)
+            g[grid] = entropy(Pv1)
+            for (row, block) in zip(blocks, [None, scipy.sparse.csr_matrix(-A @ Pθ[0, N:][:, np.newaxis]), None, None, None]):
+                row.append(block)
+            blocks.append([None, scipy.sparse.csr_matrix(g), scipy.sparse.csr_matrix([[np.sum(entropy(Pθ))]])])
+            rhs.append(-np.array([[np.sum(entropy(P)) + 0.5 * dvar[i] * λ.dot(D2sol) / qᵤₛ[0] for (i, P) in enumerate(Pp)]]))
+        with self.profile.stage('splu', N = 2 * n + calibrated):
+            w = splu(scipy.sparse.bmat(blocks, format = 'csc')).solve(np.vstack(rhs))
+        w1 = w[n:2 * n][grid].T
+        dθ = w[2 * n] if calibrated else np.zeros(len(labels))
+        (P0, Pv1, Pθ, Pp) = (P0[:, :N], Pv1[:, :N], Pθ[:, :N], [P[:, :N] for P in Pp])
+
+        # total derivatives of the pointwise functions
+        dP = np.array([Pv1 * w1[i] + Pθ * dθ[i] + Pp[i] for i in range(len(labels))])
+        dv0 = np.array([np.interp(0, x, w1[i]) for i in range(len(labels))]) - np.interp(0, x, P0[0]) * Sp[:, 3]
+        jacobian = {'θ': dθ, 'dv0': dv0, 'driftz': dP[:, 5]}
+
+        # the expectations of ExpectH at the quantiles of z and at the grid points around them, for the change of the quantiles
+        T = 1000
+        Dt = 0.1
+        std = np.sqrt(norm(self.σz) ** 2 / (2 * self.βz))
+        quantiles = ndtri(np.array([0.1, 0.5, 0.9]))
+        zq = quantiles * std + self.z̄
+        i = np.clip(np.searchsorted(x, zq) - 1, 0, N - 2)
+        tangents = [(dP[p, 5], dvar[p], dP[p, 1:5][[2, 3, 0, 1]].T) for p in range(len(labels))]
+        (expect, dexpect) = FeynmanKac(P0[5], self.σz, x, P0[1:5][[2, 3, 0, 1]].T, T, Dt, self.feynmankac, self.fkstep,
+                                       self.fktol, points = np.hstack([zq, x[i], x[i + 1]]), tangents = tangents)
+        slope = (expect[6:] - expect[3:6]) / (x[i + 1] - x[i])[:, np.newaxis, np.newaxis]
+        dE = dexpect[:, :3] + slope[np.newaxis] * (quantiles * Sp[:, -1:])[:, :, np.newaxis, np.newaxis]
+        dσk = Sp[:, 4:-1]
+        for (j, q) in enumerate(['q10', 'q50', 'q90']):
+            for k in range(2):
+                jacobian['shock{}.{}'.format(k + 1, q)] = -dE[:, j, :, k] + 0.01 * dσk[:, k:k + 1]
+                jacobian['ambiguity{}.{}'.format(k + 1, q)] = -dE[:, j, :, k + 2]
+                jacobian['misspec{}.{}'.format(k + 1, q)] = dE[:, j, :, k + 2] - dE[:, j, :, k]
+        return (labels, jacobian)
+
+    def compact(self, outputs = None, horizons = None):
+        # The solved model as a SolvedModel record, with the outputs computed so far (those among outputs if given) and the
+        # elasticity paths cut at horizons time steps of ExpectH if given
+        return SolvedModel(self, outputs, horizons)
+
+ELASTICITIES = ['shock1', 'shock2', 'ambiguity1', 'ambiguity2', 'misspec1', 'misspec2', 'h1', 'h2']
+QUANTILES = ['q10', 'q50', 'q90']
+
+def ElasticityOutput(name):
+    # An elasticity of a SolvedModel as the dict of quantile paths given by StructuredModel, or None if it was not computed
+    def get(self):
+        if name not in self.names:
+            return None
+        return dict(zip(QUANTILES, self.paths[self.names.index(name)]))
+    return property(get)
+
+class SolvedModel():
+    # Compact record of a solved StructuredModel, for grids of many models: θ, v'(0), the status of the calibration, the
+    # z grid (v['x'], as in StructuredModel), the half life, the drifts and the elasticity quantile paths in one array.
+    # The ODE solution, the drift distortions and the parameters are not kept. Outputs which were not computed before
+    # StructuredModel.compact are None
+    __slots__ = ['q0s', 'qus', 'ρ2', 'θ', 'dv0', 'status', 'v', 'hl', 'driftk', 'driftz', 'names', 'paths', 'profile']
+
+    shock1 = ElasticityOutput('shock1')
+    shock2 = ElasticityOutput('shock2')
+    ambiguity1 = ElasticityOutput('ambiguity1')
+    ambiguity2 = ElasticityOutput('ambiguity2')
+    misspec1 = ElasticityOutput('misspec1')
+    misspec2 = ElasticityOutput('misspec2')
+    h1 = ElasticityOutput('h1')
+    h2 = ElasticityOutput('h2')
+
+    def __init__(self, model, outputs = None, horizons = None):
+        kept = [name for name in model.derived if outputs is None or name in outputs]
+        self.q0s = model.q0s
+        self.qus = model.qᵤₛ
+        self.ρ2 = model.ρ2
+        self.θ = model.θ
+        self.dv0 = model.dv0
+        self.status = model.status
+        self.v = {'x': model.v['x'], 'dv0': model.v['dv0']}
+        self.hl = model.derived['hl'] if 'hl' in kept else None
+        self.driftk = model.derived['driftk'] if 'driftk' in kept else None
+        self.driftz = model.derived['driftz'] if 'driftz' in kept else None
+        # the elasticities computed, with their quantile paths as rows of paths, shape (len(names), 3, horizons)
+        self.names = tuple(name for name in ELASTICITIES if name in kept)
+        paths = [[np.ravel(model.derived[name][q])[:horizons] for q in QUANTILES] for name in self.names]
+        self.paths = np.array(paths) if paths else None
+        self.profile = model.profile
+
+def Footprint(obj, seen = None):
+    # Bytes of memory held by obj and the arrays, containers and attributes it references, each object counted once
+    # (array views count the array they view)
+    seen = set() if seen is None else seen
+    if id(obj) in seen or isinstance(obj, (type, types.ModuleType, types.FunctionType, types.MethodType)):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, np.ndarray):
+        return size + (Footprint(obj.base, seen) if obj.base is not None else 0)
+    if isinstance(obj, dict):
+        return size + sum(Footprint(key, seen) + Footprint(value, seen) for (key, value) in obj.items())
+    if isinstance(obj, (list, tuple, set)):
+        return size + sum(Footprint(item, seen) for item in obj)
+    if hasattr(obj, '__dict__'):
+        size += Footprint(vars(obj), seen)
+    for name in getattr(type(obj), '__slots__', []):
+        if hasattr(obj, name):
+            size += Footprint(getattr(obj, name), seen)
+    return size
+
 class TenuousModel():
 
     def __init__(self, param = params, q0s = [0.05, 0.1], qus = [0.1, 0.2], ρs = [0.5, 1], load = True):
@@ -571,9 +1346,17 @@ class TenuousModel():
         self.params['d'] = params['d']
 
         self.params['zrange'] = [-2.5, 2.5]
-        self.params['Dz'] = 0.01
+        self.params['Dz'] = param.get('Dz', 0.01)
         self.params['zr'] = params['zr']
         self.params['zl'] = params['zl']
+        self.params['zgrid'] = param.get('zgrid', 'uniform')
+        self.params['Nz'] = param.get('Nz', 201)
+        self.params['bvp'] = param.get('bvp', 'match')
+        self.params['feynmankac'] = param.get('feynmankac', 'euler')
+        self.params['fkstep'] = param.get('fkstep', 1.0)
+        self.params['fktol'] = param.get('fktol', 1e-6)
+        self.params['calibration'] = param.get('calibration', 'nested')
+        self.params['gridstop'] = param.get('gridstop', True)
         
         if not isinstance(q0s, list):
             if isinstance(q0s, (int, float, np.float)):
@@ -602,26 +1385,54 @@ class TenuousModel():
         self.ρ_list = sorted(ρs)
         self.models = {}
 
-    def solve(self):
+    def solve(self, outputs = ['driftz', 'hl', 'shock1', 'shock2', 'ambiguity1', 'ambiguity2', 'misspec1', 'misspec2'],
+              compact = False, horizons = None):
+        # Solving every model of the grid and computing the requested outputs (see StructuredModel.DerivedOutput); e.g. with
+        # outputs = ['driftz'] the half life and the shock price elasticities are skipped, and only computed if used later.
+        # With compact = True only these outputs are kept, in SolvedModel records with the elasticities cut at horizons
+        # time steps if given, so that large grids fit in memory (see footprint)
+        for name in outputs:
+            if not isinstance(getattr(StructuredModel, name, None), property):
+                raise ValueError("Unknown model output: {}".format(name))
         for q0s in self.q0s_list:
+            warm = {}   # (θ, v'(0)) of the previous qus for each ρ, used as warm start by the joint calibration
             for qus in self.qus_list:
                 ρ_restricted = q0s ** 2 / norm(self.params['σz']) ** 2
                 for ρ in self.ρ_list:
                     print("q0s = {}; qus = {}; rho2 = {};".format(q0s, qus, ρ * ρ_restricted))
-                    if ρ == 1:
-                        self.models[q0s, qus, ρ] = StructuredModel(self.params, q0s, qus)
-                        self.models[q0s, qus, ρ].ApproxBound()       # Approximating boundary conditions
-                        self.models[q0s, qus, ρ].solvetheta()        # Solving ODE by matching θ to designated qus
-                        self.models[q0s, qus, ρ].HL(calHL = True)    # Caculate Half life of entropy and drift distortion
-                        self.models[q0s, qus, ρ].UpdatingDrift()     # calculate new drifts 
-                        self.models[q0s, qus, ρ].ExpectH()           # Calculate shock price elasticities
+                    if self.params['calibration'] == 'joint':
+                        (θguess, dv0guess) = warm.get(ρ, (None, None))
+                    else:
+                        (θguess, dv0guess) = (None, None)
 
                     self.models[q0s, qus, ρ] = StructuredModel(self.params, q0s, qus, ρ * ρ_restricted)
-                    self.models[q0s, qus, ρ].ApproxBound()
-                    self.models[q0s, qus, ρ].solvetheta()
-                    self.models[q0s, qus, ρ].HL(calHL = True)
-                    self.models[q0s, qus, ρ].UpdatingDrift()
-                    self.models[q0s, qus, ρ].ExpectH()
+                    self.models[q0s, qus, ρ].ApproxBound()       # Approximating boundary conditions
+                    self.models[q0s, qus, ρ].solvetheta(θguess, dv0guess)        # Solving ODE by matching θ to designated qus
+                    self.models[q0s, qus, ρ].HL(calHL = False)   # Drift distortion
+                    for name in outputs:
+                        getattr(self.models[q0s, qus, ρ], name)
+                    if compact:
+                        self.models[q0s, qus, ρ] = self.models[q0s, qus, ρ].compact(outputs, horizons)
+                    if self.models[q0s, qus, ρ].status == 1 and np.isfinite(self.models[q0s, qus, ρ].θ):
+                        warm[ρ] = (self.models[q0s, qus, ρ].θ, self.models[q0s, qus, ρ].dv0)
+
+    def profilesummary(self, verbose = True):
+        # Aggregating the solve profiles of all models in the grid; returns the merged report and optionally prints it
+        report = SolveProfile.merge([model.profile.report() for model in self.models.values()])
+        if verbose:
+            print("Solve profile over {} models:".format(len(self.models)))
+            print(SolveProfile.table(report))
+        return report
+
+    def footprint(self, verbose = True):
+        # Memory held by the models of the grid in bytes; returns the total and the size of every model, and optionally prints
+        # a summary
+        sizes = dict((key, Footprint(model)) for (key, model) in self.models.items())
+        report = {'total': sum(sizes.values()), 'models': sizes}
+        if verbose and sizes:
+            print("Memory of {} models: {:.1f} MB, {:.2f} MB per model (largest {:.2f} MB)".format(
+                len(sizes), report['total'] / 1e6, report['total'] / len(sizes) / 1e6, max(sizes.values()) / 1e6))
+        return report
 
     def driftplot(self):
         fig = go.Figure()
@@ -653,10 +1464,10 @@ class TenuousModel():
         fig.show()
 
     def shockplot(self):
-        x = np.arange(0, 1000.1 ,0.1)
         q0 = self.q0s_list[0]
         rho = self.ρ_list[0]
         qu = self.qus_list[0]
+        x = np.arange(0, 1000.1 ,0.1)[:len(self.models[q0,qu,rho].shock1['q10'])]    # the paths of compact models may be cut
         fig = make_subplots(rows = 2, cols = 3, print_grid = False, vertical_spacing = 0.08,
                     subplot_titles = (('first shock', 'ambiguity price, first shock', 'misspecification price, first shock',
                                     'second shock', 'ambiguity price, second shock', 'misspecification price, second shock')))
@@ -745,13 +1556,21 @@ class Plottingmodule():
         self.q0s_list = sorted(q0s)
         self.qus_list = sorted(qus)
         self.ρ_list = sorted(ρs)
-        self.models = {}
-        self.models = pickle.load(open('Plottingdata.pickle', "rb", -1))
+        self.__models = None
 
-        x_neg = np.append(np.arange(-2.5, 0, self.Dz), 0)  
-        x_pos = np.append(np.arange(0, 2.5, self.Dz), 2.5)
-        
-        self.x = np.hstack([x_neg, x_pos[1:]])
+        self.x = ZGrid(self.params['zl'], self.params['zr'], 'uniform', self.Dz)
+
+    @property
+    def models(self):
+        # The stored model solutions are unpickled on first use, so figures which do not need them (Figure2) open faster
+        if self.__models is None:
+            with open('Plottingdata.pickle', "rb") as file_:
+                self.__models = pickle.load(file_)
+        return self.__models
+
+    @models.setter
+    def models(self, models):
+        self.__models = models
 
     def dumpdata(self):
         # save data into a pickle object if it's the first run
@@ -991,21 +1810,14 @@ class Plottingmodule():
 
     def Figure2(self, q_list = np.linspace(0,0.15)):
         # generating Figure 2 as in the paper
-        [κgrid, βgrid] = np.meshgrid(np.arange(0,0.5,0.001), np.arange(-3,3, 0.005))
-        σinv = inv(self.params['σ'])
-        η1 = σinv[0,0] * (βgrid - self.params['βk']) + σinv[0,1] * (self.params['βz'] - κgrid)
-        η2 = σinv[1,0] * (βgrid - self.params['βk']) + σinv[1,1] * (self.params['βz'] - κgrid)
-        data = []
         q_list = sorted(q_list)
-        for q in q_list:
+        (κ, β) = EntropyContours(self.params['σ'], self.params['σz'], self.params['βk'], self.params['βz'], q_list)
+        data = []
+        for i, q in enumerate(q_list):
             if q == 0:
                 data.append([])
             else:
-                lhs = 0.5 * (η1 ** 2 + η2 ** 2) + (q ** 2 / norm(self.params['σz'] ** 2)) * (-self.params['βz'] + self.params['σz'][0] * η1 + self.params['σz'][1] * η2)
-                cs = plt.contour(κgrid, βgrid, lhs, levels = 0)
-                dta = cs.allsegs[1][0]
-                data.append([dta[:,0], dta[:,1]])
-        plt.close()
+                data.append([κ[i], β[i]])
         
         fig = go.Figure()
         base = None
@@ -1015,13 +1827,13 @@ class Plottingmodule():
                 
                 if len(data[i]) == 0:
                     
-                    base_x = np.mean(data[i+1][0][1:])
-                    base_y = np.mean(data[i+1][1][1:])
+                    base_x = np.nanmean(data[i+1][0][1:])
+                    base_y = np.nanmean(data[i+1][1][1:])
                     fig.add_trace(go.Scatter(x = [base_x], y = [base_y], visible = True, name = 'Baseline model',
                                             showlegend = True, legendgroup = 'Baseline model'))
                 else:
-                    base_x = np.mean(data[i][0][1:])
-                    base_y = np.mean(data[i][1][1:])
+                    base_x = np.nanmean(data[i][0][1:])
+                    base_y = np.nanmean(data[i][1][1:])
                     fig.add_trace(go.Scatter(x = [base_x], y = [base_y], visible = True, name = 'Baseline model',
                                             showlegend = True, legendgroup = 'Baseline model'))
                 base = 1
@@ -1061,8 +1873,8 @@ class Plottingmodule():
                                                     tickfont=dict(size=12), showgrid = False),
                             sliders = sliders
                             )
-        fig.update_xaxes(range = [min(data[-1][0]), max(data[-1][0])])
-        fig.update_yaxes(range = [min(data[-1][1]), max(data[-1][1])])
+        fig.update_xaxes(range = [np.nanmin(data[-1][0]), np.nanmax(data[-1][0])])
+        fig.update_yaxes(range = [np.nanmin(data[-1][1]), np.nanmax(data[-1][1])])
         
         fig.show()
 
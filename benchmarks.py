@@ -0,0 +1,372 @@
+##################################
+#  Import required dependencies  #
+##################################
+
+import numpy as np
+import scipy.linalg as la
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from unittest import mock
+
+# Benchmark suite for the VAR Monte Carlo (tenuous_estimation.py, MLE.py) and
+# the HJB model solve (Tenuous.py). Seeds and parameters are fixed, so results
+# saved as JSON can be compared across commits:
+#
+#   python benchmarks.py --output before.json
+#   python benchmarks.py --output after.json --compare before.json
+#
+# Model options can be overridden from the command line, e.g.
+#   python benchmarks.py --only model_solve --param bvp=global
+
+SEED = 0
+MC_DRAWS = 2000                   # draws used for the Monte Carlo timings
+MODEL_POINT = (0.1, 0.2)          # (q0s, qus) used for the single model benchmarks
+GRID = ([0.1], [0.2], [1])        # (q0s, qus, ρ) lists used for the TenuousModel grid benchmark
+THETAS = [0.2, 0.4, 0.8]          # θ values used for the __MatchODE benchmark
+REPEATS = 20                      # calls averaged over in the distortion benchmark
+FK_SCHEMES = [('euler', {}), ('cn', {'step': 1.0}), ('cn', {'step': 2.0}), ('trbdf2', {'step': 1.0}), ('trbdf2', {'step': 2.0}),
+              ('adaptive', {'tol': 1e-5}), ('adaptive', {'tol': 1e-6})]   # FeynmanKac integrators compared for accuracy and time
+POSTERIOR_DRAWS = 8               # parameter draws around the baseline solved in the posterior benchmark
+COLD_START_BUDGET = {'import_s': 0.5, 'first_figure_s': 2.0}   # cold start budget in seconds, see cold_start
+LAZY_MODULES = ['sympy', 'plotly', 'IPython', 'matplotlib', 'pandas', 'scipy.stats']   # not loaded by import Tenuous
+
+BENCHMARKS = {}
+
+def benchmark(name):
+    """
+    Registers a benchmark. A benchmark takes the benchmark context (a dict
+    shared between benchmarks, e.g. to reuse a solved model) and returns a
+    dict of metrics. Metrics whose name ends in '_s' are timings in seconds
+    and are the ones compared by --compare.
+    """
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+def timed(func, *args, **kwargs):
+    """Returns the result of func(*args, **kwargs) and its wall time."""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+####################################
+#        MONTE CARLO BENCHMARKS    #
+####################################
+
+def estimation():
+    """Imports tenuous_estimation (data, VAR estimation and jit warm-up) with a fixed seed."""
+    import tenuous_estimation as te
+    te.current_seed = SEED
+    return te
+
+@benchmark('mc_draws')
+def bench_mc_draws(context):
+    """Serial throughput of gen_results, i.e. MLEVARsim + stability check + process_VAR."""
+    te = estimation()
+    te.draw_counts.clear()
+    te.stage_times.clear()
+    res, elapsed = timed(lambda: [te.gen_results(i) for i in range(MC_DRAWS)])
+    valid = sum(r[-1] for r in res)
+    metrics = {'draws': MC_DRAWS, 'valid': int(valid), 'total_s': elapsed,
+               'per_draw_s': elapsed / MC_DRAWS, 'draws_per_sec': MC_DRAWS / elapsed}
+    # number of draws ending at each stage of draw_results
+    for stage in te.STAGES:
+        metrics[stage + '_draws'] = te.draw_counts[stage]
+    return metrics
+
+@benchmark('mc_kernel')
+def bench_mc_kernel(context):
+    """Serial throughput of the compiled kernel on the draws of mc_draws."""
+    te = estimation()
+    res, elapsed = timed(te.gen_chunk, 0, MC_DRAWS)
+    return {'draws': MC_DRAWS, 'valid': int(np.sum(res[-1])), 'total_s': elapsed,
+            'per_draw_s': elapsed / MC_DRAWS, 'draws_per_sec': MC_DRAWS / elapsed}
+
+@benchmark('mc_stages')
+def bench_mc_stages(context):
+    """Time per draw of each stage of gen_results."""
+    te = estimation()
+    stages = {'MLEVARsim_s': 0., 'eigvals_s': 0., 'lyapunov_s': 0., 'cond_s': 0., 'process_VAR_s': 0.}
+    counts = {'MLEVARsim_s': 0, 'eigvals_s': 0, 'lyapunov_s': 0, 'cond_s': 0, 'process_VAR_s': 0}
+    for i in range(MC_DRAWS):
+        (G, BB, mx), t = timed(te.MLEVARsim, te.n, te.T, te.b_hat0, te.Lam, te.dt, te.lags, te.cn, i + te.current_seed, te.noncinds)
+        stages['MLEVARsim_s'] += t; counts['MLEVARsim_s'] += 1
+        eigs, t = timed(la.eigvals, G)
+        stages['eigvals_s'] += t; counts['eigvals_s'] += 1
+        if np.all(np.abs(eigs) <= 1):
+            Sigma, t = timed(la.solve_discrete_lyapunov, G, BB)
+            stages['lyapunov_s'] += t; counts['lyapunov_s'] += 1
+            cond, t = timed(np.linalg.cond, Sigma)
+            stages['cond_s'] += t; counts['cond_s'] += 1
+            if cond <= te.cond_tol:
+                _, t = timed(te.process_VAR, G, Sigma, te.num_vars, te.uc, mx, BB, te.X0)
+                stages['process_VAR_s'] += t; counts['process_VAR_s'] += 1
+    # report the mean time of each stage per call
+    return {key: stages[key] / max(counts[key], 1) for key in stages}
+
+####################################
+#         MODEL BENCHMARKS         #
+####################################
+
+def modelparams(context):
+    """The default parameters of Tenuous.py with the command line overrides applied."""
+    from Tenuous import params
+    p = dict(params)
+    p.update(context.get('overrides', {}))
+    return p
+
+def solvedmodel(context):
+    """A fully solved StructuredModel at MODEL_POINT, shared between benchmarks."""
+    if 'model' not in context:
+        bench_model_solve(context)
+    return context['model']
+
+@benchmark('model_solve')
+def bench_model_solve(context):
+    """Full StructuredModel solve at MODEL_POINT, with the per-stage profile and the memory of the result."""
+    from Tenuous import StructuredModel, Footprint
+    np.random.seed(SEED)
+    start = time.perf_counter()
+    model = StructuredModel(modelparams(context), *MODEL_POINT)
+    model.ApproxBound()
+    model.solvetheta()
+    model.HL(calHL = True)
+    model.UpdatingDrift()
+    model.ExpectH()
+    elapsed = time.perf_counter() - start
+    context['model'] = model
+    context['model_solve_s'] = elapsed
+    metrics = {'total_s': elapsed, 'θ': float(model.θ), 'hl': float(model.hl), 'status': model.status}
+    # memory held by the solved model, and by its compact records (all horizons, and the 400 kept by Plottingmodule)
+    metrics['model_mb'] = Footprint(model) / 1e6
+    metrics['compact_mb'] = Footprint(model.compact()) / 1e6
+    metrics['compact400_mb'] = Footprint(model.compact(horizons = 400)) / 1e6
+    for (stage, entry) in model.profile.report().items():
+        metrics[stage + '_s'] = entry['time']
+        metrics[stage + '_calls'] = entry['calls']
+    return metrics
+
+@benchmark('matchode')
+def bench_matchode(context):
+    """__MatchODE per θ, including the v'(0) grid search."""
+    model = solvedmodel(context)
+    metrics = {}
+    for θ in THETAS:
+        _, elapsed = timed(model._StructuredModel__MatchODE, θ, None)
+        metrics['theta_{}_s'.format(θ)] = elapsed
+    metrics['per_theta_s'] = np.mean([metrics['theta_{}_s'.format(θ)] for θ in THETAS])
+    return metrics
+
+@benchmark('distortion')
+def bench_distortion(context):
+    """__Distortion and UpdatingDrift on the solved model, per call (mean of REPEATS calls)."""
+    model = solvedmodel(context)
+    _, distortion = timed(lambda: [model._StructuredModel__Distortion(model.v, model.θ) for i in range(REPEATS)])
+    _, updating = timed(lambda: [model.UpdatingDrift() for i in range(REPEATS)])
+    return {'Nz': len(model.v['x']), 'distortion_s': distortion / REPEATS, 'updatingdrift_s': updating / REPEATS}
+
+@benchmark('sensitivities')
+def bench_sensitivities(context):
+    """StructuredModel.Sensitivities on the solved model, with the time of the full solve for comparison."""
+    model = solvedmodel(context)
+    (labels, _), elapsed = timed(model.Sensitivities)
+    return {'parameters': len(labels), 'total_s': elapsed, 'per_parameter_s': elapsed / len(labels),
+            'solves_equivalent': elapsed / context['model_solve_s']}
+
+@benchmark('posterior')
+def bench_posterior(context):
+    """
+    posterior.solvedraws on POSTERIOR_DRAWS seeded draws within 2% of the baseline parameters, as one block
+    warm started from the first draw, and again from the cache.
+    """
+    import posterior
+    base = modelparams(context)
+    center = [base['αk'], base['βz'], base['σk'][0,0], base['σz'][0,0], base['σz'][1,0]]
+    keys = np.array(center) * (1 + 0.02 * np.random.RandomState(SEED).randn(POSTERIOR_DRAWS, len(center)))
+    cache = {}
+    results, elapsed = timed(posterior.solvedraws, keys, *MODEL_POINT, base = base, workers = 1, blocks = 1, cache = cache, verbose = False)
+    _, cached = timed(posterior.solvedraws, keys, *MODEL_POINT, base = base, workers = 1, blocks = 1, cache = cache, verbose = False)
+    times = [result['time'] for result in results if 'time' in result]
+    return {'draws': len(keys), 'failed': sum(result['status'] != 1 for result in results), 'total_s': elapsed,
+            'per_draw_s': elapsed / len(keys), 'cold_draw_s': max(times), 'warm_draw_s': float(np.median(times)), 'cached_s': cached}
+
+@benchmark('feynmankac')
+def bench_feynmankac(context):
+    """One FeynmanKac march (T = 1000, Dt = 0.1) on the solved model."""
+    from Tenuous import FeynmanKac
+    model = solvedmodel(context)
+    drift = model.σ.dot(model.Distorted[2:,:])
+    μz = drift[1,:] + model.αz - model.βz * model.v['x']
+    _, elapsed = timed(FeynmanKac, μz, model.σz, model.v['x'], model.Distorted[2,:], 1000, 0.1)
+    return {'Nz': len(model.v['x']), 'march_s': elapsed}
+
+@benchmark('feynmankac_schemes')
+def bench_feynmankac_schemes(context):
+    """
+    Accuracy against time of the FeynmanKac integrators in FK_SCHEMES on the
+    four marches of ExpectH. The error is the largest absolute difference of the
+    .10, .50 and .90 quantile paths (as in ExpectH) from adaptive steps with a
+    tolerance of 1e-10.
+    """
+    from Tenuous import FeynmanKac, InterpQuantile
+    from scipy.special import ndtri
+    model = solvedmodel(context)
+    drift = model.σ.dot(model.Distorted[2:,:])
+    μz = drift[1,:] + model.αz - model.βz * model.v['x']
+    fintl = model.Distorted[[2, 3, 0, 1]].T
+    std = np.sqrt(la.norm(model.σz) ** 2 / (2 * model.βz))
+    zs = [ndtri(p) * std + model.αz / model.βz for p in [0.1, 0.5, 0.9]]
+    def quantiles(sol):
+        return np.array([[InterpQuantile(model.v['x'], sol[:,:,i], z) for z in zs] for i in range(fintl.shape[1])])
+    reference = quantiles(FeynmanKac(μz, model.σz, model.v['x'], fintl, 1000, 0.1, 'adaptive', tol = 1e-10))
+    metrics = {}
+    for (scheme, options) in FK_SCHEMES:
+        label = '_'.join([scheme] + ['{}{:g}'.format(key, value) for (key, value) in options.items()])
+        sol, metrics[label + '_s'] = timed(FeynmanKac, μz, model.σz, model.v['x'], fintl, 1000, 0.1, scheme, **options)
+        metrics[label + '_err'] = float(np.max(np.abs(quantiles(sol) - reference)))
+    return metrics
+
+@benchmark('tenuous_grid')
+def bench_tenuous_grid(context):
+    """A small TenuousModel grid solve."""
+    from Tenuous import TenuousModel
+    (q0s, qus, ρs) = GRID
+    grid = TenuousModel(modelparams(context), list(q0s), list(qus), list(ρs))
+    _, elapsed = timed(grid.solve)
+    metrics = {'models': len(grid.models), 'total_s': elapsed}
+    for (stage, entry) in grid.profilesummary(verbose = False).items():
+        metrics[stage + '_s'] = entry['time']
+    return metrics
+
+@benchmark('plotting')
+def bench_plotting(context):
+    """Plottingmodule load and figure construction (figures are built but not shown)."""
+    import plotly.graph_objs as go
+    from Tenuous import Plottingmodule, EntropyContours, params
+    metrics = {}
+    _, metrics['contours_s'] = timed(EntropyContours, params['σ'], params['σz'], params['βk'], params['βz'], np.linspace(0, 0.15))
+    if not os.path.exists('Plottingdata.pickle'):
+        metrics['skipped'] = 'Plottingdata.pickle not found'
+        return metrics
+    with mock.patch.object(go.Figure, 'show'):
+        p, metrics['load_s'] = timed(Plottingmodule)
+        _, metrics['Figure2_s'] = timed(p.Figure2)
+        _, metrics['DriftComparison_s'] = timed(p.DriftComparison)
+        _, metrics['Figure6_s'] = timed(p.Figure6)
+    return metrics
+
+def coldrun(code):
+    """Runs code in a fresh interpreter, returning the JSON it prints last, or None and the error if it fails."""
+    proc = subprocess.run([sys.executable, '-W', 'ignore', '-c', code], capture_output = True, text = True)
+    if proc.returncode != 0:
+        errors = [line for line in proc.stderr.splitlines() if 'Error' in line]
+        return None, errors[-1] if errors else 'exit code {}'.format(proc.returncode)
+    return json.loads(proc.stdout.strip().splitlines()[-1]), None
+
+@benchmark('cold_start')
+def bench_cold_start(context):
+    """
+    import Tenuous and the notebook up to its first figure (Plottingmodule().Figure2()) in fresh
+    interpreters, against COLD_START_BUDGET. Also lists the heavy modules loaded by import Tenuous.
+    """
+    code = """
+import json, sys, time
+start = time.perf_counter()
+import Tenuous
+print(json.dumps({'import_s': time.perf_counter() - start, 'loaded': [m for m in %r if m in sys.modules]}))
+""" % LAZY_MODULES
+    result, error = coldrun(code)
+    if result is None:
+        return {'skipped': error}
+    metrics = {'import_s': result['import_s'], 'heavy_modules_loaded': ','.join(result['loaded'])}
+    code = """
+import json, time
+start = time.perf_counter()
+from Tenuous import *
+from unittest import mock
+import plotly.graph_objs as go
+with mock.patch.object(go.Figure, 'show'):
+    Plottingmodule().Figure2()
+print(json.dumps({'first_figure_s': time.perf_counter() - start}))
+"""
+    result, error = coldrun(code)
+    if result is None:
+        metrics['first_figure_skipped'] = error
+    else:
+        metrics.update(result)
+    for (key, budget) in COLD_START_BUDGET.items():
+        if key in metrics:
+            metrics[key[:-2] + '_within_budget'] = metrics[key] <= budget
+    return metrics
+
+####################################
+#        RUNNING AND REPORTING     #
+####################################
+
+def metadata():
+    """Information needed to compare results across commits and machines."""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr = subprocess.DEVNULL).decode().strip()
+    except Exception:
+        commit = None
+    return {'timestamp': datetime.datetime.now().isoformat(), 'commit': commit,
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'machine': platform.platform(), 'cpus': os.cpu_count(), 'seed': SEED}
+
+def compare(results, baseline, threshold):
+    """Prints the ratio of every timing to the baseline, flagging slowdowns above threshold."""
+    print("\nComparison with {} ({}):".format(baseline['meta'].get('commit'), baseline['meta'].get('timestamp')))
+    regressions = 0
+    for (name, metrics) in results['results'].items():
+        old = baseline['results'].get(name, {})
+        for (key, value) in metrics.items():
+            if key.endswith('_s') and key in old and old[key] > 0:
+                ratio = value / old[key]
+                flag = '  <-- slower' if ratio > threshold else ''
+                regressions += ratio > threshold
+                print("\t{:<14}{:<24}{:>10.4f}{:>10.4f}{:>8.2f}x{}".format(name, key, old[key], value, ratio, flag))
+    return regressions
+
+def parsevalue(value):
+    """Parses a command line parameter override."""
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Benchmarks for the Monte Carlo and the model solve.')
+    parser.add_argument('--only', default = None, help = 'comma separated list of benchmarks: ' + ', '.join(BENCHMARKS))
+    parser.add_argument('--output', default = 'benchmarks.json', help = 'file the JSON results are written to')
+    parser.add_argument('--compare', default = None, help = 'JSON results of an earlier run to compare with')
+    parser.add_argument('--threshold', default = 1.2, type = float, help = 'slowdown ratio reported as regression')
+    parser.add_argument('--param', action = 'append', default = [], help = 'model parameter override, e.g. bvp=global')
+    args = parser.parse_args()
+
+    names = list(BENCHMARKS) if args.only is None else args.only.split(',')
+    context = {'overrides': dict((item.split('=', 1)[0], parsevalue(item.split('=', 1)[1])) for item in args.param)}
+    results = {'meta': metadata(), 'overrides': context['overrides'], 'results': {}}
+    for name in names:
+        print("Running {}...".format(name))
+        np.random.seed(SEED)
+        results['results'][name] = BENCHMARKS[name](context)
+        for (key, value) in results['results'][name].items():
+            print("\t{}: {}".format(key, value))
+
+    with open(args.output, 'w') as file_:
+        json.dump(results, file_, indent = 2, default = float)
+    print("Results saved to {}".format(args.output))
+
+    if args.compare is not None:
+        with open(args.compare) as file_:
+            regressions = compare(results, json.load(file_), args.threshold)
+        sys.exit(1 if regressions else 0)
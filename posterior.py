@@ -0,0 +1,279 @@
+##################################
+#  Import required dependencies  #
+##################################
+
+import numpy as np
+from numpy.linalg import norm
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import os
+import pickle
+import time
+
+from MLE import DrawSet, PARAMETERS, wprctile_columns
+from Tenuous import StructuredModel, DerivedParams, params
+
+# Pipeline from the Monte Carlo draws of tenuous_estimation.py to the
+# structured model: a weighted subsample of the draws of (α_c, β_z, σ_c, σ_z)
+# is solved with StructuredModel, and weighted quantile bands of the drift of z
+# and the shock price elasticities are reported, so that the parameter
+# uncertainty of the VAR reaches the model outputs.
+#
+# The draws are ordered so that neighbouring draws are close, and solved in
+# blocks in a process pool. Within a block, θ and v'(0) are calibrated from the
+# solution of the previous draw (params['calibration'] = 'joint'), which takes
+# a fraction of a cold solve. Results are cached by parameter tuple, so that
+# the draws resampled more than once are only solved once and later runs only
+# solve the draws they have not seen.
+
+CACHE_FILE = os.path.join('__pycache__', 'posterior.pkl')
+SHOCKS = ['shock1', 'shock2']           # shock price elasticities reported, see StructuredModel.ExpectH
+QUANTILES = ['q10', 'q50', 'q90']       # quantiles of z at which the elasticities are computed
+STRIDE = 10                             # elasticities are kept every STRIDE time steps of ExpectH (Dt = 0.1)
+
+def modelparams(draw, base = params):
+    """
+    The parameter dictionary of StructuredModel at one draw.
+
+    Inputs:
+    draw:       The values of PARAMETERS (ac, b, sigc1, sigz1, sigz2) of the draw.
+    base:       The parameter dictionary providing every other parameter and
+                    the solver options.
+    """
+    (ac, b, sigc1, sigz1, sigz2) = draw
+    p = dict(base)
+    p['αk'] = ac
+    p['βz'] = b
+    p['σk'] = np.array([[sigc1], [0.]])
+    p['σz'] = np.array([[sigz1], [sigz2]])
+    p['workers'] = 1        # the draws are already solved in parallel
+    return DerivedParams(p)
+
+def subsample(draws, size, seed = 0):
+    """
+    A weighted subsample of the valid draws by systematic resampling, so that
+    each draw is kept about size times its weight times.
+
+    Inputs:
+    draws:      A DrawSet of the Monte Carlo draws.
+    size:       The number of draws resampled.
+    seed:       The seed of the offset of the systematic resampling.
+
+    Returns:
+    keys:       A numpy array with the distinct resampled draws as rows, with
+                    the values of PARAMETERS as columns.
+    counts:     A numpy array of the number of times each row was resampled.
+    """
+    if not isinstance(draws, DrawSet):
+        raise TypeError("subsample requires the draws themselves (a DrawSet), not a summary of them")
+    cumulative = np.cumsum(draws.weights)
+    u = (np.random.RandomState(seed).rand() + np.arange(size)) / size * cumulative[-1]
+    indices = np.minimum(np.searchsorted(cumulative, u), len(cumulative) - 1)
+    values = np.column_stack([draws.values[name] for name in PARAMETERS])[indices]
+    return np.unique(values, axis = 0, return_counts = True)
+
+def neighbourorder(keys):
+    """
+    An ordering of the rows of keys in which consecutive draws are close: a
+    greedy nearest-neighbour path through the standardized parameters,
+    starting from the draw closest to their mean.
+    """
+    scale = np.std(keys, axis = 0)
+    x = (keys - np.mean(keys, axis = 0)) / np.where(scale > 0, scale, 1)
+    left = np.ones(len(x), dtype = bool)
+    order = [int(np.argmin(np.sum(x ** 2, axis = 1)))]
+    left[order[0]] = False
+    for i in range(len(x) - 1):
+        distance = np.sum((x - x[order[-1]]) ** 2, axis = 1)
+        distance[~left] = np.inf
+        order.append(int(np.argmin(distance)))
+        left[order[-1]] = False
+    return np.array(order)
+
+def solvedraw(draw, base, q0s, qus, ρ, warm = (None, None)):
+    """
+    Solves StructuredModel at one draw and returns its outputs.
+
+    Inputs:
+    draw:       The values of PARAMETERS of the draw.
+    base:       The parameter dictionary of the other parameters (see modelparams).
+    q0s, qus:   The relative entropies of the model.
+    ρ:          ρ2 relative to its restricted value q0s ** 2 / |σz| ** 2.
+    warm:       (θ, v'(0)) of a neighbouring draw used as starting point of the
+                    calibration, or (None, None) for a cold solve.
+
+    Returns:
+    result:     A dict with θ, v'(0) ('dv0'), the calibration status, the solve
+                    time, driftz on the z grid and each shock elasticity, e.g.
+                    'shock1.q50', every STRIDE time steps.
+    """
+    start = time.time()
+    p = modelparams(draw, base)
+    model = StructuredModel(p, q0s, qus, ρ * q0s ** 2 / norm(p['σz']) ** 2)
+    model.ApproxBound()
+    model.solvetheta(*warm)
+    if model.status != 1 and warm[0] is not None:
+        model.solvetheta()      # the warm start failed, solve from the grid search
+    model.HL(calHL = False)
+    model.UpdatingDrift()
+    model.ExpectH()
+    result = {'θ': float(model.θ), 'dv0': float(np.squeeze(model.v['dv0'])), 'status': model.status,
+              'x': model.v['x'], 'driftz': model.driftz}
+    for shock in SHOCKS:
+        for q in QUANTILES:
+            result[shock + '.' + q] = np.ravel(getattr(model, shock)[q])[::STRIDE]
+    result['time'] = time.time() - start
+    return result
+
+def solveblock(task):
+    """
+    Solves a block of neighbouring draws in order, warm starting each from the
+    previous one. task is (draws, base, q0s, qus, ρ); returns the list of the
+    results of solvedraw.
+    """
+    (draws, base, q0s, qus, ρ) = task
+    results = []
+    warm = (None, None)
+    for draw in draws:
+        try:
+            results.append(solvedraw(draw, base, q0s, qus, ρ, warm))
+        except (ValueError, RuntimeError, np.linalg.LinAlgError) as error:
+            results.append({'θ': np.nan, 'status': 0, 'error': repr(error)})
+        if results[-1]['status'] == 1 and np.isfinite(results[-1]['θ']):
+            warm = (results[-1]['θ'], results[-1]['dv0'])
+    return results
+
+def settingskey(base, q0s, qus, ρ):
+    """The part of the cache key shared by all draws: the model and solver settings other than the drawn parameters."""
+    drawn = ['αk', 'βz', 'σk', 'σz', 'z̄', 'σ', 'a', 'b', 'd', 'ρ2', 'workers', 'executor']
+    settings = [(name, np.asarray(value).tolist()) for (name, value) in sorted(base.items()) if name not in drawn]
+    return repr((settings, q0s, qus, ρ, SHOCKS, STRIDE))
+
+def loadcache(path = CACHE_FILE):
+    """The cache of solved draws stored at path, or an empty cache."""
+    try:
+        with open(path, 'rb') as file_:
+            return pickle.load(file_)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return {}
+
+def savecache(cache, path = CACHE_FILE):
+    """Stores the cache of solved draws at path, through a temporary file so that it is never left partially written."""
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+        temp = '{}.{}'.format(path, os.getpid())
+        with open(temp, 'wb') as file_:
+            pickle.dump(cache, file_, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, path)
+    except OSError:
+        pass                                # e.g. a read-only directory, the cache is optional
+
+def solvedraws(keys, q0s = 0.1, qus = 0.2, ρ = 1, base = params, calibration = 'joint', workers = None, blocks = None,
+               cache = None, verbose = True):
+    """
+    Solves StructuredModel at every row of keys, in parallel and reusing the
+    results in cache.
+
+    Inputs:
+    keys:       A numpy array of draws, with the values of PARAMETERS as columns.
+    q0s, qus, ρ: See solvedraw.
+    base:       The parameter dictionary of the other parameters.
+    calibration: The calibration of θ (see params['calibration']); the warm
+                    starts are fastest with 'joint'.
+    workers:    The number of worker processes, by default one per CPU.
+    blocks:     The number of blocks of neighbouring draws, each started with a
+                    cold solve, by default four per worker.
+    cache:      A dict of previous results (see loadcache), updated in place.
+
+    Returns:
+    results:    A list of the results of solvedraw, in the order of keys.
+    """
+    base = dict(base)
+    base['calibration'] = calibration
+    workers = workers or os.cpu_count()
+    cache = {} if cache is None else cache
+    solved = cache.setdefault(settingskey(base, q0s, qus, ρ), {})
+    todo = np.array([i for i in range(len(keys)) if tuple(keys[i]) not in solved], dtype = int)
+
+    if len(todo) > 0:
+        start = time.time()
+        order = todo[neighbourorder(keys[todo])]
+        blocks = min(blocks or 4 * workers, len(order))
+        tasks = [(keys[block], base, q0s, qus, ρ) for block in np.array_split(order, blocks)]
+        done = 0
+        with ProcessPoolExecutor(workers) as pool:
+            futures = dict((pool.submit(solveblock, task), task) for task in tasks)
+            for future in as_completed(futures):
+                for (draw, result) in zip(futures[future][0], future.result()):
+                    solved[tuple(draw)] = result
+                done += len(futures[future][0])
+                if verbose:
+                    elapsed = time.time() - start
+                    print("Solved {} of {} draws in {:.0f} seconds, about {:.0f} seconds left".format(
+                        done, len(order), elapsed, elapsed / done * (len(order) - done)))
+    return [solved[tuple(key)] for key in keys]
+
+def bands(results, counts, percentiles = [10, 50, 90]):
+    """
+    Weighted pointwise quantile bands of the outputs of the solved draws.
+
+    Inputs:
+    results:    A list of results of solvedraw.
+    counts:     A numpy array of the weights of the results, e.g. the counts of
+                    subsample. Draws whose calibration failed are left out.
+    percentiles: The percentiles of the bands.
+
+    Returns:
+    bands:      A dict mapping 'x' to the z grid and each output ('θ',
+                    'driftz', 'shock1.q50', ...) to a numpy array with one row
+                    per percentile.
+    """
+    ok = np.array([result['status'] == 1 for result in results])
+    if not np.any(ok):
+        raise ValueError("No draw was solved")
+    weights = np.asarray(counts, dtype = float)[ok]
+    weights = weights / np.sum(weights)
+    results = [result for (result, keep) in zip(results, ok) if keep]
+    out = {'x': results[0]['x'], 'solved': weights.size, 'failed': int(np.sum(~ok))}
+    values = {'θ': np.array([[result['θ']] for result in results]),
+              'driftz': np.array([np.interp(out['x'], result['x'], result['driftz']) for result in results])}   # the z grids differ with zgrid = 'adaptive'
+    for name in [shock + '.' + q for shock in SHOCKS for q in QUANTILES]:
+        values[name] = np.array([result[name] for result in results])
+    for (name, value) in values.items():
+        out[name] = np.array([wprctile_columns(value, weights, p) for p in percentiles])
+    out['θ'] = out['θ'][:, 0]
+    return out
+
+def loaddraws(path):
+    """The DrawSet of the draws saved by tenuous_estimation.py in draws_file."""
+    with np.load(path) as stored:
+        return DrawSet(stored['logweights'], dict((name, stored[name]) for name in PARAMETERS), stored['valid'])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Quantile bands of the model outputs over the posterior draws of the VAR")
+    parser.add_argument('draws', help = "the draws_file saved by tenuous_estimation.py")
+    parser.add_argument('--size', type = int, default = 1000, help = "number of draws resampled")
+    parser.add_argument('--q0s', type = float, default = 0.1)
+    parser.add_argument('--qus', type = float, default = 0.2)
+    parser.add_argument('--rho', type = float, default = 1., help = "ρ2 relative to its restricted value")
+    parser.add_argument('--workers', type = int, default = None)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--cache', default = CACHE_FILE, help = "cache file of solved draws, '' to disable")
+    parser.add_argument('--output', default = 'posterior_bands.npz')
+    args = parser.parse_args()
+
+    keys, counts = subsample(loaddraws(args.draws), args.size, args.seed)
+    print("{} distinct draws in a subsample of {}".format(len(keys), args.size))
+    cache = loadcache(args.cache) if args.cache else {}
+    try:
+        results = solvedraws(keys, args.q0s, args.qus, args.rho, workers = args.workers, cache = cache)
+    finally:
+        if args.cache:
+            savecache(cache, args.cache)
+    out = bands(results, counts)
+    print("Failed calibrations: {} of {} draws".format(out['failed'], len(keys)))
+    print("θ at the 10th, 50th and 90th percentiles: {}".format(out['θ']))
+    for shock in SHOCKS:
+        print("{} elasticity at the median z, horizon 0 and {}: {}".format(
+            shock, (out[shock + '.q50'].shape[1] - 1) * STRIDE * 0.1, out[shock + '.q50'][:, [0, -1]].tolist()))
+    np.savez(args.output, **dict((name, value) for (name, value) in out.items()))
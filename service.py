@@ -0,0 +1,361 @@
+##################################
+#  Import required dependencies  #
+##################################
+
+import numpy as np
+from numpy.linalg import norm
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import asyncio
+import collections
+import io
+import json
+import os
+import pickle
+import tempfile
+import time
+
+from Tenuous import StructuredModel, ZGrid, params
+
+# Local HTTP service for the solved model curves. The solution store saved by
+# Plottingmodule.dumpdata is loaded once, and batched queries for the drift of
+# z, the shock price elasticity paths, θ and the half life at (q0s, qus, ρ)
+# points are answered from it, as JSON or as a numpy .npz file:
+#
+#   python service.py --store Plottingdata.pickle --port 8000 --workers 2
+#   curl -X POST localhost:8000/query -d '{"points": [[0.1, 0.2, 1]], "fields": ["θ", "shock1"]}'
+#
+# The curves are returned by default. Points that are missing, or that lack a
+# requested field such as θ and the half life which the store does not keep,
+# are solved in a process pool of a bounded size, and queries asking for a
+# point which is being solved wait for that solve instead of starting another.
+# Latency and throughput are reported at /metrics.
+#
+# As in TenuousModel, ρ multiplies the restricted value q0s^2 / |σz|^2 of ρ2.
+
+STORE_FILE = 'Plottingdata.pickle'
+SHOCKS = ['shock1', 'shock2', 'ambiguity1', 'ambiguity2', 'misspec1', 'misspec2']
+QUANTILES = ['q10', 'q50', 'q90']       # quantiles of z at which the elasticities are computed
+HORIZONS = 400                          # elasticity horizons kept, as stored by Plottingmodule.dumpdata
+CURVES = ['driftz'] + SHOCKS
+SCALARS = ['θ', 'hl', 'ρ', 'status']    # ρ is the value of ρ2
+FIELDS = CURVES + SCALARS
+MAX_POINTS = 1000                       # points in one query
+MAX_PENDING = 64                        # points being solved or waiting for a worker
+LATENCY_WINDOW = 1000                   # latencies kept per route for the percentiles of /metrics
+
+def pointkey(point):
+    """
+    The store key of a (q0s, qus, ρ) point, rounded so that points given in
+    JSON match the keys built with np.linspace by Plottingmodule. qus may be
+    given as "inf" for the worst case model.
+    """
+    values = [float(value) for value in point]
+    if len(values) != 3 or not (np.isfinite(values[0]) and np.isfinite(values[2])) or np.isnan(values[1]):
+        raise ValueError("A point is [q0s, qus, ρ], with finite q0s and ρ: {}".format(point))
+    return tuple(value if np.isinf(value) else round(value, 10) for value in values)
+
+def loadstore(path = STORE_FILE):
+    """The solution store at path keyed by pointkey, or an empty store if there is no file."""
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'rb') as file_:
+        return dict((pointkey(key), record) for (key, record) in pickle.load(file_).items())
+
+def savestore(store, path):
+    """
+    Stores the solution store at path, through a temporary file of a unique
+    name in the same directory, so that the file is never left partially
+    written. The temporary file is removed if the store cannot be written.
+    """
+    (handle, temp) = tempfile.mkstemp(prefix = os.path.basename(path) + '.', dir = os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(handle, 'wb') as file_:
+            pickle.dump(store, file_, -1)
+        os.replace(temp, path)
+    except BaseException:
+        os.remove(temp)
+        raise
+
+def solvepoint(key, base = params):
+    """
+    Solves StructuredModel at one point and returns its record in the format of
+    the store, with θ, the half life and the status of the calibration added.
+
+    Inputs:
+    key:        The point (q0s, qus, ρ).
+    base:       The parameter dictionary of StructuredModel.
+    """
+    (q0s, qus, ρ) = key
+    start = time.perf_counter()
+    model = StructuredModel(base, q0s, qus, ρ * q0s ** 2 / norm(base['σz']) ** 2)
+    model.ApproxBound()
+    model.solvetheta()
+    model.HL(calHL = False)
+    # driftz is stored on the uniform grid of the store (see ModelService.x), also for models solved on other z grids
+    x = ZGrid(base['zl'], base['zr'], 'uniform', base.get('Dz', 0.01))
+    record = {'ρ': model.ρ2, 'θ': float(model.θ), 'hl': float(model.hl), 'status': model.status,
+              'driftz': np.interp(x, model.v['x'], model.driftz)}
+    for s in SHOCKS:
+        record[s] = dict((q, np.ravel(getattr(model, s)[q])[:HORIZONS]) for q in QUANTILES)
+    record['time'] = time.perf_counter() - start
+    return record
+
+def jsonable(value):
+    """value with arrays as lists, and inf and nan (which are not valid JSON) as strings."""
+    if isinstance(value, dict):
+        return dict((key, jsonable(item)) for (key, item) in value.items())
+    if isinstance(value, np.ndarray) and value.dtype.kind == 'f' and np.all(np.isfinite(value)):
+        return value.tolist()
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [jsonable(item) for item in value]
+    if isinstance(value, (float, np.floating)) and not np.isfinite(value):
+        return str(float(value))
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+class ServiceMetrics():
+    # Request latencies per route, throughput and counters of the service
+
+    def __init__(self, window = LATENCY_WINDOW):
+        self.start = time.time()
+        self.counts = collections.Counter()
+        self.latency = collections.defaultdict(lambda: collections.deque(maxlen = window))
+        self.solves = collections.deque(maxlen = window)
+
+    def request(self, route, elapsed, status, points = 0):
+        # recording a served request
+        self.counts['requests'] += 1
+        self.counts['points'] += points
+        if status >= 400:
+            self.counts['errors'] += 1
+        self.latency[route].append(elapsed)
+
+    def report(self, **extra):
+        # counters, rates since the start and latency percentiles in milliseconds
+        uptime = time.time() - self.start
+        report = {'uptime_s': uptime,
+                  'requests_per_s': self.counts['requests'] / uptime,
+                  'points_per_s': self.counts['points'] / uptime}
+        report.update(self.counts)
+        report.update(extra)
+        report['latency_ms'] = {}
+        for (route, latencies) in self.latency.items():
+            ms = 1000 * np.array(latencies)
+            report['latency_ms'][route] = {'count': len(ms), 'p50': np.percentile(ms, 50), 'p90': np.percentile(ms, 90),
+                                           'p99': np.percentile(ms, 99), 'max': ms.max()}
+        if self.solves:
+            report['solve_s'] = {'p50': np.percentile(self.solves, 50), 'max': max(self.solves)}
+        return jsonable(report)
+
+class ModelService():
+    # Answers queries for model outputs from the solution store, solving the missing points in a process pool
+
+    def __init__(self, store = {}, base = params, workers = 1, max_pending = MAX_PENDING, path = None):
+        self.store = dict(store)
+        self.base = base
+        self.pool = ProcessPoolExecutor(workers)
+        self.workers = workers
+        self.max_pending = max_pending
+        self.path = path            # the store is saved there after solved points if given, see save
+        self.saver = None           # task writing the store
+        self.unsaved = False        # points were solved since the store was last written
+        self.saveerror = None       # error of the last failed save
+        self.inflight = {}          # futures of the points being solved
+        self.encodings = {}         # JSON of the fields of the stored points, see encoded
+        self.metrics = ServiceMetrics()
+        self.x = ZGrid(base['zl'], base['zr'], 'uniform', base.get('Dz', 0.01))   # z grid of driftz
+
+    async def record(self, key, fields, compute = True):
+        # the record of a point with the requested fields, from the store or solved
+        record = self.store.get(key)
+        if record is not None and all(field in record for field in fields):
+            self.metrics.counts['store_hits'] += 1
+            return record
+        if key in self.inflight:
+            self.metrics.counts['joined'] += 1
+        elif not compute:
+            return {'error': 'not in the store'}
+        elif len(self.inflight) >= self.max_pending:
+            self.metrics.counts['rejected'] += 1
+            return {'error': 'too many points being solved, retry later'}
+        else:
+            self.inflight[key] = asyncio.ensure_future(self.solve(key))
+        return await asyncio.shield(self.inflight[key])
+
+    async def solve(self, key):
+        # solving a point in the pool and adding it to the store
+        loop = asyncio.get_event_loop()
+        try:
+            record = await loop.run_in_executor(self.pool, solvepoint, key, self.base)
+        except Exception as error:
+            self.metrics.counts['failed'] += 1
+            return {'error': 'solve failed: {}'.format(error)}
+        finally:
+            del self.inflight[key]
+        self.metrics.counts['solved'] += 1
+        self.metrics.solves.append(record.pop('time'))
+        merged = dict(self.store.get(key, {}))
+        merged.update(record)
+        self.store[key] = merged
+        for field in merged:
+            self.encodings.pop((key, field), None)
+        if self.path is not None:
+            self.save()
+        return merged
+
+    def save(self):
+        # saving the store in the background without delaying the query. A single task writes the store, one save at a
+        # time, and points solved while it writes are saved together by its next save
+        self.unsaved = True
+        if self.saver is None or self.saver.done():
+            self.saver = asyncio.ensure_future(self.writer())
+
+    async def writer(self):
+        # writing the store until no point is left unsaved; a failed save is counted in the metrics, and retried at the
+        # next solved point
+        loop = asyncio.get_event_loop()
+        while self.unsaved:
+            self.unsaved = False
+            try:
+                await loop.run_in_executor(None, savestore, dict(self.store), self.path)
+                self.metrics.counts['saves'] += 1
+            except Exception as error:
+                self.metrics.counts['save_failed'] += 1
+                self.saveerror = '{}: {}'.format(type(error).__name__, error)
+                return
+
+    async def query(self, request):
+        # records of the points of a query, in order
+        points = request.get('points', [])
+        if not isinstance(points, list) or len(points) > MAX_POINTS:
+            raise ValueError("points must be a list of at most {} points".format(MAX_POINTS))
+        keys = [pointkey(point) for point in points]
+        fields = request.get('fields', CURVES)
+        unknown = [field for field in fields if field not in FIELDS]
+        if unknown:
+            raise ValueError("Unknown fields {}, available fields are {}".format(unknown, FIELDS))
+        records = await asyncio.gather(*[self.record(key, fields, request.get('compute', True)) for key in keys])
+        return (keys, fields, records)
+
+    def encoded(self, key, field, record):
+        # the JSON of a field of a record, encoded once per stored point since the curves are large
+        if record is not self.store.get(key):
+            return json.dumps(jsonable(record[field]))
+        if (key, field) not in self.encodings:
+            self.encodings[key, field] = json.dumps(jsonable(record[field]))
+        return self.encodings[key, field]
+
+    def tojson(self, keys, fields, records):
+        results = []
+        for (key, record) in zip(keys, records):
+            items = ['"point": ' + json.dumps(jsonable(key))]
+            if 'error' in record:
+                items.append('"error": ' + json.dumps(record['error']))
+            else:
+                items += [json.dumps(field) + ': ' + self.encoded(key, field, record) for field in fields]
+            results.append('{' + ', '.join(items) + '}')
+        response = '{"results": [' + ', '.join(results) + ']'
+        if 'driftz' in fields:
+            response += ', "z": ' + json.dumps(jsonable(self.x))
+        return (response + '}').encode()
+
+    def tonpz(self, keys, fields, records):
+        # one array per field (and quantile), with a row per point; rows of missing points are nan
+        arrays = {'points': np.array(keys, dtype = float)}
+        found = np.array(['error' not in record for record in records])
+        for field in fields:
+            for q in (QUANTILES if field in SHOCKS else [None]):
+                name = field if q is None else field + '.' + q
+                values = [record[field] if q is None else record[field][q] for record in records if 'error' not in record]
+                shape = np.shape(values[0]) if values else ()
+                arrays[name] = np.full((len(keys),) + shape, np.nan)
+                arrays[name][found] = values
+        if 'driftz' in fields:
+            arrays['z'] = self.x
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        return buffer.getvalue()
+
+    async def respond(self, method, path, headers, body):
+        # (status, content type, payload, points) of a request
+        if method == 'GET' and path == '/health':
+            return (200, 'application/json', json.dumps({'status': 'ok', 'points': len(self.store)}).encode(), 0)
+        if method == 'GET' and path == '/metrics':
+            report = self.metrics.report(stored = len(self.store), inflight = len(self.inflight), workers = self.workers,
+                                         save_error = self.saveerror)
+            return (200, 'application/json', json.dumps(report).encode(), 0)
+        if method == 'GET' and path == '/points':
+            return (200, 'application/json', json.dumps(jsonable(sorted(self.store))).encode(), 0)
+        if method == 'POST' and path == '/query':
+            try:
+                request = json.loads(body.decode() or '{}')
+                (keys, fields, records) = await self.query(request)
+            except (ValueError, TypeError, AttributeError) as error:
+                return (400, 'application/json', json.dumps({'error': str(error)}).encode(), 0)
+            if request.get('format') == 'npz' or 'application/octet-stream' in headers.get('accept', ''):
+                return (200, 'application/octet-stream', self.tonpz(keys, fields, records), len(keys))
+            return (200, 'application/json', self.tojson(keys, fields, records), len(keys))
+        return (404, 'application/json', json.dumps({'error': 'unknown route {} {}'.format(method, path)}).encode(), 0)
+
+    async def handle(self, reader, writer):
+        # serving the HTTP/1.1 requests of a connection, which is kept alive unless the client closes it
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                (method, path, version) = line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    (name, _, value) = header.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                start = time.perf_counter()
+                (status, content, payload, points) = await self.respond(method, path.split('?')[0], headers, body)
+                self.metrics.request(path.split('?')[0], time.perf_counter() - start, status, points)
+                close = headers.get('connection', '').lower() == 'close' or version == 'HTTP/1.0'
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+                    status, 'OK' if status == 200 else 'Error', content, len(payload), 'close' if close else 'keep-alive').encode())
+                writer.write(payload)
+                await writer.drain()
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass                            # a malformed request or a dropped connection
+        finally:
+            writer.close()
+
+    def serve(self, host = '127.0.0.1', port = 8000):
+        # running the service until interrupted
+        loop = asyncio.get_event_loop()
+        server = loop.run_until_complete(asyncio.start_server(self.handle, host, port))
+        print("Serving {} points on http://{}:{}".format(len(self.store), host, port))
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            if self.saver is not None:
+                loop.run_until_complete(self.saver)
+            self.pool.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Local HTTP service for the solved model curves")
+    parser.add_argument('--store', default = STORE_FILE, help = "solution store saved by Plottingmodule.dumpdata")
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8000)
+    parser.add_argument('--workers', type = int, default = 1, help = "processes solving missing points")
+    parser.add_argument('--max-pending', type = int, default = MAX_PENDING, help = "points solved or waiting at once")
+    parser.add_argument('--save', action = 'store_true', help = "add the solved points to the store file")
+    args = parser.parse_args()
+
+    service = ModelService(loadstore(args.store), params, args.workers, args.max_pending, args.store if args.save else None)
+    service.serve(args.host, args.port)
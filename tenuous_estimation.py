@@ -6,14 +6,18 @@ import numpy as np
 import matplotlib.pyplot as plt
 import scipy.linalg as la
 from scipy.stats import multivariate_normal
-import pandas as pd
-from MLE import MLEVAR, MLEVARsim, wprctile, process_VAR
+from MLE import MLEVAR, MLEVARindices, MLEVARinitial, MLEVARcompanion, MLEVARtriangular, MLEVARsim, MLEVARdraw, MLEVARmap, MLEVARscreen, MLEVARassemble, MLEVARpack, MLEVARshift, MLEVARkernel, process_VAR, \
+                PARAMETERS, DrawSet, DrawSummary
 import os
+import vardata
 from tqdm import tqdm
+import collections
+import json
+import threading
 import time
 import sys
 from numba import jit
-from multiprocessing import Pool, current_process, Manager
+from multiprocessing import Pool, Queue
 
 # Set the options for printing numpy arrays neatly
 np.set_printoptions(precision=3, legacy = '1.13')
@@ -22,61 +26,24 @@ np.set_printoptions(precision=3, legacy = '1.13')
 #            LOAD DATA            #
 ###################################
 
-T = pd.read_csv('data3py.csv')
-
-date = T.date
-popu = T.popu
-propinc = T.propinc
-corpprof = T.corpprof
-pdivinc = T.pdivinc
-consnond = T.consnond
-consserv = T.consserv
-pinond = T.pinond
-piserv = T.piserv
-
-start_date = date.iloc[0]
-print("\nTime period:")
-print("\tStart date: \t{}".format(start_date))
-
 # This offset allows for a trunkated time period. Set to 0 to use all time
 # periods
 offset = 0
 
-end_date = date.iloc[-offset - 1]
-print("\tEnd date: \t{}".format(end_date))
-
-# Filter out any observations which are outside the relevant time period
-data_index = date.values <= end_date
-
-CN      = consnond[data_index]                   # nondurables
-CS      = consserv[data_index]                   # services
-PCN     = pinond[data_index]/100                 # price index for nondurables
-PCS     = piserv[data_index]/100                 # price index for services
-NIPAE   = corpprof[data_index]                   # corporate before-tax profit with IVA and CCadj
-NIPAPI  = propinc[data_index]                    # proprieters income
-NIPAPDI = pdivinc[data_index]                    # personal dividend income
-POP     = popu[data_index]                       # population series from LNU000000
-PCE     = ((PCN*CN+PCS*CS)/(CN+CS))[data_index]  # weighted aggregate deflator
-C       = (CN+CS)[data_index]                    # nominal consumption
-c       = (C/PCE)[data_index]                    # real consumption
-cpc     = (c/POP)[data_index].values             # real consumption per capita
+# The VAR inputs derived from data3py.csv, see vardata.py. They are cached, so
+# that only the first run, or a run after data3py.csv or offset has changed,
+# parses the CSV.
+data = vardata.load('data3py.csv', offset)
+date = data['date']
 
-e2       = ((NIPAE + NIPAPI)/PCE)[data_index]    # business income (proprietor's income plus corporate profits)[
-e2pc     = (e2/POP)[data_index].values           # business income per capita
-
-e3       = (NIPAPDI/PCE)[data_index]             # personal dividend income
-e3pc     = (e3/POP)[data_index].values           # personal dividend income per capita
-
-
-# We use the log values of the relevant variables
-logcpc = np.log(cpc)
-logepc = np.log(e2pc)
-logdpc = np.log(e3pc)
+print("\nTime period:")
+print("\tStart date: \t{}".format(date[0]))
+print("\tEnd date: \t{}".format(date[-1]))
 
 # These are the actual variables we use in the VAR
-gcpc = np.diff(logcpc)
-logecpc = logepc - logcpc
-logdcpc = logdpc - logcpc
+gcpc = data['gcpc']
+logecpc = data['logecpc']
+logdcpc = data['logdcpc']
 
 
 ####################################
@@ -84,7 +51,6 @@ logdcpc = logdpc - logcpc
 ####################################
 
 L = 5 # The number of lags used (consumption uses 1 less lag)
-n = 3 # The dimension of the auto-regressive vector
 
 # Load the vector of data
 y = [] # The elements of y are of different lengths, so we leave it as a list
@@ -92,32 +58,25 @@ y.append(gcpc)
 y.append(logecpc)
 y.append(logdcpc)
 
-# Code the initial observation X_0, used in Monte Carlo estimation
-X0 = np.array([y[0][3], y[1][4], y[2][4],
-     y[0][2], y[1][3], y[2][3],
-     y[0][1], y[1][2], y[2][2],
-     y[0][0], y[1][1], y[2][1],
-     y[1][0], y[2][0]])
-
+n = len(y) # The dimension of the auto-regressive vector
 lags = [L-1, L, L] # Specify the number of lags used per variable
 num_vars = np.sum(lags)
-noncinds = np.arange(12).tolist() + np.arange(13,15).tolist()
-# noncinds is used to drop the portions of the matrix A
-# from the paper's Appendix B.1 that correspond to a fifth lag of
-# consumption growth.
+
+# cn gives the locations of the first coefficient associated with each
+# variable. noncinds is used to drop the portions of the matrix A from the
+# paper's Appendix B.1 that correspond to lags beyond those of each variable,
+# here a fifth lag of consumption growth.
+cn, noncinds = MLEVARindices(lags)
+
+# Code the initial observation X_0, used in Monte Carlo estimation
+X0 = MLEVARinitial(y, lags)
 
 # Estimate the system as a VAR(5) model
 B, S, y_lagged, X_lagged = MLEVAR(y, lags)
 
 # Rearrange the systems to VAR(1)
-mx    = np.zeros(num_vars); mx[:n] = B[:,0]            # coefficient on constant
-A     = B[:,1:]                                        # coefficient on lags
-G     = np.block([[A],[np.eye(L * n - n), np.zeros((L * n - n, n))]])
-G     = G[noncinds]; G = G[:,noncinds]                 # This is the matrix A from the paper
-V     = np.linalg.cholesky(S)                          # Cholusky decomposition of variance-cov
-H     = np.block([[V],[np.zeros((L * n - n - 1, n))]]) # Corresponds to the matrix B from the paper
+G, BB, mx = MLEVARcompanion(B, S, lags, noncinds)      # G is the matrix A from the paper
 uc    = np.zeros(np.sum(lags)); uc[0] = 1              # Used to select consumption components of vectors
-BB    = H@H.T
 Sigma = la.solve_discrete_lyapunov(G,BB)               # Written as Sigma in the paper
 mu0   = la.solve(np.eye(len(G))-G, mx)                 # Written as mu in the paper
 
@@ -150,29 +109,47 @@ print("\t{}_z: \t{}".format(chr(963), sigz))
 
 print("\nDrawing parameters for Monte Carlo:")
 
-T   = len(y_lagged[0])
-
-# Create a triangular system following Zha (1999)
-x = []
-x.append(X_lagged)
-x.append(np.vstack((x[0], y_lagged[0])))
-x.append(np.vstack((x[1], y_lagged[1])))
-
-# Coefficients from regression
-b_hat0 = []
-# Part of precision matrix for coefficient draws following Zha
-Lam = []
-# Part of gamma distribution of scaling coefficient \zeta in Zha
-dt = []
-
-for k in range(n):
-    b_hat0.append(la.solve(x[k]@x[k].T, x[k]@y_lagged[k]))
-    Lam.append(x[k] @ x[k].T)
-    et = y_lagged[k] - x[k].T@b_hat0[k] # Residuals
-    dt.append(et @ et)
+# Create a triangular system following Zha (1999): the coefficients from
+# regression, part of the precision matrix for coefficient draws and part of
+# the gamma distribution of the scaling coefficient \zeta
+T, b_hat0, Lam, dt = MLEVARtriangular(y_lagged, X_lagged)
 
 iters = 1000000 # Recommended iterations: 1,000,000
 
+# Adaptive mode: the draws are run in batches of batch_size until the Monte
+# Carlo standard errors of all reported weighted percentiles are below se_tol
+# times the weighted 10-90 percentile range of the parameter, or until iters
+# draws have been made. With adapt_proposal, the mean of the coefficient
+# proposal is moved to the weighted mean of the draws after each batch and
+# the weights are corrected by the importance sampling ratio. The batches are
+# run by the compiled kernel if compiled is set.
+adaptive        = False
+batch_size      = 50000
+se_tol          = 0.01
+adapt_proposal  = False
+min_ess         = 1000   # effective sample size required before the stopping rule and the adaptation apply
+
+# With compiled, the draws are run by the nopython kernel MLEVARkernel in
+# chunks of chunk_size draws per call. Otherwise gen_results is called per draw.
+compiled        = True
+chunk_size      = 10000
+
+# Precision of the stored draws: the log-weights and the parameters of each
+# draw. np.float32 halves the memory of the results and of draws_file, while
+# the draws themselves, the Lyapunov solve, the log-determinant and the
+# normalization of the weights are computed in double precision.
+storage_dtype   = np.float64
+draws_file      = None   # if set, the stored draws are saved to this .npz file, e.g. for posterior.py
+
+# Map-reduce mode, for runs too large to hold every draw in memory (e.g. 10^8
+# draws): each chunk of the compiled kernel is reduced to a DrawSummary
+# (histograms on sketch_bins fixed bins per parameter, moment and weight sums)
+# and the summaries are merged as the chunks finish. The bin ranges are set
+# from a pilot chunk. Memory does not grow with the number of draws, and the
+# percentiles are accurate to a fraction of a bin.
+mapreduce       = False
+sketch_bins     = 8192
+
 # Get the number of cores available for parallelization
 # NOTE: Since the process is being run on all cores, runtime is influenced by
 # having other software running on the computer
@@ -186,8 +163,23 @@ current_seed = np.random.get_state()[1][0]
 # conditioned covariance matrices for the multivariate normal distribution
 cond_tol = 1e9
 
-# Gets the locations of the first coefficient associated with each variable
-cn = [0] +  np.cumsum(lags).astype(np.int).tolist()
+# Telemetry: every process counts its draws by outcome and the time spent in
+# each stage of a draw (see draw_counts and stage_times), and the pool workers send these counters to the
+# main process in batches, at most every telemetry_interval seconds and at the
+# end of each chunk of draws. The main process shows the progress, draws per
+# second, the time left and the rejection rates. With metrics_file set, these
+# are also appended as JSON lines to the file every metrics_interval seconds,
+# e.g. to follow long unattended runs.
+telemetry_interval = 1.0
+metrics_file    = None
+metrics_interval = 10.0
+
+# Progress of a run, created when the Monte Carlo is run as a script (see Telemetry)
+telemetry = None
+
+# Inputs of MLEVARsim packed into arrays for MLEVARkernel
+packed = MLEVARpack(b_hat0, Lam, dt, lags, cn, noncinds)
+unshifted = MLEVARshift(None, Lam, packed[1])     # the posterior as proposal
 
 def gen_results(i):
     """
@@ -202,153 +194,434 @@ def gen_results(i):
     i (int):    Keeps track of the iteration number of the specific call. Used
                     for random number generator seeding
     """
-    if current_process().pid % cpus == 0:
-        pbar.update(cpus)  # Track progress on one core only
-
     # Get coefficient draws
-    [G, BB, mx] = MLEVARsim(n, T, b_hat0, Lam, dt, lags, cn, i + current_seed, noncinds)
+    start = time.perf_counter()
+    zeta, b_hat1, _ = MLEVARdraw(n, T, b_hat0, Lam, dt, i + current_seed)
+    lap('draw', start)
+    res = draw_results(zeta, b_hat1)
+    if telemetry_queue is not None and time.perf_counter() - last_report > telemetry_interval:
+        report_telemetry()
+    return res
+
+def gen_results_chunk(args):
+    """gen_results for the draws first, ..., first + size - 1 given as args = (first, size), for pool.imap."""
+    (first, size) = args
+    res = [gen_results(i) for i in range(first, first + size)]
+    report_telemetry()
+    return res
+
+# Number of draws by outcome of draw_results: discarded by the screen on the lag
+# polynomial, by the eigenvalue check or by the condition number of Sigma_j, or
+# kept. stage_times holds the seconds spent in each stage of a draw, whatever
+# its outcome: draw (MLEVARdraw), map_screen (MLEVARmap and MLEVARscreen),
+# assemble_eigvals (MLEVARassemble and the eigenvalue check), lyapunov_cond
+# (Sigma_j and its condition number) and process_VAR; the compiled kernel only
+# reports its total time, kernel, as it cannot read a clock in nopython mode.
+# Each process counts its own draws, the pool workers send their counts to the
+# main process through telemetry_queue (see report_telemetry).
+STAGES = ['screen', 'eigvals', 'cond', 'valid']
+draw_counts = collections.Counter()
+stage_times = collections.Counter()
+telemetry_queue = None
+last_report = time.perf_counter()
+
+def init_worker(queue):
+    """Pool initializer, makes a worker send its counters to the main process through queue."""
+    global telemetry_queue
+    telemetry_queue = queue
+    draw_counts.clear()                     # a forked worker starts with a copy of the counters of the main process
+    stage_times.clear()
+
+def report_telemetry():
+    """Sends the counters of this process to the main process and resets them."""
+    global last_report
+    last_report = time.perf_counter()
+    if telemetry_queue is None or not (draw_counts or stage_times):
+        return
+    telemetry_queue.put((dict(draw_counts), dict(stage_times)))
+    draw_counts.clear()
+    stage_times.clear()
+
+def lap(stage, start):
+    """Adds the time since start to stage in stage_times and returns the current time."""
+    now = time.perf_counter()
+    stage_times[stage] += now - start
+    return now
+
+def draw_results(zeta, b_hat1):
+    """
+    Discards explosive or badly conditioned draws, otherwise returns the outputs
+    of process_VAR for the draw. The checks are run from the cheapest to the
+    most expensive, so that most explosive draws are discarded before G, BB and
+    mx are assembled.
+    """
+    start = time.perf_counter()
+    Astar, B1 = MLEVARmap(zeta, b_hat1)
+    # Necessary condition for stability on the 3x3 lag polynomial
+    stable = MLEVARscreen(Astar, lags, cn)
+    start = lap('map_screen', start)
+    if not stable:
+        draw_counts['screen'] += 1
+        return 0, 0, 0, 0, 0, 0, False
+    G, BB, mx = MLEVARassemble(n, Astar, B1, lags, cn, noncinds)
     # Check if the matrix G is explosive; if so, discard the draw. Otherwise, proceed.
-    if np.all(np.abs(la.eigvals(G)) <= 1):
-        Sigma   = la.solve_discrete_lyapunov(G,BB) # Written as Sigma_j in the paper
-        # Check Sigma_j for invertibility conditions
-        if np.linalg.cond(Sigma) <= cond_tol:
-            return process_VAR(G, Sigma, num_vars, uc, mx, BB, X0)
-    return 0, 0, 0, 0, 0, 0, False
-
-# Make a call to each of the jit functions MLEVARsim and process_VAR to compile them
+    stable = np.all(np.abs(la.eigvals(G)) <= 1)
+    start = lap('assemble_eigvals', start)
+    if not stable:
+        draw_counts['eigvals'] += 1
+        return 0, 0, 0, 0, 0, 0, False
+    Sigma   = la.solve_discrete_lyapunov(G,BB) # Written as Sigma_j in the paper
+    # Check Sigma_j for invertibility conditions
+    singular = np.linalg.cond(Sigma) > cond_tol
+    start = lap('lyapunov_cond', start)
+    if singular:
+        draw_counts['cond'] += 1
+        return 0, 0, 0, 0, 0, 0, False
+    res = process_VAR(G, Sigma, num_vars, uc, mx, BB, X0)
+    lap('process_VAR', start)
+    draw_counts['valid'] += 1
+    return res
+
+def gen_results_adaptive(i, shift):
+    """
+    Same as gen_results, but draws the coefficients from the posterior shifted
+    by shift (see MLEVARdraw). Also returns the log of the ratio of the
+    posterior to the proposal density at the draw, which corrects the weight,
+    and the drawn coefficients, which are used to adapt the proposal.
+
+    Inputs:
+    i (int):    Keeps track of the iteration number of the specific call. Used
+                    for random number generator seeding
+    shift:      None, or a list of numpy arrays shifting the mean of the
+                    coefficients of each equation
+    """
+    start = time.perf_counter()
+    zeta, b_hat1, logratio = MLEVARdraw(n, T, b_hat0, Lam, dt, i + current_seed, shift)
+    lap('draw', start)
+    res = draw_results(zeta, b_hat1)
+    if telemetry_queue is not None and time.perf_counter() - last_report > telemetry_interval:
+        report_telemetry()
+    return res, logratio, b_hat1
+
+def gen_results_adaptive_chunk(args):
+    """
+    gen_results_adaptive for the draws first, ..., first + size - 1 with the
+    proposal shift given as args = (first, size, shift), for pool.imap. Returns
+    the outputs of gen_chunk with a shift.
+    """
+    (first, size, shift) = args
+    out = [gen_results_adaptive(i, shift) for i in range(first, first + size)]
+    report_telemetry()
+    coeffs = np.zeros((size,) + packed[0].shape)
+    for (d, (_, _, b_hat1)) in enumerate(out):
+        for (k, b) in enumerate(b_hat1):
+            coeffs[d, k, :len(b)] = b
+    return store([o[0] for o in out]), np.array([o[1] for o in out]), coeffs
+
+def gen_chunk(first, size, shift = None):
+    """
+    Runs the draws first, ..., first + size - 1 in the compiled kernel. The
+    draws are those of gen_results, and the results agree with its results to
+    about 1e-4 relative per draw (see MLEVARkernel). Given shift, the
+    coefficients are drawn from the posterior shifted by shift, as in
+    gen_results_adaptive.
+
+    Input:
+    shift:      None, or a list of numpy arrays shifting the mean of the
+                    coefficients of each equation
+
+    Returns:
+    results:    A list of the numpy arrays logweights, ac, b, sigc1, sigz1, sigz2
+                    and valid, one entry per draw, in storage_dtype.
+    With a shift, the tuple (results, logratio, coeffs), where
+    logratio:   A numpy array of the log of the ratio of the posterior to the
+                    proposal density at each draw, not included in logweights.
+    coeffs:     A numpy array of the drawn coefficients of each draw, shape
+                    (size, n, max number of coefficients), padded with zeros.
+    """
+    seeds = np.arange(first, first + size) + current_seed
+    results = [np.empty(size, dtype = storage_dtype) for j in range(6)] + [np.empty(size, dtype = bool)]
+    stage = np.empty(size, dtype = np.int8)
+    if shift is None:
+        (proposal, logratio, coeffs) = (unshifted, np.empty(0), np.empty((0,) + packed[0].shape))
+    else:
+        (proposal, logratio, coeffs) = (MLEVARshift(shift, Lam, packed[1]), np.empty(size), np.empty((size,) + packed[0].shape))
+    start = time.perf_counter()
+    MLEVARkernel(seeds, T, *packed, uc, X0, cond_tol, *proposal, *results, stage, logratio, coeffs)
+    lap('kernel', start)
+    for (code, name) in enumerate(['valid', 'screen', 'eigvals', 'cond']):
+        draw_counts[name] += int(np.sum(stage == code))
+    report_telemetry()
+    return results if shift is None else (results, logratio, coeffs)
+
+def gen_chunk_star(args):
+    """gen_chunk taking (first, size) or (first, size, shift) as a single argument, for pool.imap."""
+    return gen_chunk(*args)
+
+def store(res):
+    """
+    Converts a list of outputs of gen_results to the arrays returned by
+    gen_chunk: the log-weights and the parameters in storage_dtype, and the
+    validity of each draw.
+    """
+    weights, ac, b, sigc1s, sigz1s, sigz2s, valid_runs = [np.array(a) for a in zip(*res)]
+    with np.errstate(divide = 'ignore'):
+        logweights = np.log(weights.astype(np.float64))
+    return [a.astype(storage_dtype) for a in [logweights, ac, b, sigc1s, sigz1s, sigz2s]] + [valid_runs.astype(bool)]
+
+def summarize_chunk(args):
+    """Runs a chunk of draws (first, size, ranges) in the compiled kernel and returns its DrawSummary."""
+    (first, size, ranges) = args
+    res = gen_chunk(first, size)
+    summary = DrawSummary(ranges, sketch_bins)
+    summary.add(res[0], dict(zip(PARAMETERS, res[1:6])), res[6])
+    return summary
+
+def run_mapreduce():
+    """
+    Runs the Monte Carlo in map-reduce mode (see mapreduce) and returns the
+    DrawSummary of all draws. The first chunk is run as a pilot to set the
+    range of the bins of each parameter: its 1-99 percentile range, extended
+    by its width on each side. Draws outside the range are kept in the
+    underflow and overflow bins.
+    """
+    pilot = gen_chunk(0, min(chunk_size, iters))
+    valid_runs = pilot[6]
+    ranges = {}
+    for (name, x) in zip(PARAMETERS, pilot[1:6]):
+        lo, hi = np.percentile(x[valid_runs].astype(np.float64), [1, 99])
+        ranges[name] = (2 * lo - hi, 2 * hi - lo)
+    summary = DrawSummary(ranges, sketch_bins)
+    summary.add(pilot[0], dict(zip(PARAMETERS, pilot[1:6])), valid_runs)
+
+    chunks = [(first, min(chunk_size, iters - first), ranges) for first in range(chunk_size, iters, chunk_size)]
+    with Pool(cpus, init_worker, (telemetry_queue,)) as pool:
+        for part in pool.imap_unordered(summarize_chunk, chunks):
+            summary.merge(part)
+    return summary
+
+def precision(draws):
+    """
+    Returns the effective sample size of the valid draws, a DrawSet, and the
+    largest standard error of the weighted 10th, 50th and 90th percentiles
+    relative to the weighted 10-90 percentile range of each parameter.
+    """
+    worst = 0
+    for name in PARAMETERS:
+        spread = draws.percentile(name, 90, True) - draws.percentile(name, 10, True)
+        for p in [10, 50, 90]:
+            worst = max(worst, draws.se(name, p) / spread)
+    return draws.ess(), worst
+
+def run_adaptive():
+    """
+    Runs the Monte Carlo in batches of batch_size draws until the precision
+    se_tol is reached (see precision) or iters draws have been made. Returns
+    the results of all draws in the format of gen_chunk, with the log-weights
+    corrected by the ratio of the posterior to the proposal density.
+    """
+    res = []
+    coeffs = []
+    shift = [np.zeros(len(bk)) for bk in b_hat0]     # the posterior as proposal, log-ratios of 0
+    drawn = 0
+    # The proposal shift is passed to the workers with each chunk, so one pool runs all batches
+    with Pool(cpus, init_worker, (telemetry_queue,)) as pool:
+        while drawn < iters:
+            last = min(drawn + batch_size, iters)
+            chunks = [(first, min(chunk_size, last - first), shift) for first in range(drawn, last, chunk_size)]
+            for (results, logratio, b) in pool.imap(gen_chunk_star if compiled else gen_results_adaptive_chunk, chunks):
+                results[0] = (results[0].astype(np.float64) + logratio).astype(storage_dtype)
+                res.append(results)
+                coeffs.append(b)
+            drawn = last
+
+            logweights, ac, b, sigc1s, sigz1s, sigz2s, valid_runs = [np.concatenate(a) for a in zip(*res)]
+            draws = DrawSet(logweights, dict(zip(PARAMETERS, [ac, b, sigc1s, sigz1s, sigz2s])), valid_runs)
+            effective, worst = precision(draws)
+            print("\n{} draws: effective sample size {:.0f}, largest relative standard error {:.4f}".format(drawn, effective, worst))
+            if effective >= min_ess and worst <= se_tol:
+                break
+            if adapt_proposal and effective >= min_ess:
+                # Move the proposal mean to the weighted mean of the coefficients of the valid draws
+                mean = np.tensordot(draws.weights, np.concatenate(coeffs)[valid_runs], axes = 1)
+                shift = [mean[k, :len(bk)] - bk for (k, bk) in enumerate(b_hat0)]
+    return [np.concatenate(a) for a in zip(*res)]
+
+class Telemetry():
+    """
+    Progress of a run in the main process. A thread adds up the counters sent
+    by the processes to queue (see report_telemetry) and updates a progress bar
+    with the draws per second and the rejection rates; tqdm shows the time left.
+    With path set, the progress is also appended as a JSON line to path every
+    interval seconds and at the end of the run (see report).
+
+    Inputs:
+        total:    number of draws of the run
+        queue:    multiprocessing.Queue the counters are sent to
+        path:     metrics file, or None
+        interval: seconds between the lines of the metrics file
+    """
+    def __init__(self, total, queue, path = None, interval = 10.0):
+        self.total = total
+        self.queue = queue
+        self.path = path
+        self.interval = interval
+        self.counts = collections.Counter()
+        self.times = collections.Counter()
+        self.start = time.time()
+        self.pbar = tqdm(total = total)
+        self.thread = threading.Thread(target = self.collect, daemon = True)
+        self.thread.start()
+
+    def collect(self):
+        """Adds up the counters arriving on the queue until close puts None on it."""
+        written = time.time()
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            counts, times = item
+            self.counts.update(counts)
+            self.times.update(times)
+            self.pbar.update(sum(counts.get(stage, 0) for stage in STAGES))
+            rates = self.rates()
+            self.pbar.set_postfix_str("{:.0f} draws/s, explosive {:.1%}, cond {:.1%}".format(
+                self.rate(), rates['explosive'], rates['cond']), refresh = False)
+            if self.path is not None and time.time() - written > self.interval:
+                self.write()
+                written = time.time()
+
+    def draws(self):
+        """Returns the number of draws reported so far."""
+        return sum(self.counts[stage] for stage in STAGES)
+
+    def rate(self):
+        """Returns the draws per second since the start of the run."""
+        return self.draws() / max(time.time() - self.start, 1e-9)
+
+    def rates(self):
+        """Returns the fraction of the draws ending at each stage, with explosive for the screen and eigenvalue check together."""
+        draws = max(self.draws(), 1)
+        rates = dict((stage, self.counts[stage] / draws) for stage in STAGES)
+        rates['explosive'] = rates['screen'] + rates['eigvals']
+        return rates
+
+    def report(self):
+        """
+        Returns the progress of the run as a dict: the draws made, the total,
+        the elapsed time, draws per second, the expected time left, the count
+        and rate of each outcome of the draws and the seconds spent in each
+        stage, summed over the processes.
+        """
+        draws = self.draws()
+        rate = self.rate()
+        return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'draws': draws, 'total': self.total,
+                'elapsed_s': time.time() - self.start, 'draws_per_s': rate,
+                'eta_s': (self.total - draws) / rate if rate > 0 else None,
+                'counts': dict((stage, self.counts[stage]) for stage in STAGES),
+                'rates': self.rates(), 'stage_s': dict(self.times)}
+
+    def write(self):
+        """Appends the report as a JSON line to the metrics file."""
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(self.report()) + '\n')
+
+    def close(self):
+        """Collects the counters still on the queue, writes the last line of the metrics file and closes the progress bar."""
+        report_telemetry()
+        self.queue.put(None)
+        self.thread.join()
+        if self.path is not None:
+            self.write()
+        self.pbar.close()
+
+# Make a call to each of the jit functions process_VAR, MLEVARkernel and, through MLEVARsim, mvn to compile them
+process_VAR(G, Sigma, num_vars, uc, mx, BB, X0)                # at the MLE estimates, a stable system
 G, BB, mx = MLEVARsim(n, T, b_hat0, Lam, dt, lags, cn, 0, noncinds)
 Sigma       = la.solve_discrete_lyapunov(G,BB)                # Written as Sigma in the paper
-process_VAR(G, Sigma, num_vars, uc, mx, BB, X0)
-
-start = time.time()
-# Create a progress tracker
-pbar = tqdm(total = iters)
-# Create a parallel pool
-pool = Pool(cpus)
-# Run the pool, saving the results
-res = pool.map(gen_results, range(iters))
-pbar.close()
-pool.close()
-end = time.time()
-# Unpack the results from the parallel processes
-res = list(zip(*res))
-weights, ac, b, sigc1s, sigz1s, sigz2s, valid_runs = [np.array(a) for a in res]
-
-# Discard invalid runs (explosive eigenvalues)
-ac = ac[valid_runs]
-b = b[valid_runs]
-sigc1s = sigc1s[valid_runs]
-sigz1s = sigz1s[valid_runs]
-sigz2s = sigz2s[valid_runs]
-weights = weights[valid_runs]
-weights = weights / np.sum(weights)
-
-# Announce that estimation is complete and display useful stats and results
-try:
-    os.system('say "Estimation complete"')
-except:
-    pass
-
-print("Finished in {} seconds. {}% of the draws had explosive systems and were discarded.".format(round(end-start,2),round((iters - len(ac)) / iters * 100, 2)))
-
-print("\nUnweighted percentiles:")
-acDist = np.array([np.percentile(ac, 10), np.percentile(ac, 50), np.percentile(ac, 90)])
-print("\t{}_c:\t{}".format(chr(945),acDist))
-betaDist = np.array([np.percentile(b, 10), np.percentile(b, 50), np.percentile(b, 90)])
-print("\t{}_z:\t{}".format(chr(946),betaDist))
-sigc1Dist = np.array([np.percentile(sigc1s, 10), np.percentile(sigc1s, 50), \
-             np.percentile(sigc1s, 90)])
-print("\t{}_c^1:\t{}".format(chr(963),sigc1Dist))
-sigz1Dist = np.array([np.percentile(sigz1s, 10), np.percentile(sigz1s, 50), \
-             np.percentile(sigz1s, 90)])
-print("\t{}_z^1:\t{}".format(chr(963),sigz1Dist))
-sigz2Dist = np.array([np.percentile(sigz2s, 10), np.percentile(sigz2s, 50), \
-             np.percentile(sigz2s, 90)])
-print("\t{}_z^2:\t{}".format(chr(963),sigz2Dist))
-
-print("Weighted percentiles:")
-acDist = np.array([wprctile(ac, weights, 10), wprctile(ac, weights, 50), \
-          wprctile(ac, weights, 90)])
-print("\t{}_c:\t{}".format(chr(945),acDist))
-betaDist = np.array([wprctile(b, weights, 10), wprctile(b, weights, 50), \
-            wprctile(b, weights, 90)])
-print("\t{}_z:\t{}".format(chr(946),betaDist))
-sigc1Dist = np.array([wprctile(sigc1s, weights, 10), wprctile(sigc1s, weights, 50), \
-             wprctile(sigc1s, weights, 90)])
-print("\t{}_c^1:\t{}".format(chr(963),sigc1Dist))
-sigz1Dist = np.array([wprctile(sigz1s, weights, 10), wprctile(sigz1s, weights, 50), \
-             wprctile(sigz1s, weights, 90)])
-print("\t{}_z^1:\t{}".format(chr(963),sigz1Dist))
-sigz2Dist = np.array([wprctile(sigz2s, weights, 10), wprctile(sigz2s, weights, 50), \
-             wprctile(sigz2s, weights, 90)])
-print("\t{}_z^2:\t{}".format(chr(963),sigz2Dist))
-
-#######################
-#   Generate graphs   #
-#######################
-
-# Define the current variable (beta_z here)
-xint = b
-# We will discard some outliers
-inds = np.logical_and(xint > np.percentile(xint, 1), xint < np.percentile(xint, 99))
-# Generate histogram bins
-bins = np.linspace(np.percentile(xint, 1), np.percentile(xint, 99), 200)
-# Create an histogram where each draw is weighted equally
-plt.hist(xint[inds], bins = bins, density = True, \
-         alpha = .5, label='Unweighted')
-# Add a histogram where each draw is weighted by the marginal likelihood of X0
-plt.hist(xint[inds], weights = weights[inds], density = True, bins = bins, \
-         alpha = .5, label='Weighted')
-plt.legend()
-plt.title(r"$\beta_z$")
-# Save the figure
-plt.savefig("beta_z.png")
-plt.clf()
-
-xint = ac
-inds = np.logical_and(xint > np.percentile(xint, 1), xint < np.percentile(xint, 99))
-bins = np.linspace(np.percentile(xint, 1), np.percentile(xint, 99), 200)
-plt.hist(xint[inds], bins = bins, density = True, \
-         alpha = .5, label='Unweighted')
-plt.hist(xint[inds], weights = weights[inds], density = True, bins = bins, \
-         alpha = .5, label='Weighted')
-plt.legend()
-plt.title(r"$\alpha_c$")
-plt.savefig("alpha_c.png")
-plt.clf()
-
-xint = sigc1s
-inds = np.logical_and(xint > np.percentile(xint, 1), xint < np.percentile(xint, 99))
-bins = np.linspace(np.percentile(xint, 1), np.percentile(xint, 99), 200)
-plt.hist(xint[inds], bins = bins, density = True, \
-         alpha = .5, label='Unweighted')
-plt.hist(xint[inds], weights = weights[inds], density = True, bins = bins, \
-         alpha = .5, label='Weighted')
-plt.legend()
-plt.title(r"$\sigma_c^1$")
-plt.savefig("sigma_c^1.png")
-plt.clf()
-
-xint = sigz1s
-inds = np.logical_and(xint > np.percentile(xint, 1), xint < np.percentile(xint, 99))
-bins = np.linspace(np.percentile(xint, 1), np.percentile(xint, 99), 200)
-plt.hist(xint[inds], bins = bins, density = True, \
-         alpha = .5, label='Unweighted')
-plt.hist(xint[inds], weights = weights[inds], density = True, bins = bins, \
-         alpha = .5, label='Weighted')
-plt.legend()
-plt.title(r"$\sigma_z^1$")
-plt.savefig("sigma_z^1.png")
-plt.clf()
-
-xint = sigz2s
-inds = np.logical_and(xint > np.percentile(xint, 1), xint < np.percentile(xint, 99))
-bins = np.linspace(np.percentile(xint, 1), np.percentile(xint, 99), 200)
-plt.hist(xint[inds], bins = bins, density = True, \
-         alpha = .5, label='Unweighted')
-plt.hist(xint[inds], weights = weights[inds], density = True, bins = bins, \
-         alpha = .5, label='Weighted')
-plt.legend()
-plt.title(r"$\sigma_z^2$")
-plt.savefig("sigma_z^2.png")
-plt.clf()
+MLEVARkernel(np.arange(1), T, *packed, uc, X0, cond_tol, *unshifted, *[np.empty(1) for j in range(6)],
+             np.empty(1, dtype = bool), np.empty(1, dtype = np.int8), np.empty(0), np.empty((0,) + packed[0].shape))
+
+if __name__ == "__main__":
+    start = time.time()
+    # Collect the counters of all processes in the main process
+    telemetry_queue = Queue()
+    telemetry = Telemetry(iters, telemetry_queue, metrics_file, metrics_interval)
+    if mapreduce:
+        summary = run_mapreduce()
+    elif adaptive:
+        res = run_adaptive()
+        iters = len(res[6])
+    else:
+        chunks = [(first, min(chunk_size, iters - first)) for first in range(0, iters, chunk_size)]
+        res = []
+        with Pool(cpus, init_worker, (telemetry_queue,)) as pool:
+            # Chunks are returned in order
+            for chunk in pool.imap(gen_chunk_star if compiled else gen_results_chunk, chunks):
+                res.append(chunk)
+        if compiled:
+            res = [np.concatenate(a) for a in zip(*res)]
+        else:
+            res = store([r for chunk in res for r in chunk])
+    telemetry.close()
+    end = time.time()
+    # Unpack the results from the parallel processes
+    if mapreduce:
+        draws = summary
+    else:
+        logweights, ac, b, sigc1s, sigz1s, sigz2s, valid_runs = res
+        if draws_file is not None:
+            np.savez(draws_file, logweights = logweights, ac = ac, b = b, sigc1 = sigc1s,
+                     sigz1 = sigz1s, sigz2 = sigz2s, valid = valid_runs)
+        # Discard invalid runs (explosive eigenvalues)
+        draws = DrawSet(logweights, dict(zip(PARAMETERS, [ac, b, sigc1s, sigz1s, sigz2s])), valid_runs)
+
+    # Announce that estimation is complete and display useful stats and results
+    try:
+        os.system('say "Estimation complete"')
+    except:
+        pass
+
+    print("Finished in {} seconds. {}% of the draws had explosive systems and were discarded.".format(round(end-start,2),round((draws.draws - draws.valid) / draws.draws * 100, 2)))
+    print("Draws discarded by the polynomial screen: {}, by the eigenvalue check: {}, by the condition number: {}. Valid draws: {}.".format(
+          *[telemetry.counts[stage] for stage in STAGES]))
+    print("Seconds per stage of the draws, summed over the processes: {}".format(
+          ", ".join("{} {:.2f}".format(stage, t) for (stage, t) in sorted(telemetry.times.items()))))
+
+    # Printed name, plot title and file of each parameter
+    labels = {'ac': ("{}_c".format(chr(945)), r"$\alpha_c$", "alpha_c.png"),
+              'b': ("{}_z".format(chr(946)), r"$\beta_z$", "beta_z.png"),
+              'sigc1': ("{}_c^1".format(chr(963)), r"$\sigma_c^1$", "sigma_c^1.png"),
+              'sigz1': ("{}_z^1".format(chr(963)), r"$\sigma_z^1$", "sigma_z^1.png"),
+              'sigz2': ("{}_z^2".format(chr(963)), r"$\sigma_z^2$", "sigma_z^2.png")}
+
+    print("\nUnweighted percentiles:")
+    for name in PARAMETERS:
+        print("\t{}:\t{}".format(labels[name][0], np.array([draws.percentile(name, p) for p in [10, 50, 90]])))
+
+    print("Weighted percentiles:")
+    for name in PARAMETERS:
+        print("\t{}:\t{}".format(labels[name][0], np.array([draws.percentile(name, p, True) for p in [10, 50, 90]])))
+
+    print("Monte Carlo standard errors of the weighted percentiles (effective sample size {}):".format(round(draws.ess())))
+    for name in PARAMETERS:
+        print("\t{}:\t{}".format(labels[name][0], np.array([draws.se(name, p) for p in [10, 50, 90]])))
+
+    #######################
+    #   Generate graphs   #
+    #######################
+
+    for name in PARAMETERS:
+        # Histograms between the 1st and 99th percentiles, discarding outliers
+        edges, counts, wcounts = draws.histogram(name, 200)
+        # Create an histogram where each draw is weighted equally
+        plt.hist(edges[:-1], bins = edges, weights = counts, density = True, \
+                 alpha = .5, label='Unweighted')
+        # Add a histogram where each draw is weighted by the marginal likelihood of X0
+        plt.hist(edges[:-1], bins = edges, weights = wcounts, density = True, \
+                 alpha = .5, label='Weighted')
+        plt.legend()
+        plt.title(labels[name][1])
+        # Save the figure
+        plt.savefig(labels[name][2])
+        plt.clf()
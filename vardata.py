@@ -0,0 +1,107 @@
+##################################
+#  Import required dependencies  #
+##################################
+
+import numpy as np
+import csv
+import hashlib
+import os
+
+# Data layer of the VAR estimation in tenuous_estimation.py. The raw series of
+# data3py.csv are parsed into typed numpy arrays and the VAR inputs are
+# derived from them in one pass. The results are cached as an .npz file keyed
+# by the hash of the CSV and the offset, so that later runs, and worker
+# processes importing tenuous_estimation, load them without parsing the CSV.
+
+DATA_FILE = 'data3py.csv'
+CACHE_DIR = '__pycache__'
+CACHE_VERSION = 1           # increase when the derived series change
+
+# Columns of data3py.csv, besides the date
+COLUMNS = ['consnond', 'consserv', 'pinond', 'piserv', 'propinc', 'corpprof', 'pdivinc', 'popu']
+
+# Series returned by load
+SERIES = ['date', 'gcpc', 'logecpc', 'logdcpc']
+
+def filehash(path):
+    """The SHA-256 hash of the contents of the file at path."""
+    with open(path, 'rb') as file_:
+        return hashlib.sha256(file_.read()).hexdigest()
+
+def readraw(path):
+    """
+    Reads the raw series of data3py.csv.
+
+    Returns:
+    raw:        A dict mapping 'date' to a numpy array of strings (e.g. '1948Q1')
+                    and each name in COLUMNS to a float64 numpy array.
+    """
+    with open(path, newline = '') as file_:
+        rows = list(csv.reader(file_))
+    header = rows[0]
+    columns = list(zip(*rows[1:]))
+    raw = {'date': np.array(columns[header.index('date')])}
+    for name in COLUMNS:
+        raw[name] = np.array(columns[header.index(name)], dtype = np.float64)
+    return raw
+
+def derive(raw, offset = 0):
+    """
+    Computes the series used in the VAR from the raw series, dropping the last
+    offset observations.
+
+    Inputs:
+    raw:        A dict of raw series, as returned by readraw.
+    offset:     The number of final periods dropped. Set to 0 to use all time periods.
+
+    Returns:
+    series:     A dict with the dates of the observations used ('date'), the
+                    growth of log real consumption per capita ('gcpc') and the
+                    logs of business income ('logecpc') and personal dividend
+                    income ('logdcpc') relative to consumption.
+    """
+    # Filter out any observations which are outside the relevant time period
+    keep = raw['date'] <= raw['date'][-offset - 1]
+    CN, CS, PCN, PCS, NIPAE, NIPAPI, NIPAPDI, POP = [raw[name][keep] for name in COLUMNS]
+    PCN = PCN / 100                                 # price index for nondurables
+    PCS = PCS / 100                                 # price index for services
+
+    PCE = (PCN * CN + PCS * CS) / (CN + CS)         # weighted aggregate deflator
+    cpc = (CN + CS) / PCE / POP                     # real consumption per capita
+    e2pc = (NIPAE + NIPAPI) / PCE / POP             # business income (proprietor's income plus corporate profits) per capita
+    e3pc = NIPAPDI / PCE / POP                      # personal dividend income per capita
+
+    # We use the log values of the relevant variables
+    logcpc = np.log(cpc)
+    return {'date': raw['date'][keep], 'gcpc': np.diff(logcpc),
+            'logecpc': np.log(e2pc) - logcpc, 'logdcpc': np.log(e3pc) - logcpc}
+
+def load(path = DATA_FILE, offset = 0, cache = True):
+    """
+    Returns the series used in the VAR (see derive), from the cache if the
+    CSV and offset are unchanged since they were last computed.
+
+    Inputs:
+    path:       The path of the data CSV.
+    offset:     The number of final periods dropped.
+    cache:      If False, the CSV is always parsed and no cache file is written.
+    """
+    cachefile = os.path.join(os.path.dirname(os.path.abspath(path)), CACHE_DIR, '{}.{}.{}.v{}.npz'.format(
+        os.path.splitext(os.path.basename(path))[0], filehash(path)[:16], offset, CACHE_VERSION))
+    if cache and os.path.exists(cachefile):
+        try:
+            with np.load(cachefile) as stored:
+                return dict((name, stored[name]) for name in SERIES)
+        except (OSError, KeyError, ValueError):
+            pass                                    # unreadable cache, recompute it
+    series = derive(readraw(path), offset)
+    if cache:
+        try:
+            os.makedirs(os.path.dirname(cachefile), exist_ok = True)
+            # written under a temporary name, so that concurrent processes never read a partial file
+            temp = '{}.{}.npz'.format(cachefile[:-4], os.getpid())
+            np.savez(temp, **series)
+            os.replace(temp, cachefile)
+        except OSError:
+            pass                                    # e.g. a read-only directory, the cache is optional
+    return series